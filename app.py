@@ -1,21 +1,52 @@
 import streamlit as st
 import pandas as pd
-from datetime import datetime, timedelta
-from ecoscope.io.earthranger import EarthRangerIO
-import geopandas as gpd
+import numpy as np
+from datetime import datetime, timedelta, timezone
 import tempfile
 import os
 import zipfile
-from shapely.geometry import LineString, shape
+import queue
+import threading
+import time
+import json
+import tracemalloc
+import importlib.util
+import gzip
+import hashlib
+import io
+import csv
+import pickle
+import sys
 import requests as _requests
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlparse
+from requests.adapters import BaseAdapter, HTTPAdapter
+from urllib3.util.retry import Retry
 
-# Optional imports for map
-try:
-    import folium
-    from streamlit_folium import folium_static
-    HAS_FOLIUM = True
-except ImportError:
-    HAS_FOLIUM = False
+from event_transforms import (
+    flatten_event_details, flatten_events_parallel, insert_name_columns, resolve_uuid_columns, uuid_column_counts,
+    uuid_names
+)
+
+# The geospatial stack (ecoscope, geopandas, shapely, folium) is imported lazily
+# where it is first needed, so the login form renders without loading it.
+# Streamlit reruns the script on every interaction; repeat imports are free.
+
+# Optional imports for map - only check availability here
+HAS_FOLIUM = (
+    importlib.util.find_spec("folium") is not None
+    and importlib.util.find_spec("streamlit_folium") is not None
+)
+# Optional zstd compression for CSV exports (gzip is always available)
+HAS_ZSTD = importlib.util.find_spec("zstandard") is not None
+# Optional GeoTIFF output for the patrol-effort grid (GeoParquet is always available)
+HAS_RASTERIO = importlib.util.find_spec("rasterio") is not None
+# Optional fast JSON decoding of EarthRanger responses (the standard library parser otherwise)
+HAS_ORJSON = importlib.util.find_spec("orjson") is not None
 
 # Page configuration
 st.set_page_config(
@@ -28,96 +59,2355 @@ st.set_page_config(
 # Calls GoatCounter's public count endpoint server-side - no API key required
 # Bypasses Streamlit's sandboxed iframe which blocks browser-side JS trackers
 # Dashboard: https://gcfstreamlit.goatcounter.com
-if "goatcounter_loaded" not in st.session_state:
-    st.session_state["goatcounter_loaded"] = True
+# Hits are queued and sent by a background thread so a slow or unreachable
+# endpoint (e.g. offline field deployments) never delays the first page render
+GOATCOUNTER_URL = "https://gcfstreamlit.goatcounter.com/count"
+ANALYTICS_QUEUE_SIZE = 100   # hits beyond this are dropped, never waited on
+ANALYTICS_BATCH_SIZE = 20    # max hits sent per wake-up of the worker
+
+
+def analytics_enabled():
+    """Analytics can be switched off with GCF_ANALYTICS=off or [analytics] enabled = false in secrets."""
+    if os.environ.get('GCF_ANALYTICS', '').strip().lower() in ('0', 'false', 'off', 'no'):
+        return False
     try:
-        _requests.get(
-            "https://gcfstreamlit.goatcounter.com/count",
-            params={"p": "/", "t": "Patrol Shapefile Downloader"},
-            headers={"User-Agent": "Mozilla/5.0 (compatible; StreamlitApp/1.0)"},
-            timeout=2
-        )
+        return bool(st.secrets.get('analytics', {}).get('enabled', True))
     except Exception:
-        pass  # Never let analytics errors affect the app
+        return True  # No secrets file configured
+
+
+def _analytics_worker(hits, url):
+    """Drain queued hits in batches and send them over one keep-alive session."""
+    session = _requests.Session()
+    session.headers.update({"User-Agent": "Mozilla/5.0 (compatible; StreamlitApp/1.0)"})
+    while True:
+        batch = [hits.get()]
+        while len(batch) < ANALYTICS_BATCH_SIZE:
+            try:
+                batch.append(hits.get_nowait())
+            except queue.Empty:
+                break
+        for params in batch:
+            try:
+                session.get(url, params=params, timeout=2)
+            except Exception:
+                pass  # Never let analytics errors affect the app
+            finally:
+                hits.task_done()
+
+
+@st.cache_resource
+def get_analytics_queue(url=GOATCOUNTER_URL):
+    """Start the analytics worker once per process and return its bounded queue."""
+    hits = queue.Queue(maxsize=ANALYTICS_QUEUE_SIZE)
+    threading.Thread(target=_analytics_worker, args=(hits, url), daemon=True, name="goatcounter").start()
+    return hits
+
+
+def track_page_view(path="/", title="Patrol Shapefile Downloader", url=GOATCOUNTER_URL):
+    """Queue a GoatCounter hit without blocking; drops the hit if the queue is full."""
+    try:
+        get_analytics_queue(url).put_nowait({"p": path, "t": title})
+    except queue.Full:
+        pass
+
+
+if "goatcounter_loaded" not in st.session_state:
+    st.session_state["goatcounter_loaded"] = True
+    if analytics_enabled():
+        track_page_view()
 
 # Initialize session state for authentication
 if 'authenticated' not in st.session_state:
     st.session_state.authenticated = False
 if 'er_io' not in st.session_state:
     st.session_state.er_io = None
+if 'diagnostics' not in st.session_state:
+    st.session_state.diagnostics = {}
+if 'er_server' not in st.session_state:
+    st.session_state.er_server = None
+if 'extra_connections' not in st.session_state:
+    st.session_state.extra_connections = {}  # {server label: er_io} for multi-server exports
+
+# HTTP transport for EarthRanger calls
+# One pool is shared by every session in this process, so TLS handshakes and
+# TCP setup are paid once per host instead of once per request
+ER_POOL_HOSTS = 10       # number of per-host pools kept alive
+ER_POOL_MAXSIZE = 8      # max concurrent connections to any one host
+
+
+@st.cache_resource
+def get_er_http_adapter():
+    """Return the process-wide HTTPAdapter used for all EarthRanger traffic."""
+    # Same retry policy erclient installs on its own session, except that
+    # 429/503 Retry-After is left to ScheduledAdapter, which pauses the whole host
+    # instead of sleeping here while holding a pooled connection
+    retries = Retry(total=5, backoff_factor=1.5, status_forcelist=[502], respect_retry_after_header=False)
+    # pool_block=True makes pool_maxsize a hard per-host concurrency limit:
+    # extra requests wait for a free connection instead of opening new ones
+    return HTTPAdapter(
+        pool_connections=ER_POOL_HOSTS,
+        pool_maxsize=ER_POOL_MAXSIZE,
+        pool_block=True,
+        max_retries=retries
+    )
+
+
+# Request scheduling
+# Every EarthRanger request from every session passes one scheduler: a token
+# bucket per host keeps aggregate traffic at the server's sustainable rate,
+# waiting requests are served round-robin across logins so one large export
+# cannot starve the others, and a 429 pauses the whole host for its Retry-After.
+ER_RATE_PER_S = float(os.environ.get('GCF_ER_RATE_PER_S', 10))  # sustained requests per second per host
+ER_RATE_BURST = 20           # requests allowed back-to-back after an idle spell
+ER_THROTTLE_RETRIES = 5      # 429/503 responses retried per request before giving up
+ER_THROTTLE_MAX_WAIT_S = 120  # cap on a single Retry-After pause
+# 503s are only retried for these; a POST may have been acted on before it failed
+ER_IDEMPOTENT_METHODS = frozenset(['GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE', 'TRACE'])
+
+
+class RequestScheduler:
+    """
+    Token bucket per host with round-robin fair queuing across clients.
+    acquire(host, client) blocks until the request may be sent; pause(host, s)
+    holds every client of a host back, e.g. after a 429. Keeps per-host metrics.
+    """
+
+    def __init__(self, rate_per_s, burst):
+        self.rate_per_s = rate_per_s
+        self.burst = burst
+        self._cond = threading.Condition()
+        self._hosts = {}
+
+    def _host(self, host):
+        state = self._hosts.get(host)
+        if state is None:
+            state = self._hosts[host] = {
+                'tokens': float(self.burst), 'updated': time.monotonic(), 'paused_until': 0.0,
+                'queues': OrderedDict(),  # client -> waiting tickets, in serving order
+                'metrics': {'requests': 0, 'throttled': 0, 'wait_s': 0.0, 'max_queue': 0},
+            }
+        return state
+
+    def acquire(self, host, client):
+        ticket = object()
+        start = time.monotonic()
+        with self._cond:
+            state = self._host(host)
+            state['queues'].setdefault(client, deque()).append(ticket)
+            waiting = sum(len(q) for q in state['queues'].values())
+            state['metrics']['max_queue'] = max(state['metrics']['max_queue'], waiting)
+            served = False
+            try:
+                while True:
+                    now = time.monotonic()
+                    state['tokens'] = min(self.burst, state['tokens'] + (now - state['updated']) * self.rate_per_s)
+                    state['updated'] = now
+                    head_client, head_queue = next(iter(state['queues'].items()))
+                    if now < state['paused_until']:
+                        delay = state['paused_until'] - now
+                    elif head_queue[0] is not ticket:
+                        delay = None  # Not our turn; woken when the head is served
+                    elif state['tokens'] >= 1:
+                        state['tokens'] -= 1
+                        head_queue.popleft()
+                        served = True
+                        # The served client goes to the back of the rotation
+                        if head_queue:
+                            state['queues'].move_to_end(head_client)
+                        else:
+                            del state['queues'][head_client]
+                        state['metrics']['requests'] += 1
+                        state['metrics']['wait_s'] += time.monotonic() - start
+                        self._cond.notify_all()
+                        return
+                    else:
+                        delay = (1 - state['tokens']) / self.rate_per_s
+                    self._cond.wait(delay)
+            finally:
+                # Interrupted while waiting (e.g. KeyboardInterrupt): a ticket left
+                # queued would block every later request to this host
+                if not served:
+                    self._withdraw(state, client, ticket)
+
+    def _withdraw(self, state, client, ticket):
+        """Remove an unserved ticket from its client's queue and let the next waiter go (lock held)"""
+        tickets = state['queues'].get(client)
+        if tickets is not None and ticket in tickets:
+            tickets.remove(ticket)
+            if not tickets:
+                del state['queues'][client]
+        self._cond.notify_all()
+
+    def pause(self, host, seconds):
+        with self._cond:
+            state = self._host(host)
+            state['paused_until'] = max(state['paused_until'], time.monotonic() + seconds)
+            state['metrics']['throttled'] += 1
+            self._cond.notify_all()
+
+    def metrics(self, hosts=None):
+        """Per-host metrics, limited to hosts when given"""
+        with self._cond:
+            return {
+                host: {**state['metrics'], 'wait_s': round(state['metrics']['wait_s'], 1)}
+                for host, state in self._hosts.items()
+                if hosts is None or host in hosts
+            }
+
+
+@st.cache_resource
+def get_request_scheduler():
+    """The process-wide scheduler shared by all sessions"""
+    return RequestScheduler(ER_RATE_PER_S, ER_RATE_BURST)
+
+
+def retry_after_seconds(response, attempt):
+    """Seconds to wait before retrying a throttled response: its Retry-After, else exponential backoff"""
+    value = response.headers.get('Retry-After', '')
+    try:
+        seconds = float(value)
+    except ValueError:
+        try:
+            seconds = (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds()
+        except (TypeError, ValueError):
+            seconds = 2 ** attempt
+    return min(max(seconds, 0.0), ER_THROTTLE_MAX_WAIT_S)
+
+
+def decode_json(response, **kwargs):
+    """
+    A response's JSON body, decoded with orjson straight from its bytes when
+    orjson is installed. requests' own json() handles keyword arguments and
+    bodies orjson rejects: it decodes other encodings or raises its usual error.
+    """
+    if kwargs or not HAS_ORJSON:
+        return _requests.Response.json(response, **kwargs)
+    import orjson
+    try:
+        return orjson.loads(response.content)
+    except orjson.JSONDecodeError:
+        return _requests.Response.json(response)
+
+
+class ScheduledAdapter(BaseAdapter):
+    """
+    Per-login transport adapter: takes a scheduler slot for every request, sends
+    it through the shared pooled adapter, and waits out 429/503 throttling
+    (503 only for idempotent methods; 429 means the request was not processed).
+    Responses decode JSON with orjson when it is installed.
+    """
+
+    def __init__(self, pooled, scheduler, client):
+        super().__init__()
+        self.pooled = pooled
+        self.scheduler = scheduler
+        self.client = client
+
+    def send(self, request, **kwargs):
+        host = urlparse(request.url).netloc
+        for attempt in range(ER_THROTTLE_RETRIES + 1):
+            self.scheduler.acquire(host, self.client)
+            response = self.pooled.send(request, **kwargs)
+            retryable = response.status_code == 429 or (
+                response.status_code == 503 and request.method in ER_IDEMPOTENT_METHODS
+            )
+            if not retryable or attempt == ER_THROTTLE_RETRIES:
+                if HAS_ORJSON:
+                    # erclient calls response.json() itself, so each response carries the decoder
+                    response.json = partial(decode_json, response)
+                return response
+            self.scheduler.pause(host, retry_after_seconds(response, attempt))
+            response.close()
+        return response
+
+    def close(self):
+        pass  # The pooled adapter is shared by every login; it lives as long as the process
+
+
+def configure_er_transport(er_io):
+    """
+    Route an EarthRangerIO client through the request scheduler and the shared
+    keep-alive, gzip-enabled connection pool.
+    """
+    session = getattr(er_io, '_http_session', None)
+    if session is None:
+        return er_io  # Older clients without a session fall back to plain requests
+    adapter = ScheduledAdapter(get_er_http_adapter(), get_request_scheduler(), client=id(session))
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.headers.update({
+        'Accept-Encoding': 'gzip, deflate',
+        'Connection': 'keep-alive'
+    })
+    # Count calls and bytes received for the diagnostics panel
+    if not hasattr(session, 'er_call_stats'):
+        session.er_call_stats = {'calls': 0, 'bytes': 0}
+
+        def _count_response(response, *args, **kwargs):
+            stats = session.er_call_stats
+            stats['calls'] += 1
+            stats['bytes'] += received_bytes(response, stream=kwargs.get('stream', False))
+            return response
+
+        session.hooks['response'].append(_count_response)
+    return er_io
+
+
+def received_bytes(response, stream=False):
+    """
+    Body bytes received for a response. The body is read here, which requests
+    does right after its response hooks anyway, since chunked and compressed
+    responses rarely carry a Content-Length. urllib3 counts the bytes read off
+    the wire (before gzip decoding) except for chunked bodies, which are
+    counted after decoding. Streamed responses are left unread and counted by
+    their Content-Length.
+    """
+    if stream:
+        size = response.headers.get('Content-Length')
+        return int(size) if size and size.isdigit() else 0
+    content = response.content or b''
+    wire = getattr(response.raw, 'tell', None)
+    return (wire() if callable(wire) else 0) or len(content)
+
+
+def get_er_call_stats(er_io):
+    """Return a snapshot of {'calls', 'bytes'} made through an EarthRangerIO client so far"""
+    session = getattr(er_io, '_http_session', None)
+    return dict(getattr(session, 'er_call_stats', {'calls': 0, 'bytes': 0}))
+
+
+class ExportProfiler:
+    """
+    Records wall time, EarthRanger API calls, bytes received and peak memory
+    for each stage of an export flow, for the diagnostics panel.
+    Stages are marked with lap(name), which ends the previous stage, so the
+    linear export code needs no extra nesting. A disabled profiler is a no-op.
+    Peak memory comes from a MemoryTracing shared with concurrent exports.
+    """
+
+    def __init__(self, flow, er_io=None, enabled=True, tracing=None):
+        self.flow = flow
+        self.er_io = er_io
+        self.enabled = enabled
+        self.stages = []
+        self._current = None
+        self._tracing = tracing or MemoryTracing()
+        self._traced = False
+        if enabled:
+            self._tracing.start()
+            self._traced = True
+
+    def lap(self, name):
+        """End the running stage (if any) and start timing a new one"""
+        if not self.enabled:
+            return
+        self._end_stage()
+        self._current = {
+            'name': name,
+            'start': time.perf_counter(),
+            'api': get_er_call_stats(self.er_io),
+            'peak_shared': not self._tracing.reset_peak(),
+            'starts': self._tracing.starts,
+        }
+
+    def annotate(self, **values):
+        """Attach extra measurements (e.g. frame sizes) to the running stage"""
+        if self.enabled and self._current is not None:
+            self._current.setdefault('notes', {}).update(values)
+
+    def finish(self):
+        """End the running stage and stop memory tracing"""
+        if not self.enabled:
+            return
+        self._end_stage()
+        if self._traced:
+            self._tracing.stop()
+            self._traced = False
+
+    def _end_stage(self):
+        if self._current is None:
+            return
+        api = get_er_call_stats(self.er_io)
+        shared = self._current['peak_shared'] or self._tracing.starts != self._current['starts']
+        self.stages.append({
+            'stage': self._current['name'],
+            'seconds': round(time.perf_counter() - self._current['start'], 3),
+            'api_calls': api['calls'] - self._current['api']['calls'],
+            'bytes_received': api['bytes'] - self._current['api']['bytes'],
+            'peak_memory_mb': round(tracemalloc.get_traced_memory()[1] / 1e6, 1),
+            # Another export was traced at the same time, so the peak covers both
+            **({'peak_memory_shared': True} if shared else {}),
+            **self._current.get('notes', {}),
+        })
+        self._current = None
+
+    def to_dict(self):
+        return {
+            'flow': self.flow,
+            'recorded_at': datetime.now().isoformat(timespec='seconds'),
+            'total_seconds': round(sum(stage['seconds'] for stage in self.stages), 3),
+            'stages': self.stages,
+        }
+
+
+class MemoryTracing:
+    """
+    tracemalloc shared by concurrent exports. Tracing is process-wide, so the
+    first export to start it starts tracemalloc and the last to stop stops it
+    (unless something else was already tracing). The peak is only reset while a
+    single export is traced; overlapping exports share one peak.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._users = 0
+        self._owned = False
+        self.starts = 0  # exports started so far; a change means another export joined
+
+    def start(self):
+        with self._lock:
+            if self._users == 0 and not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self._owned = True
+            self._users += 1
+            self.starts += 1
+
+    def stop(self):
+        with self._lock:
+            self._users -= 1
+            if self._users == 0 and self._owned:
+                tracemalloc.stop()
+                self._owned = False
+
+    def reset_peak(self):
+        """Reset the traced peak if no other export is traced; returns whether it was reset"""
+        with self._lock:
+            if self._users != 1:
+                return False
+            tracemalloc.reset_peak()
+            return True
+
+
+@st.cache_resource
+def get_memory_tracing():
+    """The process-wide memory tracing shared by all sessions' profilers"""
+    return MemoryTracing()
+
+
+@contextmanager
+def export_profiler(flow):
+    """
+    Profile an export flow, enabled only when diagnostics are switched on. The
+    profiler is closed and recorded however the flow ends, including errors and
+    st.stop(), so memory tracing never outlives the export.
+    """
+    profiler = ExportProfiler(
+        flow,
+        er_io=st.session_state.er_io,
+        enabled=st.session_state.get('diagnostics_enabled', False),
+        tracing=get_memory_tracing()
+    )
+    try:
+        yield profiler
+    finally:
+        record_diagnostics(profiler)
+
+
+def record_diagnostics(profiler):
+    """Close the profiler and keep its stages for the diagnostics panel"""
+    if profiler.enabled:
+        profiler.finish()
+        st.session_state.diagnostics[profiler.flow] = profiler.to_dict()
+
 
 def authenticate_earthranger(server, username, password):
     """Authenticate with EarthRanger and return EarthRangerIO instance"""
     try:
-        er_io = EarthRangerIO(
+        from ecoscope.io.earthranger import EarthRangerIO
+        er_io = configure_er_transport(EarthRangerIO(
             server=server,
             username=username,
             password=password
-        )
-        return er_io, None
+        ))
+        # Read calls go through the response cache shared with this user's other sessions
+        return CachedEarthRangerIO(er_io, server_label(server), permission_scope(er_io, username)), None
     except Exception as e:
         return None, str(e)
 
-def build_subject_lookup(er_io):
-    """Fetch all subjects and return a {uuid: display_name} dict for UUID resolution."""
-    try:
-        subjects_df = er_io.get_subjects(include_inactive=True)
-        if subjects_df is not None and not subjects_df.empty and 'id' in subjects_df.columns and 'name' in subjects_df.columns:
-            return dict(zip(subjects_df['id'].astype(str), subjects_df['name'].astype(str)))
-    except Exception:
-        pass
-    return {}
 
+# Shared response cache
+# Read calls are cached once per process. Keys include the server and the
+# login's permission sets, so rangers and analysts who can see the same data
+# reuse each other's fetches and no one is served data they could not fetch
+# themselves. Entries expire after a TTL and the least recently used are
+# evicted beyond the memory budget; an optional disk tier in a private
+# directory survives restarts. Date windows reaching the present are split:
+# the part before closed_window_cutoff() is cached, the rest always fetched.
+# Open patrols are never cached, and the "Fetch fresh data" switch re-fetches
+# everything else.
+RESPONSE_CACHE_MAX_MB = float(os.environ.get('GCF_RESPONSE_CACHE_MB', 128))  # 0 disables the cache
+RESPONSE_CACHE_DISK_MB = float(os.environ.get('GCF_RESPONSE_CACHE_DISK_MB', 0))  # 0 keeps it in memory only
+RESPONSE_CACHE_DISK_DIR = os.environ.get(
+    'GCF_RESPONSE_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'gcf_patrol_downloader', 'responses')
+)
+RESPONSE_CACHE_TTL_S = 10 * 60
+GEOMETRY_NBYTES = 100  # approximate GEOS footprint of one geometry besides its coordinates
+FRAME_NBYTES_SAMPLE = 1000  # rows whose nested dicts and lists are measured when sizing an entry
+CACHED_ER_METHODS = ('get_patrols', 'get_patrol_observations', 'get_events',
+                     'get_patrol_segment_events', 'get_subjects')
+
+
+class ResponseCache:
+    """
+    Thread-safe LRU of API response DataFrames with a byte budget, a TTL and an
+    optional on-disk tier. Concurrent misses on one key wait for a single fetch.
+    Callers always get their own copy, so they can add columns freely.
+    """
+
+    def __init__(self, max_bytes, ttl_s, disk_dir=None, disk_max_bytes=0):
+        self.max_bytes = max_bytes
+        self.ttl_s = ttl_s
+        self.disk_dir = disk_dir if disk_max_bytes > 0 else None
+        self.disk_max_bytes = disk_max_bytes
+        self._entries = OrderedDict()  # key -> (stored at, bytes, frame), least recently used first
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._inflight = {}  # key -> lock held while that key is being fetched
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+        if self.disk_dir and not private_dir(self.disk_dir):
+            self.disk_dir = None  # Pickles are only read from a directory no one else can write to
+
+    def get_or_fetch(self, key, fetch, refresh=False):
+        """Return the cached frame for key, or call fetch() once and cache its result; refresh always fetches"""
+        with self._lock:
+            key_lock = self._inflight.setdefault(key, threading.Lock())
+        with key_lock:
+            try:
+                frame = None if refresh else self._get(key)
+                if frame is None:
+                    frame = fetch()
+                    if isinstance(frame, pd.DataFrame):
+                        self._put(key, frame)
+            finally:
+                with self._lock:
+                    self._inflight.pop(key, None)
+        return frame.copy() if isinstance(frame, pd.DataFrame) else frame
+
+    def summary(self):
+        with self._lock:
+            return {'entries': len(self._entries), 'mb': round(self._bytes / 1e6, 1), **self.stats}
+
+    def _get(self, key):
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and now - entry[0] < self.ttl_s:
+                self._entries.move_to_end(key)
+                self.stats['hits'] += 1
+                return entry[2]
+        frame = self._read_disk(key, now)
+        with self._lock:
+            self.stats['hits' if frame is not None else 'misses'] += 1
+        if frame is not None:
+            self._put(key, frame, write_disk=False)
+        return frame
+
+    def _put(self, key, frame, write_disk=True):
+        size = frame_nbytes(frame)
+        if size > self.max_bytes:
+            return  # Larger than the whole budget; not worth evicting everything for
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= old[1]
+            self._entries[key] = (time.time(), size, frame)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                _, (_, evicted, _) = self._entries.popitem(last=False)
+                self._bytes -= evicted
+                self.stats['evictions'] += 1
+        if write_disk:
+            self._write_disk(key, frame)
+
+    def _read_disk(self, key, now):
+        if not self.disk_dir:
+            return None
+        path = os.path.join(self.disk_dir, key + '.pkl')
+        try:
+            info = os.stat(path)
+            if now - info.st_mtime >= self.ttl_s or not owned_privately(info):
+                return None
+            with open(path, 'rb') as f:
+                return pickle.load(f)
+        except Exception:
+            return None  # Missing, truncated or written by other library versions
+
+    def _write_disk(self, key, frame):
+        if not self.disk_dir:
+            return
+        path = os.path.join(self.disk_dir, key + '.pkl')
+        try:
+            tmp_path = f"{path}.{threading.get_ident()}.tmp"
+            with open(tmp_path, 'wb') as f:
+                pickle.dump(frame, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, path)  # Readers never see a half-written file
+            # Trim the oldest files beyond the disk budget
+            files = [os.path.join(self.disk_dir, name) for name in os.listdir(self.disk_dir) if name.endswith('.pkl')]
+            files.sort(key=os.path.getmtime)
+            total = sum(os.path.getsize(f) for f in files)
+            while files and total > self.disk_max_bytes:
+                oldest = files.pop(0)
+                total -= os.path.getsize(oldest)
+                os.remove(oldest)
+        except OSError:
+            pass  # The disk tier is best-effort; the memory tier still holds the frame
+
+
+def owned_privately(info):
+    """Whether an os.stat result belongs to this process's user and no one else can write to it"""
+    if not hasattr(os, 'getuid'):
+        return True  # Windows: no POSIX ownership; rely on the per-user default location
+    return info.st_uid == os.getuid() and not info.st_mode & 0o022
+
+
+def private_dir(path):
+    """Create path as a 0700 directory if missing; True if it exists and only this user can write to it"""
+    try:
+        os.makedirs(path, mode=0o700, exist_ok=True)
+        return owned_privately(os.stat(path))
+    except OSError:
+        return False
+
+
+def _nested_nbytes(value):
+    """Size of the contents of a dict or list, recursively (the container itself is not counted)"""
+    items = [*value.keys(), *value.values()] if isinstance(value, dict) else value
+    total = 0
+    for item in items:
+        total += sys.getsizeof(item)
+        if isinstance(item, (dict, list)):
+            total += _nested_nbytes(item)
+    return total
+
+
+def frame_nbytes(frame):
+    """
+    Memory held by a frame. memory_usage(deep=True) sizes the dicts and lists
+    in object columns (event_details, patrol_segments) shallowly and geometries
+    as pointers, so their contents are added here.
+    """
+    size = int(frame.memory_usage(deep=True).sum())
+    for col in frame.columns:
+        values = frame[col]
+        if values.dtype.name == 'geometry':
+            import shapely
+            size += int(shapely.get_num_coordinates(values.values).sum()) * 16 + len(values) * GEOMETRY_NBYTES
+        elif values.dtype == object and len(values):
+            # Measured on evenly spaced rows and scaled up; walking every nested value is slow
+            sample = values.iloc[::max(1, len(values) // FRAME_NBYTES_SAMPLE)]
+            nested = sum(_nested_nbytes(v) for v in sample if isinstance(v, (dict, list)))
+            size += int(nested * len(values) / len(sample))
+    return size
+
+
+@st.cache_resource
+def get_response_cache():
+    """The process-wide response cache shared by all sessions"""
+    return ResponseCache(
+        max_bytes=RESPONSE_CACHE_MAX_MB * 1e6,
+        ttl_s=RESPONSE_CACHE_TTL_S,
+        disk_dir=RESPONSE_CACHE_DISK_DIR,
+        disk_max_bytes=RESPONSE_CACHE_DISK_MB * 1e6
+    )
+
+
+def permission_scope(er_io, username):
+    """
+    Cache scope of a login. EarthRanger grants access to subjects, event
+    categories and patrol types through permission sets, so logins in the
+    same sets see the same data and share entries; superusers share one scope.
+    When user/me lists no permission sets the scope is the user, and only
+    their own sessions share entries.
+    """
+    try:
+        me = er_io._get('user/me')
+        if me.get('is_superuser'):
+            return 'superuser'
+        sets = me.get('permissionsets', me.get('permission_sets'))
+        if sets:
+            ids = sorted(str(s.get('id', s.get('name')) if isinstance(s, dict) else s) for s in sets)
+            return 'perm:' + hashlib.sha256(json.dumps(ids).encode()).hexdigest()[:16]
+    except Exception:
+        pass
+    return 'user:' + hashlib.sha256(username.encode()).hexdigest()[:16]
+
+
+def closed_window_cutoff():
+    """
+    Latest time a cached date window may reach: midnight UTC at least one TTL
+    ago, so the closed part of a window keeps the same key all day
+    """
+    return (pd.Timestamp.now(tz='UTC') - pd.Timedelta(seconds=RESPONSE_CACHE_TTL_S)).floor('D')
+
+
+def covers_open_patrols(args, kwargs):
+    """Whether a read call takes a patrols frame holding patrols that are still open"""
+    for value in [*args, *kwargs.values()]:
+        if isinstance(value, pd.DataFrame) and 'state' in value.columns and value['state'].isin(['open', 'active']).any():
+            return True
+    return False
+
+
+def closed_segment_ids(patrols_df):
+    """Ids of the segments of finished patrols whose time range has ended; their events no longer change"""
+    ids = set()
+    if not isinstance(patrols_df, pd.DataFrame) or not {'state', 'patrol_segments'} <= set(patrols_df.columns):
+        return ids
+    for state, segments in zip(patrols_df['state'], patrols_df['patrol_segments']):
+        if state not in ('done', 'cancelled') or not isinstance(segments, list):
+            continue
+        for segment in segments:
+            if isinstance(segment, dict) and segment.get('id') and (segment.get('time_range') or {}).get('end_time'):
+                ids.add(str(segment['id']))
+    return ids
+
+
+def merge_window_parts(closed, live):
+    """Join the cached and freshly fetched parts of a split date window; rows in both keep the fresh copy"""
+    parts = [part for part in (closed, live) if isinstance(part, pd.DataFrame) and not part.empty]
+    if len(parts) < 2:
+        return parts[0] if parts else live
+    merged = pd.concat(parts, ignore_index=True)
+    if 'id' in merged.columns:
+        merged = merged.drop_duplicates('id', keep='last', ignore_index=True)
+    return merged
+
+
+def response_cache_key(server, scope, method, args, kwargs):
+    """Stable key for one read call, or None if an argument cannot be keyed (the call is then not cached)"""
+    def keyable(value):
+        if isinstance(value, pd.DataFrame):
+            # Observation calls take a patrols frame; the patrols it holds identify the query
+            if 'id' not in value.columns:
+                raise TypeError("frame without ids")
+            return ['frame', sorted(value['id'].astype(str))]
+        if isinstance(value, (list, tuple)):
+            return [keyable(v) for v in value]
+        if isinstance(value, dict):
+            return {str(k): keyable(v) for k, v in value.items()}
+        if isinstance(value, datetime):
+            return value.isoformat()
+        return value if value is None or isinstance(value, (str, int, float, bool)) else str(value)
+
+    try:
+        payload = json.dumps([server, scope, method, keyable(list(args)), keyable(kwargs)], sort_keys=True)
+    except TypeError:
+        return None
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+class CachedEarthRangerIO:
+    """
+    EarthRangerIO proxy that serves the read calls in CACHED_ER_METHODS from the
+    shared response cache. With refresh set, every call is fetched again.
+    Segment events are only cached for segments of finished patrols this proxy
+    has seen in a get_patrols result.
+    """
+
+    def __init__(self, er_io, server, scope):
+        self._er_io = er_io
+        self._server = server
+        self._scope = scope
+        self._cache = get_response_cache()  # Resolved here; calls may run on worker threads
+        self._closed_segments = set()
+        self.refresh = False  # Set from the session on each rerun, for the same reason
+
+    def __getattr__(self, name):
+        attr = getattr(self._er_io, name)
+        if name not in CACHED_ER_METHODS or RESPONSE_CACHE_MAX_MB <= 0:
+            return attr
+
+        def cached(*args, **kwargs):
+            key = response_cache_key(self._server, self._scope, name, args, kwargs)
+            if key is None:
+                return attr(*args, **kwargs)
+            return self._cache.get_or_fetch(key, lambda: attr(*args, **kwargs), refresh=self.refresh)
+
+        def cached_call(*args, **kwargs):
+            if covers_open_patrols(args, kwargs):
+                return attr(*args, **kwargs)
+            if name == 'get_patrol_segment_events':
+                segment_id = kwargs.get('patrol_segment_id', args[0] if args else None)
+                if str(segment_id) not in self._closed_segments:
+                    return attr(*args, **kwargs)
+            try:
+                since, until = kwargs.get('since'), kwargs.get('until')
+                cutoff = closed_window_cutoff()
+                split = until is not None and _utc(until) > cutoff
+                live_only = split and (since is None or _utc(since) >= cutoff)
+            except (TypeError, ValueError):
+                return attr(*args, **kwargs)
+            if live_only:
+                result = attr(*args, **kwargs)
+            elif split:
+                # Only the part of the window before the cutoff comes from the cache
+                result = merge_window_parts(
+                    cached(*args, **{**kwargs, 'until': cutoff.isoformat()}),
+                    attr(*args, **{**kwargs, 'since': cutoff.isoformat()})
+                )
+            else:
+                result = cached(*args, **kwargs)
+            if name == 'get_patrols':
+                self._closed_segments |= closed_segment_ids(result)
+            return result
+        return cached_call
+
+
+# Multi-server exports
+# Extra EarthRanger logins are kept next to the main one; exports can fan out
+# to all of them concurrently and tag every row with its source_server
+FAN_OUT_MAX_WORKERS = 4  # servers queried at the same time
+
+
+def server_label(server):
+    """Short display name for an EarthRanger instance URL"""
+    return urlparse(server if '://' in server else f'https://{server}').netloc or server
+
+
+def get_connections():
+    """All logged-in EarthRanger connections as {server label: er_io}, the main login first"""
+    connections = {st.session_state.er_server or 'primary': st.session_state.er_io}
+    connections.update(st.session_state.extra_connections)
+    return connections
+
+
+def fan_out(connections, func):
+    """
+    Call func(label, er_io) for every connection on a thread pool. Returns
+    ({label: result}, {label: error message}); one failing server does not
+    stop the others. func must not call Streamlit.
+    """
+    results, errors = {}, {}
+    with ThreadPoolExecutor(max_workers=min(FAN_OUT_MAX_WORKERS, len(connections))) as pool:
+        futures = {label: pool.submit(func, label, er_io) for label, er_io in connections.items()}
+        for label, future in futures.items():
+            try:
+                results[label] = future.result()
+            except Exception as e:
+                errors[label] = str(e)
+    return results, errors
+
+
+def concat_sources(frames):
+    """Concatenate per-server frames into one, tagging every row with its source_server"""
+    tagged = [
+        frame.assign(source_server=label)
+        for label, frame in frames.items()
+        if frame is not None and not frame.empty
+    ]
+    if not tagged:
+        return None
+    return pd.concat(tagged, ignore_index=True)
+
+
+PIPELINE_DEPTH = 16  # items a pipelined producer may run ahead of its consumer
+SEGMENT_FETCH_WORKERS = 4  # patrol segments downloaded at once; the request scheduler still sets the pace
+
+
+def pipelined(produce, depth=PIPELINE_DEPTH):
+    """
+    Run the generator function produce() on a background thread and yield its
+    items on the calling thread as they arrive, so work on one item overlaps the
+    network waits for the next. At most depth items are buffered; an exception
+    in produce is re-raised here, and the producer stops if the consumer does.
+    """
+    items = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+    finished = object()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def run():
+        try:
+            for item in produce():
+                if not put((None, item)):
+                    return
+        except BaseException as e:
+            put((e, finished))
+        else:
+            put((None, finished))
+
+    threading.Thread(target=run, daemon=True, name="pipeline").start()
+    try:
+        while True:
+            error, item = items.get()
+            if error is not None:
+                raise error
+            if item is finished:
+                return
+            yield item
+    finally:
+        stop.set()
+
+def build_subject_lookup(er_io):
+    """Fetch all subjects and return a {uuid: display_name} dict for UUID resolution."""
+    try:
+        subjects_df = er_io.get_subjects(include_inactive=True)
+        if subjects_df is not None and not subjects_df.empty and 'id' in subjects_df.columns and 'name' in subjects_df.columns:
+            return dict(zip(subjects_df['id'].astype(str), subjects_df['name'].astype(str)))
+    except Exception:
+        pass
+    return {}
+
+
+# Filter-option index
+# Patrol types, leaders and date spans of every patrol seen, persisted per
+# server and user so the filter widgets render from it instead of downloading
+# all patrols on every rerun. Date ranges it has not covered yet, or covered
+# longer ago than the span TTL, are fetched on demand; recent patrols are
+# re-fetched in the background when it gets stale. Selecting every option means
+# no filter, so a stale index can narrow the choices but never an export.
+FILTER_INDEX_DIR = os.environ.get(
+    'GCF_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'gcf_patrol_downloader')
+)
+FILTER_INDEX_MAX_AGE_S = 15 * 60              # background refresh after this long
+FILTER_INDEX_OVERLAP = timedelta(days=3)      # recent patrols may still change (active -> done)
+FILTER_INDEX_SPAN_TTL = timedelta(days=1)     # covered date ranges are re-fetched after this long
+FILTER_INDEX_COLUMNS = ['id', 'start', 'end', 'patrol_type', 'leader']
+
+
+def _utc(value):
+    """Timestamp in UTC from an ISO string or datetime (naive values are taken as UTC)"""
+    ts = pd.Timestamp(value)
+    return ts.tz_localize('UTC') if ts.tz is None else ts.tz_convert('UTC')
+
+
+def patrol_index_rows(patrols_df):
+    """
+    Reduce a get_patrols frame to one index row per patrol: id, start/end of its
+    segments, and patrol type and leader read the way download_patrol_tracks reads them
+    """
+    rows = []
+    for patrol_id, segments in zip(patrols_df['id'], patrols_df['patrol_segments']):
+        segments = [seg for seg in segments if isinstance(seg, dict)] if isinstance(segments, list) else []
+        first = segments[0] if segments else {}
+        leader = first.get('leader')
+        if isinstance(leader, dict):
+            leader = leader.get('name', leader.get('username', ''))
+        elif leader is None:
+            leader = first.get('patrol_subject', '')
+        time_ranges = [seg.get('time_range') or {} for seg in segments]
+        rows.append([
+            patrol_id,
+            time_ranges[0].get('start_time') if time_ranges else None,
+            time_ranges[-1].get('end_time') if time_ranges else None,
+            first.get('patrol_type'),
+            str(leader) if leader else '',
+        ])
+    rows = pd.DataFrame(rows, columns=FILTER_INDEX_COLUMNS)
+    for col in ['start', 'end']:
+        rows[col] = pd.to_datetime(rows[col], format='ISO8601', utc=True)
+    return rows
+
+
+class PatrolFilterIndex:
+    """
+    Persisted patrol index for one server/user. ensure() fetches only the parts
+    of a date range not covered within FILTER_INDEX_SPAN_TTL; refresh_in_background()
+    re-fetches the recent window on a daemon thread. All state changes happen under a lock.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.patrols = pd.DataFrame(columns=FILTER_INDEX_COLUMNS)
+        self.spans = []          # sorted, non-overlapping [start, end, fetched at] UTC timestamps
+        self.refreshed_at = None
+        self._refreshing = False
+        self._load()
+
+    def _load(self):
+        try:
+            if not owned_privately(os.stat(self.path)):
+                return  # Not written by this user: another account could have planted it
+            with open(self.path) as f:
+                data = json.load(f)
+            patrols = pd.DataFrame(data['patrols'], columns=FILTER_INDEX_COLUMNS)
+            for col in ['start', 'end']:
+                patrols[col] = pd.to_datetime(patrols[col], format='ISO8601', utc=True)
+            self.patrols = patrols
+            # Spans saved without a fetch time are treated as expired
+            self.spans = [
+                [_utc(span[0]), _utc(span[1]), _utc(span[2] if len(span) > 2 else 0)]
+                for span in data['spans']
+            ]
+            self.refreshed_at = _utc(data['refreshed_at']) if data.get('refreshed_at') else None
+        except (OSError, ValueError, KeyError, TypeError):
+            pass  # No index yet, or an unreadable one - start empty
+
+    def _save(self):
+        patrols = self.patrols.copy()
+        for col in ['start', 'end']:
+            patrols[col] = patrols[col].map(lambda ts: ts.isoformat() if pd.notna(ts) else None)
+        data = {
+            'spans': [[ts.isoformat() for ts in span] for span in self.spans],
+            'refreshed_at': self.refreshed_at.isoformat() if self.refreshed_at is not None else None,
+            'patrols': patrols.to_dict(orient='records'),
+        }
+        if not private_dir(os.path.dirname(self.path)):
+            return  # The index lists other users' patrols; keep it in memory only
+        tmp_path = f"{self.path}.tmp"
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)  # A leftover would keep its old permissions
+        # 0600: readable by this user only, whatever the umask
+        with os.fdopen(os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp_path, self.path)  # Never leave a half-written index behind
+
+    def _missing_spans(self, start, end):
+        expires = pd.Timestamp.now(tz='UTC') - FILTER_INDEX_SPAN_TTL
+        missing = []
+        for span_start, span_end, fetched_at in self.spans:
+            if fetched_at < expires:
+                continue  # Too old to trust; fetched again as if never covered
+            if span_start > start:
+                missing.append([start, min(span_start, end)])
+            start = max(start, span_end)
+            if start >= end:
+                break
+        if start < end:
+            missing.append([start, end])
+        return [span for span in missing if span[0] < span[1]]
+
+    def _fetch(self, er_io, start, end):
+        """Fetch patrols for [start, end] and merge them in; newer rows replace older ones"""
+        fetched_at = pd.Timestamp.now(tz='UTC')
+        patrols_df = er_io.get_patrols(
+            since=start.isoformat(),
+            until=end.isoformat(),
+            status=['done', 'active']
+        )
+        rows = patrol_index_rows(patrols_df) if not patrols_df.empty else None
+        with self.lock:
+            if rows is not None:
+                merged = pd.concat([self.patrols, rows], ignore_index=True) if len(self.patrols) else rows
+                self.patrols = merged.drop_duplicates('id', keep='last').reset_index(drop=True)
+            # The new span replaces whatever it overlaps; the remainders keep their
+            # fetch times, and expired ones are dropped as they count as missing anyway
+            expires = fetched_at - FILTER_INDEX_SPAN_TTL
+            spans = [[start, end, fetched_at]]
+            for span_start, span_end, span_fetched in self.spans:
+                if span_fetched < expires:
+                    continue
+                if span_start < start:
+                    spans.append([span_start, min(span_end, start), span_fetched])
+                if span_end > end:
+                    spans.append([max(span_start, end), span_end, span_fetched])
+            spans.sort()
+            self.spans = [spans[0]]
+            for span in spans[1:]:
+                last = self.spans[-1]
+                if span[0] <= last[1] and span[2] == last[2]:
+                    last[1] = max(last[1], span[1])
+                else:
+                    self.spans.append(span)
+
+    def ensure(self, er_io, since, until):
+        """Fetch whatever part of [since, until] the index has not covered yet (blocking)"""
+        start, end = _utc(since), min(_utc(until), pd.Timestamp.now(tz='UTC'))
+        with self.lock:
+            missing = self._missing_spans(start, end)
+            first_fetch = self.refreshed_at is None
+        for span_start, span_end in missing:
+            self._fetch(er_io, span_start, span_end)
+        if missing:
+            with self.lock:
+                if first_fetch:
+                    self.refreshed_at = pd.Timestamp.now(tz='UTC')
+                self._save()
+
+    def is_stale(self):
+        return self.refreshed_at is None or (
+            pd.Timestamp.now(tz='UTC') - self.refreshed_at
+        ).total_seconds() > FILTER_INDEX_MAX_AGE_S
+
+    def refresh_in_background(self, er_io):
+        """Re-fetch patrols started since the last refresh (with overlap) on a daemon thread"""
+        with self.lock:
+            if self._refreshing or not self.spans or not self.is_stale():
+                return
+            self._refreshing = True
+            start = (self.refreshed_at or self.spans[-1][1]) - FILTER_INDEX_OVERLAP
+
+        def refresh():
+            try:
+                now = pd.Timestamp.now(tz='UTC')
+                self._fetch(er_io, start, now)
+                with self.lock:
+                    self.refreshed_at = now
+                    self._save()
+            except Exception:
+                pass  # The next stale rerun tries again
+            finally:
+                self._refreshing = False
+
+        threading.Thread(target=refresh, daemon=True, name="filter-index-refresh").start()
+
+    def patrols_in_range(self, since, until):
+        """Index rows of patrols overlapping [since, until]"""
+        start, end = _utc(since), _utc(until)
+        with self.lock:
+            patrols = self.patrols
+        overlaps = (patrols['start'] <= end) & (patrols['end'].isna() | (patrols['end'] >= start))
+        return patrols[overlaps.to_numpy(dtype=bool)]
+
+
+@st.cache_resource
+def get_filter_index(server, username):
+    """One index per server/user, shared by all sessions in this process"""
+    key = hashlib.sha256(f"{server}|{username}".encode()).hexdigest()[:16]
+    return PatrolFilterIndex(os.path.join(FILTER_INDEX_DIR, f"filter_index_{key}.json"))
+
+
+def build_subject_lookups(connections):
+    """Merged {uuid: display_name} lookup across several connections, fetched concurrently"""
+    results, _ = fan_out(connections, lambda label, er_io: build_subject_lookup(er_io))
+    lookup = {}
+    for server_lookup in results.values():
+        lookup.update(server_lookup)
+    return lookup
+
+
+# Output schema shared by both event exports. Unused API columns are dropped
+# right after fetch, so geometry building, the orphan merge, flattening and
+# UUID resolution never carry them. Source columns are read by those
+# transforms and left out of every output. The CSV export and the preview
+# are both projected from these lists.
+EVENT_UNUSED_COLUMNS = ['level_8', 'index', 'location', 'attributes', 'notes', 'patrols', 'patrol_segments',
+                        'is_contained_in', 'related_subjects', 'message', 'provenance', 'event_category',
+                        'priority_label', 'comment', 'end_time', 'sort_at', 'icon_id', 'url', 'image_url',
+                        'external_source']
+EVENT_SOURCE_COLUMNS = ['geojson', 'reported_by', 'event_details']
+EVENT_OUTPUT_EXCLUDED = ['geometry'] + EVENT_SOURCE_COLUMNS + EVENT_UNUSED_COLUMNS
+EVENT_RENAME = {'id': 'event_id', 'time': 'event_datetime'}
+# Preview order (after renaming); detail_ columns follow, then everything else
+EVENT_LEADING_COLUMNS = ['event_id', 'patrol_id', 'patrol_name', 'patrol_leader',
+                         'nearest_patrol_id', 'track_offset_m', 'km_along_patrol',
+                         'serial_number', 'event_type', 'subject_name', 'subject_id',
+                         'longitude', 'latitude', 'event_datetime',
+                         'priority', 'title', 'state',
+                         'updated_at', 'created_at', 'is_collection']
+
+
+def project_event_columns(events_df):
+    """Drop the API columns no event output uses; call right after each fetch"""
+    return events_df.drop(columns=[col for col in EVENT_UNUSED_COLUMNS if col in events_df.columns])
+
+
+def event_preview_frame(events_df, sort_rest=False):
+    """
+    The events preview: output columns only, renamed, with the leading
+    columns first, then sorted detail_ columns, then the rest (sorted too
+    with sort_rest=True, e.g. for exploded item columns)
+    """
+    keep = [col for col in events_df.columns if col not in EVENT_OUTPUT_EXCLUDED]
+    preview = pd.DataFrame(events_df[keep]).rename(columns=EVENT_RENAME)
+    leading = [col for col in EVENT_LEADING_COLUMNS if col in preview.columns]
+    detail_cols = sorted(col for col in preview.columns if col.startswith('detail_'))
+    rest = [col for col in preview.columns if col not in leading and not col.startswith('detail_')]
+    return preview[leading + detail_cols + (sorted(rest) if sort_rest else rest)]
+
+
+def nested_values(values, *keys, default=None):
+    """Pick one field (following keys) out of a column of nested dicts, as a list; default where absent"""
+    out = []
+    for value in values:
+        for key in keys:
+            value = value.get(key) if isinstance(value, dict) else None
+        out.append(default if value is None else value)
+    return out
+
+
+def geojson_geometries(values):
+    """
+    Geometries for a column of GeoJSON dicts (Features or bare geometries).
+    2D points, nearly every event, are gathered into one coordinate array and
+    built in a single shapely call; anything else goes through shape(). Missing
+    or invalid GeoJSON gives None.
+    """
+    import shapely
+    from shapely.geometry import shape
+
+    values = list(values)
+    coords = np.full((len(values), 2), np.nan)
+    geometries = np.full(len(values), None, dtype=object)
+    for i, value in enumerate(values):
+        if not isinstance(value, dict) or not value:
+            continue
+        geometry = value.get('geometry') if value.get('type') == 'Feature' else value
+        point = geometry.get('coordinates') if isinstance(geometry, dict) and geometry.get('type') == 'Point' else None
+        if isinstance(point, (list, tuple)) and len(point) == 2:
+            coords[i] = point
+        else:
+            try:
+                geometries[i] = shape(value)
+            except Exception:
+                pass
+    is_point = ~np.isnan(coords).any(axis=1)
+    geometries[is_point] = shapely.points(coords[is_point])
+    return geometries
+
+
+def decode_event_fields(events_gdf):
+    """
+    Pull the time (when the API left it out), reporter name and reporter id
+    out of the nested geojson / reported_by dicts, one pass per field, then drop
+    those source columns
+    """
+    if 'time' not in events_gdf.columns and 'geojson' in events_gdf.columns:
+        events_gdf['time'] = pd.to_datetime(
+            nested_values(events_gdf['geojson'], 'properties', 'datetime'), utc=True, format='ISO8601', errors='coerce'
+        )
+    if 'reported_by' in events_gdf.columns:
+        events_gdf['subject_name'] = nested_values(events_gdf['reported_by'], 'name', default='')
+        if 'subject_id' not in events_gdf.columns:
+            events_gdf['subject_id'] = nested_values(events_gdf['reported_by'], 'id', default='')
+    return events_gdf.drop(columns=[col for col in ['geojson', 'reported_by'] if col in events_gdf.columns])
+
+
+def prepare_patrol_events(events_gdf, tracks_gdf, aoi=None, snap_index=None):
+    """
+    The per-segment part of the patrol events export: drop events outside the
+    area of interest, add longitude/latitude, decode the nested fields, snap to
+    the nearest track and flatten event_details. UUID resolution runs on the
+    combined frame, where the subject lookup has arrived.
+    """
+    import shapely
+
+    events_gdf = filter_events_to_aoi(events_gdf, aoi).reset_index(drop=True)
+    if events_gdf.empty:
+        return events_gdf
+    geometries = events_gdf.geometry.values
+    events_gdf['longitude'] = shapely.get_x(geometries)
+    events_gdf['latitude'] = shapely.get_y(geometries)
+    # Time and reporter from the nested dicts; flattening never needs their sources
+    events_gdf = decode_event_fields(events_gdf)
+    events_gdf = snap_events_to_tracks(events_gdf, tracks_gdf, snap_index)
+    return flatten_event_details(events_gdf)
+
+
+def get_events_by_id(connections, event_ids, server_of_event=None):
+    """
+    Fetch events with details by id from the first connection, or, given a
+    {event id: server label} map, from each event's own server with a source_server column
+    """
+    if not server_of_event:
+        er_io = next(iter(connections.values()))
+        return er_io.get_events(event_ids=event_ids, include_details=True, include_notes=True)
+    by_server = {}
+    for event_id in event_ids:
+        by_server.setdefault(server_of_event[event_id], []).append(event_id)
+    events = concat_sources({
+        label: connections[label].get_events(event_ids=ids, include_details=True, include_notes=True)
+        for label, ids in by_server.items()
+    })
+    return events if events is not None else pd.DataFrame()
+
+
+def fetch_patrol_events(er_io, tracks_gdf, since, until, patrol_type, on_progress=None, transform=None, sink=None):
+    """
+    Fetch the events of every segment of the patrols in tracks_gdf, with full
+    event details, tagged with patrol_id, patrol_name and patrol_leader.
+    Returns (events GeoDataFrame or None, warnings). on_progress(fraction, message)
+    reports progress; leave it out when running on a worker thread.
+    transform(events_gdf) is applied to each segment's events as they arrive,
+    while later segments are still downloading. Given sink(events_gdf), each
+    segment's non-empty events are handed to it in segment order instead of
+    being combined, and the events returned are None.
+    """
+    import geopandas as gpd
+
+    def report(fraction, message):
+        if on_progress is not None:
+            on_progress(fraction, message)
+
+    # Get the original patrols dataframe with patrol_segments
+    # Use patrol_type_value instead of patrol_type since we have the value, not UUID
+    patrols_df = er_io.get_patrols(
+        since=since,
+        until=until,
+        patrol_type_value=patrol_type,
+        status=['done', 'active']
+    )
+    
+    # Filter to only the patrol IDs we have in our downloaded tracks
+    patrol_ids = tracks_gdf['patrol_id'].unique().tolist()
+    patrols_df = patrols_df[patrols_df['id'].isin(patrol_ids)].copy()
+    if patrols_df.empty:
+        return None, ["No matching patrols found"]
+
+    # Extract all patrol segment IDs from the matched patrols
+    # Also create mappings for patrol_id, patrol_name, and subject/leader name
+    patrol_segment_ids = []
+    segment_to_patrol_map = {}  # Maps segment_id -> patrol_id
+    segment_to_patrol_name_map = {}  # Maps segment_id -> patrol_name/title
+    segment_to_subject_map = {}  # Maps segment_id -> subject/leader name
+    
+    for _, patrol in patrols_df.iterrows():
+        patrol_id = patrol['id']
+        patrol_name = patrol.get('title', patrol.get('serial_number', ''))
+        
+        # Extract leader/subject name from first segment
+        leader_name = ''
+        for segment in patrol.get('patrol_segments', []):
+            if 'id' in segment:
+                segment_id = segment['id']
+                patrol_segment_ids.append(segment_id)
+                segment_to_patrol_map[segment_id] = patrol_id
+                segment_to_patrol_name_map[segment_id] = patrol_name
+                
+                # Extract leader name if not already extracted
+                if not leader_name and 'leader' in segment:
+                    leader_data = segment['leader']
+                    if isinstance(leader_data, dict):
+                        leader_name = leader_data.get('name', leader_data.get('username', ''))
+                    else:
+                        leader_name = str(leader_data) if leader_data else ''
+                
+                segment_to_subject_map[segment_id] = leader_name
+    
+    if not patrol_segment_ids:
+        return None, ["No patrol segments found"]
+
+    # Segments are downloaded a few at a time on a background thread while the
+    # calling thread transforms the ones already in, so network waits and CPU
+    # work overlap. Results arrive in segment order, keeping the output stable.
+    warnings = []
+
+    def fetch_segment(idx, segment_id):
+        """One segment's events with details: (fraction done, progress message, events GeoDataFrame or None)"""
+        progress = f"Segment {idx + 1}/{len(patrol_segment_ids)}"
+        done = (idx + 1) / len(patrol_segment_ids)
+        try:
+            # Use get_patrol_segment_events which correctly filters to patrol segment
+            events_df = er_io.get_patrol_segment_events(
+                patrol_segment_id=segment_id,
+                include_details=True,
+                include_notes=True,
+                include_related_events=False,
+                include_files=False
+            )
+        
+            if not events_df.empty:
+                events_df = project_event_columns(events_df)
+                # Add patrol_id, patrol_name, and patrol_leader from our mappings
+                events_df['patrol_id'] = segment_to_patrol_map.get(segment_id, '')
+                events_df['patrol_name'] = segment_to_patrol_name_map.get(segment_id, '')
+                events_df['patrol_leader'] = segment_to_subject_map.get(segment_id, '')
+            
+                # Convert to GeoDataFrame with geometry from geojson
+                events_df['geometry'] = geojson_geometries(events_df.get('geojson', [None] * len(events_df)))
+                # Filter out events without geometry
+                events_gdf = events_df[events_df['geometry'].notna()].copy()
+            
+                if events_gdf.empty:
+                    return done, f"{progress}: No events with valid geometry", None
+            
+                events_gdf = gpd.GeoDataFrame(events_gdf, geometry='geometry', crs=4326)
+            
+                # Now fetch full details for each event by event ID (only if 'id' column exists)
+                has_details = False
+                if 'id' in events_gdf.columns and len(events_gdf) > 0:
+                    event_ids = events_gdf['id'].tolist()
+                    # Filter out any None or NaN values
+                    event_ids = [eid for eid in event_ids if eid and pd.notna(eid)]
+                
+                    if event_ids:
+                        # Batch event IDs to avoid URL length limits (414 error)
+                        # Process in chunks of 50 event IDs at a time
+                        batch_size = 50
+                        detailed_events_list = []
+                    
+                        for batch_idx in range(0, len(event_ids), batch_size):
+                            batch_event_ids = event_ids[batch_idx:batch_idx + batch_size]
+                            try:
+                                # Fetch events with details using event IDs
+                                detailed_events_batch = er_io.get_events(
+                                    event_ids=batch_event_ids,
+                                    include_details=True,
+                                    include_notes=True
+                                )
+                                if not detailed_events_batch.empty:
+                                    detailed_events_list.append(detailed_events_batch)
+                            except Exception as batch_err:
+                                warnings.append(f"Could not fetch details for event batch {batch_idx//batch_size + 1}: {str(batch_err)[:100]}")
+                    
+                        # Combine all batches
+                        if detailed_events_list:
+                            detailed_events = pd.concat(detailed_events_list, ignore_index=True)
+                        
+                            if not detailed_events.empty and 'event_details' in detailed_events.columns and 'id' in detailed_events.columns:
+                                # Merge event_details back into events_gdf
+                                # Reset index to use 'id' for merging
+                                try:
+                                    detailed_events_subset = detailed_events[['id', 'event_details']].copy()
+                                    events_gdf = events_gdf.merge(detailed_events_subset, on='id', how='left')
+                                    has_details = True
+                                except Exception as merge_err:
+                                    warnings.append(f"Could not merge event details: {str(merge_err)[:100]}")
+                                    has_details = False
+            
+                return done, f"{progress}: Found {len(events_gdf)} events (details: {has_details})", events_gdf
+            else:
+                return done, f"{progress}: No events", None
+        except Exception as e:
+            warnings.append(f"Could not get events for segment {segment_id}: {e}")
+            return done, f"{progress}: Error - {str(e)[:50]}", None
+
+    def fetch_segments():
+        """Fetch segments a few at a time, yielding their results in segment order"""
+        pool = ThreadPoolExecutor(max_workers=SEGMENT_FETCH_WORKERS)
+        pending = deque()
+        try:
+            for idx, segment_id in enumerate(patrol_segment_ids):
+                pending.append(pool.submit(fetch_segment, idx, segment_id))
+                if len(pending) > SEGMENT_FETCH_WORKERS:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            pool.shutdown(wait=True, cancel_futures=True)
+
+    all_events = []
+    for fraction, message, events_gdf in pipelined(fetch_segments):
+        report(fraction, message)
+        if events_gdf is not None and transform is not None:
+            events_gdf = transform(events_gdf)
+        if events_gdf is not None and not events_gdf.empty:
+            if sink is not None:
+                sink(events_gdf)
+            else:
+                all_events.append(events_gdf)
+
+    # Combine all events
+    if not all_events:
+        return None, warnings
+    return gpd.GeoDataFrame(pd.concat(all_events, ignore_index=True)), warnings
+
+
+CSV_CHUNK_ROWS = 5000  # rows encoded per block by write_events_csv
+PARALLEL_FLATTEN_MIN_ROWS = 20_000  # smaller exports flatten faster than worker processes start
+
+# file extension and mime type for each CSV compression option
+CSV_FORMATS = {
+    None: ('.csv', 'text/csv'),
+    'gzip': ('.csv.gz', 'application/gzip'),
+    'zstd': ('.csv.zst', 'application/zstd'),
+}
+
+
+def write_events_csv(events_gdf, base_path, drop_columns, rename_mapping, compression=None, chunk_rows=CSV_CHUNK_ROWS):
+    """
+    Encode an events frame to CSV in blocks of rows written straight to disk,
+    optionally gzip or zstd compressed. Columns are selected per block, so
+    neither a full export copy of the frame nor the full CSV text is held in
+    memory while encoding. Returns (file path, mime type).
+    This bounds the encoding only: st.download_button reads the finished file
+    whole into Streamlit's in-memory media storage, which has no streaming
+    download, so the file's size (after compression) is still held once.
+    """
+    extension, mime = CSV_FORMATS[compression]
+    path = base_path + extension
+    positions = [i for i, col in enumerate(events_gdf.columns) if col not in drop_columns]
+    header = [rename_mapping.get(events_gdf.columns[i], events_gdf.columns[i]) for i in positions]
+
+    with open(path, 'wb') as raw, csv_text_stream(raw, compression) as text:
+        if len(events_gdf) == 0:
+            pd.DataFrame(columns=header).to_csv(text, index=False)
+        for start in range(0, len(events_gdf), chunk_rows):
+            block = pd.DataFrame(events_gdf.iloc[start:start + chunk_rows, positions])
+            block.to_csv(text, index=False, header=header if start == 0 else False)
+    return path, mime
+
+
+@contextmanager
+def csv_text_stream(raw, compression=None):
+    """UTF-8 text stream over the binary file raw, gzip or zstd compressed on the way; closing it leaves raw open"""
+    if compression == 'gzip':
+        stream = gzip.GzipFile(fileobj=raw, mode='wb')
+    elif compression == 'zstd':
+        import zstandard
+        stream = zstandard.ZstdCompressor().stream_writer(raw, closefd=False)
+    else:
+        stream = raw
+    text = io.TextIOWrapper(stream, encoding='utf-8', newline='')
+    yield text
+    text.flush()
+    text.detach()
+    if stream is not raw:
+        stream.close()  # Writes the compression trailer; leaves the file open
+
+
+class EventsCSVWriter:
+    """
+    resolve_uuid_columns and write_events_csv for events that arrive in blocks,
+    one per patrol segment: each block has its UUID columns resolved and is
+    encoded to a temporary body file as it arrives, so nothing waits for the
+    combined frame. Blocks may bring new columns, and whether a '<col>_name'
+    column is kept depends on the UUID counts of every block, so the header is
+    settled by finish(): blocks already in the final layout are copied through
+    as they are, the others are re-laid out field by field. Used as a context
+    manager, which removes the body and the finished file.
+    """
+
+    def __init__(self, base_filename, drop_columns, rename_mapping, compression=None):
+        extension, self.mime = CSV_FORMATS[compression]
+        self._dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self._dir.name, base_filename + extension)
+        self.drop_columns = set(drop_columns)
+        self.rename_mapping = rename_mapping
+        self.compression = compression
+        self.rows = 0
+        self._body = tempfile.TemporaryFile(dir=self._dir.name)
+        self._blocks = []        # (body offset, end offset, column keys) per block
+        self._columns = []       # source columns in order of first appearance
+        self._uuid_counts = {}   # column -> [values that look like UUIDs, non-null values]
+        self._resolved = set()   # columns given a name column in some block
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self._body.close()
+        self._dir.cleanup()
+
+    def write(self, events_df, uuid_to_name):
+        """
+        Resolve and encode one block. Returns it with a '<col>_name' column
+        for each column with UUIDs that resolve; rejected_name_columns() lists
+        the ones the finished file leaves out.
+        """
+        names = {}
+        if uuid_to_name:
+            for col, (n_uuid, n_values) in uuid_column_counts(events_df, col_prefix='').items():
+                totals = self._uuid_counts.setdefault(col, [0, 0])
+                totals[0] += n_uuid
+                totals[1] += n_values
+                if n_uuid and col + '_name' not in events_df.columns:
+                    name_series = uuid_names(events_df[col], uuid_to_name)
+                    if name_series.str.len().sum() > 0:  # at least one resolved
+                        names[col] = name_series
+        self._resolved.update(names)
+        block = insert_name_columns(events_df, names)
+
+        known = set(self._columns)
+        self._columns.extend(col for col in events_df.columns if col not in known)
+        # Name columns are keyed by their source column, apart from any column
+        # the data itself calls '<col>_name'
+        inserted = {col + '_name': col for col in names}
+        columns = [col for col in block.columns if col in inserted or col not in self.drop_columns]
+        keys = [('name', inserted[col]) if col in inserted else col for col in columns]
+        start = self._body.tell()
+        with csv_text_stream(self._body) as text:
+            block[columns].to_csv(text, index=False, header=False)
+        self._blocks.append((start, self._body.tell(), keys))
+        self.rows += len(block)
+        return block
+
+    def _kept_names(self):
+        return {col for col in self._resolved
+                if self._uuid_counts[col][0] / self._uuid_counts[col][1] >= 0.5 and col + '_name' not in self._columns}
+
+    def rejected_name_columns(self):
+        """Name columns returned by write() that the finished file leaves out"""
+        return sorted(col + '_name' for col in self._resolved - self._kept_names())
+
+    def finish(self):
+        """Write the header and every block to the output file; returns (file path, mime type)"""
+        kept = self._kept_names()
+        layout = []
+        for col in self._columns:
+            if col not in self.drop_columns:
+                layout.append(col)
+            if col in kept:
+                layout.append(('name', col))
+        header = [self.rename_mapping.get(key, key) if isinstance(key, str) else key[1] + '_name' for key in layout]
+
+        with open(self.path, 'wb') as raw, csv_text_stream(raw, self.compression) as text:
+            csv.writer(text, lineterminator=os.linesep).writerow(header)
+            for start, end, keys in self._blocks:
+                self._body.seek(start)
+                body = self._body.read(end - start)
+                if keys == layout:
+                    text.flush()
+                    text.buffer.write(body)
+                    continue
+                # Fields in final column order, empty where this block has no such column
+                positions = {key: i for i, key in enumerate(keys)}
+                order = [positions.get(key) for key in layout]
+                writer = csv.writer(text, lineterminator=os.linesep)
+                for row in csv.reader(io.StringIO(body.decode('utf-8'), newline='')):
+                    writer.writerow(['' if i is None else row[i] for i in order])
+        return self.path, self.mime
+
+
+def build_shapefile_zip(gdf_export, base_filename):
+    """Write a GeoDataFrame as a shapefile and return the bytes of a ZIP holding all its components"""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        shapefile_path = os.path.join(tmpdir, f"{base_filename}.shp")
+        gdf_export.to_file(shapefile_path)
+        
+        # Create a zip file with all shapefile components
+        zip_path = os.path.join(tmpdir, f"{base_filename}.zip")
+        
+        with zipfile.ZipFile(zip_path, 'w') as zipf:
+            for ext in ['.shp', '.shx', '.dbf', '.prj', '.cpg']:
+                file_path = shapefile_path.replace('.shp', ext)
+                if os.path.exists(file_path):
+                    # Add files to zip with the base filename
+                    zipf.write(file_path, f"{base_filename}{ext}")
+        
+        # Read the zip file for download
+        with open(zip_path, 'rb') as f:
+            return f.read()
+
+
+PREVIEW_PAGE_SIZES = [25, 50, 100, 250]
+PREVIEW_DEFAULT_COLUMNS = 30  # columns shown until the user picks others
+
+
+def column_stats(df):
+    """
+    One row per column: dtype, non-null count, distinct values and min/max for
+    numeric and datetime columns. Computed once per preview, not per page.
+    """
+    rows = []
+    for col in df.columns:
+        series = df[col]
+        try:
+            distinct = series.nunique(dropna=True)
+        except TypeError:
+            distinct = series.astype(str).nunique(dropna=True)  # Unhashable values such as lists
+        row = {'column': col, 'dtype': str(series.dtype), 'non_null': int(series.notna().sum()),
+               'distinct': int(distinct), 'min': None, 'max': None}
+        if pd.api.types.is_numeric_dtype(series) or pd.api.types.is_datetime64_any_dtype(series):
+            if not pd.api.types.is_bool_dtype(series) and row['non_null']:
+                row['min'], row['max'] = str(series.min()), str(series.max())
+        rows.append(row)
+    return pd.DataFrame(rows, columns=['column', 'dtype', 'non_null', 'distinct', 'min', 'max'])
+
+
+def preview_positions(df, sort_col=None, ascending=True, filter_col=None, query=''):
+    """
+    Row positions of df matching a case-insensitive substring filter on one
+    column, in sort order. Only positions are returned; pages are sliced from
+    the original frame.
+    """
+    positions = np.arange(len(df))
+    if filter_col and query:
+        text = df[filter_col].astype(str)
+        positions = positions[text.str.contains(query, case=False, regex=False, na=False).to_numpy()]
+    if sort_col:
+        values = df[sort_col].iloc[positions].reset_index(drop=True)
+        try:
+            order = values.sort_values(ascending=ascending, kind='stable', na_position='last').index
+        except TypeError:
+            # Mixed types (e.g. numbers and strings in a flattened detail column) sort as text
+            order = values.astype(str).sort_values(ascending=ascending, kind='stable').index
+        positions = positions[order.to_numpy()]
+    return positions
+
+
+@st.fragment
+def _data_preview_fragment(df, key, stats, token):
+    """Paging, sort and filter controls; reruns on its own without re-running the export"""
+    all_cols = list(df.columns)
+    widget = f"{key}_{token}"
+
+    columns = st.multiselect(
+        f"Columns ({len(all_cols)} available)",
+        options=all_cols,
+        default=all_cols[:PREVIEW_DEFAULT_COLUMNS],
+        key=f"{widget}_columns"
+    ) or all_cols[:PREVIEW_DEFAULT_COLUMNS]
+
+    col_sort, col_dir, col_filter, col_query = st.columns([2, 1, 2, 2])
+    with col_sort:
+        sort_col = st.selectbox("Sort by", options=[None] + all_cols, key=f"{widget}_sort",
+                                format_func=lambda c: "(export order)" if c is None else c)
+    with col_dir:
+        ascending = st.radio("Order", ["Ascending", "Descending"], key=f"{widget}_order",
+                             horizontal=True) == "Ascending"
+    with col_filter:
+        filter_col = st.selectbox("Filter column", options=all_cols, key=f"{widget}_filter_col")
+    with col_query:
+        query = st.text_input("Contains", key=f"{widget}_query").strip()
+
+    # Matching rows are only recomputed when the sort or filter changes, not per page
+    view_key = f"{key}_preview_view"
+    signature = (token, sort_col, ascending, filter_col if query else None, query)
+    view = st.session_state.get(view_key)
+    if view is None or view[0] != signature:
+        view = (signature, preview_positions(df, sort_col, ascending, filter_col, query))
+        st.session_state[view_key] = view
+    positions = view[1]
+
+    col_size, col_page = st.columns(2)
+    with col_size:
+        page_size = st.selectbox("Rows per page", PREVIEW_PAGE_SIZES, index=1, key=f"{key}_page_size")
+    n_pages = max(1, -(-len(positions) // page_size))
+    with col_page:
+        page = st.number_input("Page", min_value=1, max_value=n_pages, value=1, step=1,
+                               key=f"{widget}_page_{n_pages}")
+
+    start = (page - 1) * page_size
+    page_positions = positions[start:start + page_size]
+    # Only this window of rows and columns is serialized (as Arrow) to the browser
+    st.dataframe(df.iloc[page_positions][[c for c in all_cols if c in columns]])
+    shown = f"{start + 1:,}-{start + len(page_positions):,}" if len(page_positions) else "0"
+    filtered = f" (filtered from {len(df):,})" if len(positions) != len(df) else ""
+    st.caption(f"Rows {shown} of {len(positions):,}{filtered} · page {page} of {n_pages}")
+
+    with st.expander("📊 Column statistics"):
+        st.dataframe(stats, hide_index=True, use_container_width=True)
+
+
+def show_data_preview(df, key):
+    """
+    Render a paginated preview of df: only one page of rows and the selected
+    columns are sent to the browser, and sort/filter run server-side. Column
+    statistics are computed here once per export; paging reruns only the fragment.
+    """
+    stats = column_stats(df)
+    _data_preview_fragment(df, key, stats, os.urandom(4).hex())
+
+
+EVENT_MAP_MODES = {
+    'auto': "Automatic (clusters, heat map for large exports)",
+    'cluster': "Clustered markers",
+    'heat': "Heat map",
+}
+EVENT_MAP_MAX_MARKERS = 5000  # above this, clusters give way to the heat map
+EVENT_MAP_HEAT_GRID = 64      # heat map cells per side, so at most 64 x 64 weighted points
+
+# Markers are created in the browser from one packed array; popups are built when clicked
+EVENT_MARKER_CALLBACK = """
+function (row) {
+    var marker = L.circleMarker(new L.LatLng(row[0], row[1]),
+        {radius: 6, color: 'red', fill: true, fillColor: 'red', fillOpacity: 0.7});
+    marker.bindPopup(function () { return row[2]; });
+    return marker;
+}
+"""
+
+
+def event_heat_cells(lat, lon, grid=EVENT_MAP_HEAT_GRID):
+    """Bin event positions into a grid x grid lattice over their extent; returns [[lat, lon, count], ...] per occupied cell"""
+    lat_edges = np.linspace(lat.min(), lat.max(), grid + 1)
+    lon_edges = np.linspace(lon.min(), lon.max(), grid + 1)
+    row = np.clip(np.searchsorted(lat_edges, lat, side='right') - 1, 0, grid - 1)
+    col = np.clip(np.searchsorted(lon_edges, lon, side='right') - 1, 0, grid - 1)
+    cells, counts = np.unique(row * grid + col, return_counts=True)
+    cell_lat = (lat_edges[cells // grid] + lat_edges[cells // grid + 1]) / 2
+    cell_lon = (lon_edges[cells % grid] + lon_edges[cells % grid + 1]) / 2
+    return np.column_stack([cell_lat, cell_lon, counts]).tolist()
+
+
+def event_map_points(events_gdf):
+    """
+    What the event map needs from an events frame: a DataFrame of lat, lon and
+    popup HTML, one row per located event. Built per block of events, so the
+    map never needs the combined frame.
+    """
+    from html import escape
+
+    located = events_gdf[events_gdf.geometry.notna() & ~events_gdf.geometry.is_empty]
+
+    def column(name):
+        return located[name].astype(str).map(escape) if name in located.columns else pd.Series('N/A', index=located.index)
+
+    popups = ("<b>" + column('event_type') + "</b><br>Time: " + column('time')
+              + "<br>Patrol: " + column('patrol_serial_number'))
+    return pd.DataFrame({
+        'lat': located.geometry.y.to_numpy(),
+        'lon': located.geometry.x.to_numpy(),
+        'popup': popups.to_numpy(dtype=object),
+    })
+
+
+def add_event_layer(m, points, mode='auto'):
+    """
+    Add events (event_map_points) to a folium map as one client-side cluster
+    layer or one heat layer, so the page size does not grow with a marker
+    object per event. Returns the mode used.
+    """
+    from folium.plugins import FastMarkerCluster, HeatMap
+
+    if len(points) == 0:
+        return mode
+    lat = points['lat'].to_numpy()
+    lon = points['lon'].to_numpy()
+    if mode == 'auto':
+        mode = 'cluster' if len(points) <= EVENT_MAP_MAX_MARKERS else 'heat'
+
+    if mode == 'heat':
+        HeatMap(event_heat_cells(lat, lon), name="Events", radius=18).add_to(m)
+        return mode
+
+    data = [[y, x, text] for y, x, text in zip(lat.tolist(), lon.tolist(), points['popup'].tolist())]
+    FastMarkerCluster(data, callback=EVENT_MARKER_CALLBACK, name="Events").add_to(m)
+    return mode
+
+
+def load_aoi(uploaded_file=None, bbox_text=''):
+    """
+    Build the area of interest as one (multi)polygon in EPSG:4326 from an uploaded
+    GeoJSON / zipped shapefile, or from a 'min_lon, min_lat, max_lon, max_lat'
+    bounding box. Returns None when neither is given; raises ValueError if unusable.
+    """
+    import geopandas as gpd
+    import shapely
+    from shapely.geometry import box
+
+    if uploaded_file is not None:
+        suffix = '.zip' if uploaded_file.name.lower().endswith('.zip') else '.geojson'
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, f"aoi{suffix}")
+            with open(path, 'wb') as f:
+                f.write(uploaded_file.getvalue())
+            try:
+                aoi_gdf = gpd.read_file(f"zip://{path}" if suffix == '.zip' else path)
+            except Exception as e:
+                raise ValueError(f"Could not read area of interest file: {e}")
+        if aoi_gdf.crs is not None and aoi_gdf.crs.to_epsg() != 4326:
+            aoi_gdf = aoi_gdf.to_crs(4326)
+        polygons = aoi_gdf.geometry[aoi_gdf.geom_type.isin(['Polygon', 'MultiPolygon'])]
+        if polygons.empty:
+            raise ValueError("Area of interest file contains no polygons")
+        return shapely.union_all(polygons.values)
+
+    if bbox_text and bbox_text.strip():
+        try:
+            min_lon, min_lat, max_lon, max_lat = [float(v) for v in bbox_text.split(',')]
+        except ValueError:
+            raise ValueError("Bounding box must be four numbers: min_lon, min_lat, max_lon, max_lat")
+        if min_lon >= max_lon or min_lat >= max_lat:
+            raise ValueError("Bounding box minimums must be smaller than maximums")
+        return box(min_lon, min_lat, max_lon, max_lat)
+
+    return None
+
+
+def aoi_mask(x, y, aoi):
+    """
+    Vectorized point-in-AOI test: returns a boolean array marking which (x, y)
+    points fall inside the area of interest, using an STRtree over its polygon parts
+    """
+    import shapely
+
+    mask = np.zeros(len(x), dtype=bool)
+    valid = ~(np.isnan(x) | np.isnan(y))
+    if not valid.any():
+        return mask
+    tree = shapely.STRtree(shapely.get_parts(aoi))
+    hits = tree.query(shapely.points(x[valid], y[valid]), predicate='intersects')
+    mask[np.flatnonzero(valid)[np.unique(hits[0])]] = True
+    return mask
+
+
+def filter_events_to_aoi(events_gdf, aoi):
+    """Keep only events whose point geometry falls inside the area of interest"""
+    if aoi is None or events_gdf.empty:
+        return events_gdf
+    import shapely
+
+    geoms = events_gdf.geometry.values
+    x = shapely.get_x(geoms)
+    y = shapely.get_y(geoms)
+    # get_x/get_y return NaN for missing or non-point geometries
+    return events_gdf[aoi_mask(np.asarray(x, dtype='float64'), np.asarray(y, dtype='float64'), aoi)]
+
+
+def clip_tracks_to_aoi(lines_gdf, aoi):
+    """Clip track geometries to the area of interest and add the in-AOI distance per patrol"""
+    import shapely
+    from shapely.geometry import MultiLineString
+
+    clipped = shapely.intersection(lines_gdf.geometry.values, aoi)
+    # A track touching the boundary gives a Point, a MultiPoint or points in a
+    # GeometryCollection, which a line shapefile cannot hold: keep only the lines
+    not_linear = ~np.isin(shapely.get_type_id(clipped), [1, 5])  # LineString, MultiLineString
+    for i in np.flatnonzero(not_linear):
+        lines = [g for g in shapely.get_parts(clipped[i]) if g.geom_type == 'LineString']
+        clipped[i] = shapely.multilinestrings(lines) if lines else MultiLineString()  # Empty rows are dropped below
+    lines_gdf = lines_gdf.set_geometry(clipped)
+    lines_gdf['aoi_dist_km'] = shapely.length(clipped) * 111
+    return lines_gdf[~shapely.is_empty(clipped)].reset_index(drop=True)
+
+
+def track_latlon_parts(geometry):
+    """Return a track (LineString or MultiLineString) as a list of [(lat, lon), ...] parts for folium"""
+    parts = getattr(geometry, 'geoms', [geometry])
+    return [[(coord[1], coord[0]) for coord in part.coords] for part in parts if not part.is_empty]
+
+
+def track_segment_index(tracks_gdf):
+    """
+    Nearest-segment index over every track for snap_events_to_tracks, built
+    once and reusable across batches of events. The STRtree holds the
+    individual track segments in a local equirectangular plane in metres, so a
+    long winding track does not match every query. None when there are no segments.
+    """
+    import shapely
+
+    parts, track_of_part = shapely.get_parts(np.asarray(tracks_gdf.geometry.values), return_index=True)
+    coords, part_of_coord = shapely.get_coordinates(parts, return_index=True)
+    # Segments join consecutive vertices of the same part
+    seg = np.flatnonzero(part_of_coord[1:] == part_of_coord[:-1])
+    if not len(seg):
+        return None
+    scale = np.array([111_320.0 * np.cos(np.deg2rad(coords[:, 1].mean())), 110_574.0])
+    xy = coords * scale
+    start, end = xy[seg], xy[seg + 1]
+    seg_m = np.hypot(*(end - start).T)
+    # Distance along the track to each segment's start, restarting at every track
+    seg_track = track_of_part[part_of_coord[seg]]
+    before_m = np.cumsum(seg_m) - seg_m
+    first = np.r_[True, seg_track[1:] != seg_track[:-1]]
+    before_m -= before_m[np.maximum.accumulate(np.where(first, np.arange(len(seg)), 0))]
+    return {
+        'scale': scale, 'start': start, 'end': end, 'seg_m': seg_m, 'before_m': before_m,
+        'patrol_id': tracks_gdf['patrol_id'].to_numpy()[seg_track],
+        'tree': shapely.STRtree(shapely.linestrings(np.stack([start, end], axis=1))),
+    }
+
+
+def snap_events_to_tracks(events_gdf, tracks_gdf, index=None):
+    """
+    Bulk nearest-track join: adds nearest_patrol_id, track_offset_m (distance
+    from the event to that track) and km_along_patrol (position of the nearest
+    point along the track, parts counted in order) to every event; events that
+    are not Points are measured from a point on their surface. Positions on
+    the nearest segments are computed with numpy, all events at once. Pass an
+    index from track_segment_index to snap several batches against the same tracks.
+    """
+    import shapely
+
+    if index is None:
+        index = track_segment_index(tracks_gdf)
+    nearest = np.full(len(events_gdf), None, dtype=object)
+    offset_m = np.full(len(events_gdf), np.nan)
+    along_km = np.full(len(events_gdf), np.nan)
+
+    points = np.asarray(events_gdf.geometry.values)
+    point_rows = np.flatnonzero(~(shapely.is_missing(points) | shapely.is_empty(points)))
+    if index is not None and len(point_rows):
+        start, end, seg_m = index['start'], index['end'], index['seg_m']
+        # Events that are not Points (geojson_geometries keeps any shape) snap
+        # from a point on their surface, so there is one coordinate per row
+        anchors = points[point_rows]
+        shaped = shapely.get_type_id(anchors) != 0
+        anchors[shaped] = shapely.point_on_surface(anchors[shaped])
+        point_xy = shapely.get_coordinates(anchors) * index['scale']
+        (point_idx, seg_idx), distance = index['tree'].query_nearest(
+            shapely.points(point_xy), return_distance=True, all_matches=False
+        )
+        direction = end[seg_idx] - start[seg_idx]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            t = np.einsum('ij,ij->i', point_xy[point_idx] - start[seg_idx], direction) / (seg_m[seg_idx] ** 2)
+        t = np.clip(np.nan_to_num(t), 0, 1)  # zero-length segments snap to their start
+        rows = point_rows[point_idx]
+        nearest[rows] = index['patrol_id'][seg_idx]
+        offset_m[rows] = distance
+        along_km[rows] = (index['before_m'][seg_idx] + t * seg_m[seg_idx]) / 1000
+
+    events_gdf['nearest_patrol_id'] = nearest
+    events_gdf['track_offset_m'] = offset_m.round(1)
+    events_gdf['km_along_patrol'] = along_km.round(3)
+    return events_gdf
+
+
+def track_steps(xs, ys, times_ns, codes):
+    """
+    Duration (s), length (km) and speed (km/h) of every step between consecutive
+    fixes sorted by (patrol, time), as arrays of length n - 1. Steps from one
+    patrol into the next are NaN. Lengths use an equirectangular approximation.
+    """
+    step_km = np.hypot(
+        np.diff(xs) * 111.32 * np.cos(np.deg2rad((ys[1:] + ys[:-1]) / 2)),
+        np.diff(ys) * 110.574
+    )
+    step_s = np.diff(times_ns) / 1e9 if times_ns is not None else np.full(len(step_km), np.nan)
+    crossing = codes[1:] != codes[:-1]
+    step_km[crossing] = np.nan
+    step_s[crossing] = np.nan
+    with np.errstate(divide='ignore', invalid='ignore'):
+        speed = np.where(step_km == 0, 0.0, step_km / (step_s / 3600))
+    return step_s, step_km, speed
+
+
+def clean_track_fixes(xs, ys, times_ns, codes, max_speed_kmh=None, max_gap_s=None):
+    """
+    Vectorized cleaning of fixes sorted by (patrol, time), all patrols at once.
+    Returns (keep, part_start): keep drops GPS spikes, i.e. fixes both reached
+    and left faster than max_speed_kmh. A patrol's first or last fix only has
+    the one step, so it is dropped for a fast step only when its neighbour is
+    not a spike itself; part_start marks the kept fixes that follow a gap
+    longer than max_gap_s, where the track is split into a new part.
+    """
+    keep = np.ones(len(xs), dtype=bool)
+    if max_speed_kmh:
+        _, _, speed = track_steps(xs, ys, times_ns, codes)
+        new_patrol = codes[1:] != codes[:-1]
+        first, last = np.r_[True, new_patrol], np.r_[new_patrol, True]
+        fast_in = np.r_[False, speed > max_speed_kmh]
+        fast_out = np.r_[speed > max_speed_kmh, False]
+        spike = fast_in & fast_out
+        # The fast step next to an endpoint belongs to the spike beside it, if there is one
+        end_spike = (first & fast_out & ~np.r_[spike[1:], False]) | (last & fast_in & ~np.r_[False, spike[:-1]])
+        keep = ~(spike | end_spike)
+
+    part_start = np.zeros(int(keep.sum()), dtype=bool)
+    if max_gap_s:
+        step_s, _, _ = track_steps(xs[keep], ys[keep], times_ns[keep], codes[keep])
+        part_start[1:] = step_s > max_gap_s
+    return keep, part_start
+
+
+def assemble_tracks(xs, ys, line_of_point, part_start=None):
+    """
+    Build all track geometries in bulk from fixes sorted by line index: one
+    LineString per line, or a MultiLineString where part_start splits it.
+    Parts with fewer than two fixes are dropped.
+    """
+    import shapely
+
+    if part_start is None:
+        return shapely.linestrings(xs, ys, indices=line_of_point)
+    new_part = np.r_[True, line_of_point[1:] != line_of_point[:-1]] | part_start
+    part = np.cumsum(new_part) - 1
+    ok = np.bincount(part)[part] >= 2
+    part_of_fix = np.unique(part[ok], return_inverse=True)[1]
+    parts = shapely.linestrings(xs[ok], ys[ok], indices=part_of_fix)
+    part_line = line_of_point[ok][new_part[ok]]
+    geometries = shapely.multilinestrings(parts, indices=part_line)
+    single = np.bincount(part_line, minlength=len(geometries)) == 1
+    geometries[single] = shapely.get_geometry(geometries[single], 0)
+    return geometries
+
+
+EFFORT_RESOLUTIONS_M = [100, 250, 500, 1000, 2000, 5000]
+EFFORT_MAX_STEP_S = 30 * 60  # longer gaps between fixes add no time or distance to a cell
+EFFORT_GRID_FORMATS = {'geoparquet': ('.parquet', 'application/vnd.apache.parquet'),
+                       'geotiff': ('.tif', 'image/tiff')}
+
+
+def build_effort_grid(xs, ys, times_ns, patrol_codes, resolution_m, aoi=None):
+    """
+    Bin observations sorted by (patrol, time) into a regular grid of roughly
+    resolution_m square cells. Each step between consecutive fixes of a patrol
+    adds its duration and length to the cell it starts in. Returns a GeoDataFrame
+    of the visited cells with patrols, points, hours and dist_km columns; the grid
+    origin and cell size are kept in attrs['effort_grid'] for raster export.
+    """
+    import geopandas as gpd
+    import shapely
+
+    valid = (patrol_codes >= 0) & ~(np.isnan(xs) | np.isnan(ys))
+    xs, ys, codes = xs[valid], ys[valid], patrol_codes[valid]
+    if times_ns is not None:
+        times_ns = times_ns[valid]
+    if len(xs) == 0:
+        return None
+
+    # Cell size in degrees at the mean latitude; the origin snaps to multiples of
+    # the cell size so grids from different exports line up
+    dlat = resolution_m / 110_574.0
+    dlon = resolution_m / (111_320.0 * np.cos(np.deg2rad(ys.mean())))
+    west = np.floor(xs.min() / dlon) * dlon
+    north = np.ceil(ys.max() / dlat) * dlat
+    if north == ys.max():
+        north += dlat
+    cols = ((xs - west) // dlon).astype(np.int64)
+    rows = ((north - ys) // dlat).astype(np.int64)
+    ncols = int(cols.max()) + 1
+    nrows = int(rows.max()) + 1
+    cell_ids, cell_of_point = np.unique(rows * ncols + cols, return_inverse=True)
+    n_cells = len(cell_ids)
+
+    # Steps between consecutive fixes of the same patrol
+    step_s, step_km, _ = track_steps(xs, ys, times_ns, codes)
+    step = ~np.isnan(step_km)
+    if times_ns is not None:
+        step &= (step_s >= 0) & (step_s <= EFFORT_MAX_STEP_S)
+    step_s = np.nan_to_num(step_s)
+    step_cell = cell_of_point[:-1][step]
+
+    # Distinct patrols per cell from the unique (cell, patrol) pairs
+    n_codes = int(codes.max()) + 1
+    pairs = np.unique(cell_of_point.astype(np.int64) * n_codes + codes)
+
+    rows_out = cell_ids // ncols
+    cols_out = cell_ids % ncols
+    min_x = west + cols_out * dlon
+    max_y = north - rows_out * dlat
+    grid = gpd.GeoDataFrame({
+        'row': rows_out,
+        'col': cols_out,
+        'patrols': np.bincount(pairs // n_codes, minlength=n_cells),
+        'points': np.bincount(cell_of_point, minlength=n_cells),
+        'hours': np.bincount(step_cell, weights=step_s[step] / 3600, minlength=n_cells),
+        'dist_km': np.bincount(step_cell, weights=step_km[step], minlength=n_cells),
+    }, geometry=shapely.box(min_x, max_y - dlat, min_x + dlon, max_y), crs=4326)
+
+    if aoi is not None:
+        grid = grid[aoi_mask(min_x + dlon / 2, max_y - dlat / 2, aoi)].reset_index(drop=True)
+    grid.attrs['effort_grid'] = {
+        'resolution_m': resolution_m, 'west': west, 'north': north,
+        'dlon': dlon, 'dlat': dlat, 'rows': nrows, 'cols': ncols,
+    }
+    return grid
+
+
+def effort_grid_bytes(grid, fmt='geoparquet'):
+    """
+    Serialize an effort grid: GeoParquet keeps one polygon per visited cell,
+    GeoTIFF writes patrols/hours/dist_km as bands of a dense float32 raster
+    """
+    if fmt == 'geoparquet':
+        buffer = io.BytesIO()
+        grid.to_parquet(buffer, index=False)
+        return buffer.getvalue()
+
+    if 'effort_grid' not in grid.attrs:
+        raise ValueError("GeoTIFF needs a grid from a single server; use GeoParquet for merged grids")
+    import rasterio
+    from rasterio.transform import from_origin
+
+    meta = grid.attrs['effort_grid']
+    bands = ['patrols', 'hours', 'dist_km']
+    raster = np.zeros((len(bands), meta['rows'], meta['cols']), dtype='float32')
+    for i, band in enumerate(bands):
+        raster[i, grid['row'].to_numpy(), grid['col'].to_numpy()] = grid[band].to_numpy()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, 'effort.tif')
+        with rasterio.open(
+            path, 'w', driver='GTiff', compress='deflate',
+            height=meta['rows'], width=meta['cols'], count=len(bands), dtype='float32',
+            crs='EPSG:4326', nodata=0,
+            transform=from_origin(meta['west'], meta['north'], meta['dlon'], meta['dlat'])
+        ) as dst:
+            dst.write(raster)
+            for i, band in enumerate(bands, start=1):
+                dst.set_band_description(i, band)
+        with open(path, 'rb') as f:
+            return f.read()
+
+
+def resample_mask(patrol_codes, times_ns, interval_s):
+    """
+    Time-based thinning over observations sorted by (patrol, time): marks the first
+    fix in each interval_s window of a patrol, plus every patrol's first and last fix
+    """
+    n = len(patrol_codes)
+    block_start = np.r_[True, patrol_codes[1:] != patrol_codes[:-1]]
+    block_end = np.r_[block_start[1:], True]
+    first_of_block = np.maximum.accumulate(np.where(block_start, np.arange(n), 0))
+    window = (times_ns - times_ns[first_of_block]) // int(interval_s * 1e9)
+    return block_start | block_end | np.r_[True, window[1:] != window[:-1]]
+
+
+def simplify_tracks(geometries, tolerance_m):
+    """Topology-preserving Douglas-Peucker simplification of an array of tracks, tolerance in metres"""
+    import shapely
+
+    # Degrees of latitude; a degree of longitude is shorter, so this errs on the side of keeping detail
+    return shapely.simplify(geometries, tolerance_m / 111_320.0, preserve_topology=True)
+
+
+TRACK_MODES = {
+    'patrol': "One line per patrol",
+    'segment': "One line per patrol segment",
+    'multipart': "One multi-line per patrol, split at segments",
+}
+
+
+def patrol_segment_windows(patrols_df):
+    """
+    One row per patrol segment with its time window: patrol_id, segment_id,
+    segment_start, segment_end (UTC; NaT while a segment is still open),
+    segment_type and segment_leader, sorted by patrol and start time
+    """
+    columns = ['patrol_id', 'segment_id', 'segment_start', 'segment_end', 'segment_type', 'segment_leader']
+    rows = []
+    for patrol_id, segments in zip(patrols_df['id'], patrols_df['patrol_segments']):
+        if not isinstance(segments, list):
+            continue
+        for segment in segments:
+            if not isinstance(segment, dict):
+                continue
+            time_range = segment.get('time_range') or {}
+            leader = segment.get('leader')
+            if isinstance(leader, dict):
+                leader = leader.get('name', leader.get('username', ''))
+            rows.append([patrol_id, segment.get('id'), time_range.get('start_time'), time_range.get('end_time'),
+                         segment.get('patrol_type') or '', leader or ''])
+    windows = pd.DataFrame(rows, columns=columns)
+    for col in ['segment_start', 'segment_end']:
+        windows[col] = pd.to_datetime(windows[col], format='ISO8601', utc=True)
+    windows = windows.dropna(subset=['segment_start'])
+    return windows.sort_values(['patrol_id', 'segment_start'], kind='stable').reset_index(drop=True)
+
+
+def assign_segments(patrol_ids, times, windows):
+    """
+    Assign every observation to the segment window of its patrol that contains
+    its timestamp, in one as-of merge. Returns the windows row index per
+    observation, or -1 for fixes outside every segment.
+    """
+    # Work on int64 nanoseconds - tz-aware datetimes would be boxed to objects
+    patrols = pd.Index(windows['patrol_id'].unique())
+    observations = pd.DataFrame({
+        'patrol': patrols.get_indexer(np.asarray(patrol_ids, dtype=object)),
+        'time': times.dt.as_unit('ns').array.asi8,
+        'position': np.arange(len(times)),
+    })
+    observations = observations[(observations['patrol'] >= 0) & times.notna().to_numpy()]
+    starts = pd.DataFrame({
+        'patrol': patrols.get_indexer(windows['patrol_id']),
+        'segment_start': windows['segment_start'].dt.as_unit('ns').array.asi8,
+        'segment': np.arange(len(windows)),
+    })
+    matched = pd.merge_asof(
+        observations.sort_values('time', kind='stable'), starts.sort_values('segment_start', kind='stable'),
+        left_on='time', right_on='segment_start', by='patrol', direction='backward'
+    )
+
+    segment = matched['segment'].fillna(-1).to_numpy(dtype=np.int64)
+    # Open segments have no end yet
+    ends = np.where(windows['segment_end'].isna(), np.iinfo(np.int64).max, windows['segment_end'].dt.as_unit('ns').array.asi8)
+    inside = segment >= 0
+    inside[inside] = matched['time'].to_numpy()[inside] <= ends[segment[inside]]
+    assigned = np.full(len(times), -1, dtype=np.int64)
+    assigned[matched['position'].to_numpy()[inside]] = segment[inside]
+    return assigned
+
+
+def merge_segment_lines(lines_gdf):
+    """
+    Combine consecutive per-segment rows of the same patrol into one
+    MultiLineString row per patrol, keeping the first segment's metadata and
+    summing the point, vertex and distance counts
+    """
+    import shapely
+
+    codes = pd.factorize(lines_gdf['patrol_id'])[0]
+    first = np.flatnonzero(np.r_[True, codes[1:] != codes[:-1]])
+    last = np.r_[first[1:], len(codes)] - 1
+    merged = lines_gdf.iloc[first].drop(columns=['segment_id', 'segment_start', 'segment_end'], errors='ignore')
+    # Segments already split at gaps are MultiLineStrings themselves, so merge their parts
+    parts, segment_of_part = shapely.get_parts(lines_gdf.geometry.values, return_index=True)
+    merged = merged.set_geometry(shapely.multilinestrings(parts, indices=codes[segment_of_part]), crs=lines_gdf.crs)
+    merged['num_segments'] = np.diff(np.r_[first, len(codes)])
+    for col in ['num_points', 'num_vertices', 'distance_km']:
+        if col in merged.columns:
+            merged[col] = np.add.reduceat(lines_gdf[col].to_numpy(), first)
+    if 'end_time' in merged.columns:
+        merged['end_time'] = lines_gdf['end_time'].to_numpy()[last]
+    return merged.reset_index(drop=True)
+
+
+# Observation columns read by download_patrol_tracks - everything else is dropped right after fetch
+OBSERVATION_TIME_COLUMNS = ['extra__recorded_at', 'recorded_at', 'fixtime', 'time', 'timestamp']
+OBSERVATION_COLUMNS = ['patrol_id', 'patrol_title', 'patrol_serial_number', 'patrol_start_time',
+                       'patrol_end_time', 'extra__subject_id', 'leader', 'patrol_leader', 'patrol_subject']
 
-import re as _re
-_UUID_RE = _re.compile(r'^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$', _re.I)
 
-def resolve_uuid_columns(df, uuid_to_name, col_prefix='detail_'):
+def frame_memory_mb(df):
+    """Deep memory usage of a DataFrame in MB (walks object columns, so only call when needed)"""
+    return round(df.memory_usage(deep=True).sum() / 1e6, 1)
+
+
+def compact_observations(points_gdf):
     """
-    For every column whose name starts with col_prefix and whose values look like
-    UUIDs, insert a companion '<col>_name' column immediately after it containing
-    the resolved display name (or empty string if not found).
-    Only adds the name column when at least one value resolves successfully.
+    Shrink the observation frame right after fetch: keep only the columns the
+    track build reads, parse timestamps once, store repeated strings as
+    categoricals and replace Point geometries with float64 x/y columns.
+    Returns a plain DataFrame.
     """
-    if not uuid_to_name:
-        return df
+    time_col = next((c for c in OBSERVATION_TIME_COLUMNS if c in points_gdf.columns), None)
+    keep = [
+        c for c in points_gdf.columns
+        if c in OBSERVATION_COLUMNS or c == time_col or c.startswith('patrol_type__')
+    ]
+    compact = pd.DataFrame({c: points_gdf[c].to_numpy() for c in keep}, index=points_gdf.index)
+    compact['x'] = points_gdf.geometry.x.to_numpy(dtype='float64')
+    compact['y'] = points_gdf.geometry.y.to_numpy(dtype='float64')
+
+    # Parse ISO timestamp strings to int64-backed datetimes once
+    for col in [time_col, 'patrol_start_time', 'patrol_end_time']:
+        if col in compact.columns and not pd.api.types.is_datetime64_any_dtype(compact[col]):
+            try:
+                compact[col] = pd.to_datetime(compact[col], format='ISO8601', utc=True)
+            except (ValueError, TypeError):
+                pass  # Left as-is; the time clip reports unparseable data
+        # Ensure all are timezone-aware UTC
+        if col in compact.columns and pd.api.types.is_datetime64_any_dtype(compact[col]) and compact[col].dt.tz is None:
+            compact[col] = compact[col].dt.tz_localize('UTC')
 
-    def _is_uuid(val):
-        return isinstance(val, str) and bool(_UUID_RE.match(val.strip()))
+    # Repeated strings (patrol ids, titles, type displays, subject ids) become categoricals
+    for col in compact.columns:
+        if compact[col].dtype == 'object':
+            try:
+                if compact[col].nunique(dropna=True) <= len(compact) // 2:
+                    compact[col] = compact[col].astype('category')
+            except TypeError:
+                pass  # Unhashable values such as dicts stay as objects
+    return compact
 
-    cols = list(df.columns)
-    inserts = []  # list of (position, new_col_name, series)
 
-    for i, col in enumerate(cols):
-        if not col.endswith('_name') and col.startswith(col_prefix):
-            sample = df[col].dropna()
-            if sample.empty:
-                continue
-            uuid_frac = sample.apply(_is_uuid).mean()
-            if uuid_frac >= 0.5:  # majority look like UUIDs
-                name_series = df[col].apply(
-                    lambda v: uuid_to_name.get(str(v).strip(), '') if isinstance(v, str) else ''
-                )
-                if name_series.str.len().sum() > 0:  # at least one resolved
-                    inserts.append((i + 1, col + '_name', name_series))
+def patrol_type_filename(patrol_type):
+    """Patrol type filter as a filename part: 'all_patrols' when unfiltered, at most 3 types otherwise"""
+    if not patrol_type:
+        return "all_patrols"
+    if isinstance(patrol_type, list):
+        # Limit to first 3 to avoid too long filename
+        return "_".join("".join(c if c.isalnum() else "_" for c in pt) for pt in patrol_type[:3])
+    return "".join(c if c.isalnum() else "_" for c in patrol_type)
 
-    if not inserts:
-        return df
 
-    # Rebuild column order with injected name columns
-    result = df.copy()
-    offset = 0
-    for pos, name_col, series in inserts:
-        if name_col not in result.columns:
-            result.insert(pos + offset, name_col, series.values)
-            offset += 1
-    return result
+def download_patrol_tracks(er_io, patrol_type_value, since, until, subject_name=None, profiler=None, aoi=None,
+                           effort_resolution_m=None, outputs=None, simplify_m=None, resample_s=None,
+                           track_mode='patrol', max_speed_kmh=None, max_gap_s=None):
+    """
+    Download patrol tracks as GeoDataFrame and convert to LineStrings.
+    With effort_resolution_m set, a patrol-effort grid is built from the same
+    sorted observations and stored in outputs['effort_grid'].
+    resample_s keeps one fix per that many seconds and simplify_m simplifies the
+    lines; num_points and distance_km still describe the raw track, and
+    num_vertices gives the vertex count after thinning.
+    track_mode 'segment' builds one line per patrol segment and 'multipart'
+    one MultiLineString per patrol with a part per segment (see TRACK_MODES).
+    max_speed_kmh drops GPS spikes and max_gap_s splits tracks at long gaps
+    into MultiLineStrings; both need timestamped observations.
+    """
+    import geopandas as gpd
+    from shapely.geometry import LineString, MultiLineString
 
+    if profiler is None:
+        profiler = ExportProfiler('patrol_tracks', enabled=False)
 
-def download_patrol_tracks(er_io, patrol_type_value, since, until, subject_name=None):
-    """Download patrol tracks as GeoDataFrame and convert to LineStrings"""
     try:
         # Get patrols based on filters
+        profiler.lap('get_patrols')
         patrols_df = er_io.get_patrols(
             since=since,
             until=until,
@@ -127,70 +2417,58 @@ def download_patrol_tracks(er_io, patrol_type_value, since, until, subject_name=
         if patrols_df.empty:
             return None, "No patrols found for the specified criteria"
         
-        # Extract patrol_type from nested patrol_segments structure
-        def get_patrol_type(row):
-            """Extract patrol_type from patrol_segments"""
-            if 'patrol_segments' in row and isinstance(row['patrol_segments'], list) and len(row['patrol_segments']) > 0:
-                segment = row['patrol_segments'][0]
-                if isinstance(segment, dict) and 'patrol_type' in segment:
-                    return segment['patrol_type']
-            return None
-        
-        def get_patrol_subject(row):
-            """Extract patrol subject (leader name) from patrol_segments"""
-            if 'patrol_segments' in row and isinstance(row['patrol_segments'], list) and len(row['patrol_segments']) > 0:
-                segment = row['patrol_segments'][0]
-                if isinstance(segment, dict):
-                    # Try different possible subject field names
-                    if 'leader' in segment:
-                        leader = segment['leader']
-                        if isinstance(leader, dict):
-                            return leader.get('name', leader.get('username', ''))
-                        return str(leader) if leader else ''
-                    elif 'patrol_subject' in segment:
-                        return segment['patrol_subject']
-            return ''
-        
-        patrols_df['patrol_type_extracted'] = patrols_df.apply(get_patrol_type, axis=1)
-        patrols_df['patrol_subject_extracted'] = patrols_df.apply(get_patrol_subject, axis=1)
+        # Patrol type and leader of each patrol's first segment, in one pass over the segments
+        profiler.lap('filter_patrols')
+        if 'patrol_segments' in patrols_df.columns:
+            first_segment = patrol_index_rows(patrols_df)
+            patrols_df['patrol_type_extracted'] = first_segment['patrol_type'].to_numpy()
+            patrols_df['patrol_subject_extracted'] = first_segment['leader'].to_numpy()
+        else:
+            patrols_df['patrol_type_extracted'] = None
+            patrols_df['patrol_subject_extracted'] = ''
         
+        # Build all patrol filters as masks and apply them once at the end,
+        # checking after each one so the error names the filter that emptied the selection
         # Remove patrols with None/empty patrol types to avoid processing errors
-        patrols_df = patrols_df[patrols_df['patrol_type_extracted'].notna()].copy()
-        patrols_df = patrols_df[patrols_df['patrol_type_extracted'] != ''].copy()
+        keep = patrols_df['patrol_type_extracted'].notna() & (patrols_df['patrol_type_extracted'] != '')
         
-        if patrols_df.empty:
+        if not keep.any():
             return None, "No patrols found with valid patrol types in the specified date range"
         
         # Filter by patrol_type(s)
         if patrol_type_value:
             if isinstance(patrol_type_value, list):
                 # Multiple patrol types selected
-                patrols_df = patrols_df[patrols_df['patrol_type_extracted'].isin(patrol_type_value)].copy()
-                if patrols_df.empty:
+                keep &= patrols_df['patrol_type_extracted'].isin(patrol_type_value)
+                if not keep.any():
                     return None, f"No patrols found for types: {', '.join(patrol_type_value)}"
             else:
                 # Single patrol type (backwards compatibility)
-                patrols_df = patrols_df[patrols_df['patrol_type_extracted'] == patrol_type_value].copy()
-                if patrols_df.empty:
+                keep &= patrols_df['patrol_type_extracted'] == patrol_type_value
+                if not keep.any():
                     return None, f"No patrols found for type: {patrol_type_value}"
         
         # Filter by subject name(s) if specified
         if subject_name:
             if isinstance(subject_name, list):
                 # Multiple leaders selected
-                patrols_df = patrols_df[patrols_df['patrol_subject_extracted'].isin(subject_name)].copy()
-                if patrols_df.empty:
+                keep &= patrols_df['patrol_subject_extracted'].isin(subject_name)
+                if not keep.any():
                     return None, f"No patrols found for leaders: {', '.join(subject_name)}"
             else:
                 # Single leader (backwards compatibility)
-                patrols_df = patrols_df[patrols_df['patrol_subject_extracted'] == subject_name].copy()
-                if patrols_df.empty:
+                keep &= patrols_df['patrol_subject_extracted'] == subject_name
+                if not keep.any():
                     return None, f"No patrols found for leader: {subject_name}"
         
+        # Boolean indexing already returns a new frame - no extra .copy() needed
+        patrols_df = patrols_df[keep]
+        
         # Get the patrol IDs that match our filter
         patrol_ids = patrols_df['id'].tolist() if 'id' in patrols_df.columns else patrols_df.index.tolist()
         
         # Get patrol observations
+        profiler.lap('get_patrol_observations')
         patrol_observations = er_io.get_patrol_observations(
             patrols_df=patrols_df,
             include_patrol_details=True
@@ -205,14 +2483,27 @@ def download_patrol_tracks(er_io, patrol_type_value, since, until, subject_name=
         if points_gdf.empty:
             return None, "No patrol tracks found"
         
+        profiler.lap('compact_observations')
+        if profiler.enabled:
+            profiler.annotate(memory_before_mb=frame_memory_mb(points_gdf))
+        points_gdf = compact_observations(points_gdf)
+        if profiler.enabled:
+            profiler.annotate(memory_after_mb=frame_memory_mb(points_gdf))
+        
+        profiler.lap('time_clip')
+        # The patrol and time-window filters are combined into one mask and
+        # applied in a single pass, so only one filtered copy of the frame is made
+        keep = np.ones(len(points_gdf), dtype=bool)
+        
         # IMPORTANT: Filter to only include observations from the patrols we queried
         # This ensures we only get the selected patrol type
         if 'patrol_id' in points_gdf.columns and len(patrol_ids) > 0:
-            points_gdf = points_gdf[points_gdf['patrol_id'].isin(patrol_ids)].copy()
-            if points_gdf.empty:
+            keep &= points_gdf['patrol_id'].isin(patrol_ids).to_numpy()
+            if not keep.any():
                 return None, f"No observations found for the selected patrols"
         
         # Merge patrol subject names and titles into points data
+        # (patrol_id is categorical after compaction, so these maps are cheap)
         if 'patrol_id' in points_gdf.columns:
             if 'patrol_subject_extracted' in patrols_df.columns:
                 # Create mapping of patrol_id to subject name
@@ -226,71 +2517,120 @@ def download_patrol_tracks(er_io, patrol_type_value, since, until, subject_name=
         
         # Find time column for sorting points chronologically
         time_col = None
-        for col in ['extra__recorded_at', 'recorded_at', 'fixtime', 'time', 'timestamp']:
+        for col in OBSERVATION_TIME_COLUMNS:
             if col in points_gdf.columns:
                 time_col = col
                 break
         
         # Filter points to patrol segment times
-        points_before_filter = len(points_gdf)
+        points_before_filter = int(keep.sum())
         
         if time_col and 'patrol_start_time' in points_gdf.columns and 'patrol_end_time' in points_gdf.columns:
-            try:
-                # Ensure time column is datetime
-                if not pd.api.types.is_datetime64_any_dtype(points_gdf[time_col]):
-                    points_gdf[time_col] = pd.to_datetime(points_gdf[time_col], format='ISO8601', utc=True)
-                
-                # Convert patrol_start_time and patrol_end_time from STRING to datetime
-                # These come as ISO format strings like "2025-10-25T04:59:42Z" or with microseconds
-                if points_gdf['patrol_start_time'].dtype == 'object':  # strings
-                    points_gdf['patrol_start_time'] = pd.to_datetime(points_gdf['patrol_start_time'], format='ISO8601', utc=True)
-                if points_gdf['patrol_end_time'].dtype == 'object':  # strings
-                    points_gdf['patrol_end_time'] = pd.to_datetime(points_gdf['patrol_end_time'], format='ISO8601', utc=True)
-                
-                # Ensure all are timezone-aware UTC
-                if points_gdf[time_col].dt.tz is None:
-                    points_gdf[time_col] = points_gdf[time_col].dt.tz_localize('UTC')
-                if points_gdf['patrol_start_time'].dt.tz is None:
-                    points_gdf['patrol_start_time'] = points_gdf['patrol_start_time'].dt.tz_localize('UTC')
-                if points_gdf['patrol_end_time'].dt.tz is None:
-                    points_gdf['patrol_end_time'] = points_gdf['patrol_end_time'].dt.tz_localize('UTC')
-                
-                # Filter: keep only points where recorded time is between patrol start and end times
-                within_patrol = (points_gdf[time_col] >= points_gdf['patrol_start_time']) & \
-                               (points_gdf[time_col] <= points_gdf['patrol_end_time'])
-                points_gdf = points_gdf[within_patrol].copy()
-            except Exception as e:
+            # compact_observations has already parsed these to UTC datetimes;
+            # anything still unparsed means the data is not usable
+            time_cols = [time_col, 'patrol_start_time', 'patrol_end_time']
+            if not all(pd.api.types.is_datetime64_any_dtype(points_gdf[col]) for col in time_cols):
                 return None, "⚠️ No valid patrol data found within the selected date range and filters. Please check:\n• The date range contains patrols\n• The selected patrol type(s) are correct\n• The selected patrol leader(s) have patrols in this period"
+            
+            # Filter: keep only points where recorded time is between patrol start and end times
+            keep &= ((points_gdf[time_col] >= points_gdf['patrol_start_time']) &
+                     (points_gdf[time_col] <= points_gdf['patrol_end_time'])).to_numpy()
         
-        total_removed = points_before_filter - len(points_gdf)
+        total_removed = points_before_filter - int(keep.sum())
         
-        if points_gdf.empty:
+        if not keep.any():
             return None, f"No points found within patrol time ranges (filtered out {total_removed} of {points_before_filter} points)"
         
+        # Area of interest: drop patrols that never enter it before any lines are built.
+        # Patrols that do enter keep all their points so the clip below cuts exactly at the boundary
+        if aoi is not None:
+            profiler.lap('aoi_filter')
+            in_aoi = keep & aoi_mask(points_gdf['x'].to_numpy(), points_gdf['y'].to_numpy(), aoi)
+            if not in_aoi.any():
+                return None, "No patrol tracks enter the selected area of interest"
+            keep &= points_gdf['patrol_id'].isin(points_gdf['patrol_id'][in_aoi].unique()).to_numpy()
+        
+        points_gdf = points_gdf[keep]
+        
         # Convert points to LineStrings grouped by patrol segment
+        profiler.lap('sort_observations')
         lines = []
         
         # Group by patrol_id - each patrol should be a separate track
         # Note: groupby_col in ecoscope contains subject_id, not patrol segment ID
         group_col = 'patrol_id'
         
-        for group_id in points_gdf[group_col].unique():
-            patrol_points = points_gdf[points_gdf[group_col] == group_id].copy()
-            
-            # CRITICAL: Sort by recorded time to maintain chronological order
-            # Data comes sorted from EarthRanger, but filtering may have disrupted the order
-            if time_col and time_col in patrol_points.columns:
-                patrol_points = patrol_points.sort_values(time_col, ascending=True)
+        # CRITICAL: Sort by recorded time to maintain chronological order
+        # Data comes sorted from EarthRanger, but filtering may have disrupted the order.
+        # One lexsort over (patrol, time) makes each patrol a contiguous, time-ordered
+        # block of positions - no per-patrol filtering or copies of the frame
+        patrol_codes, group_ids = pd.factorize(points_gdf[group_col])
+        group_codes = patrol_codes
+        segment_windows = None
+        if track_mode != 'patrol':
+            # Group by segment instead: each fix goes to the segment window of its patrol it falls in
+            if not (time_col and pd.api.types.is_datetime64_any_dtype(points_gdf[time_col])):
+                return None, "Segment output needs timestamped observations"
+            segment_windows = patrol_segment_windows(patrols_df)
+            # Segments give their type as a value; observations pair values with display names
+            segment_type_names = {}
+            if 'patrol_type__value' in points_gdf.columns and 'patrol_type__display' in points_gdf.columns:
+                pairs = points_gdf[['patrol_type__value', 'patrol_type__display']].drop_duplicates()
+                segment_type_names = dict(zip(pairs['patrol_type__value'], pairs['patrol_type__display']))
+            group_codes = assign_segments(points_gdf[group_col], points_gdf[time_col], segment_windows)
+            group_ids = segment_windows['segment_id'].to_numpy()
+            if not (group_codes >= 0).any():
+                return None, "No observations fall within the selected patrols' segments"
+        if time_col and pd.api.types.is_datetime64_any_dtype(points_gdf[time_col]):
+            order = np.lexsort((points_gdf[time_col].array.asi8, group_codes))
+        elif time_col:
+            order = np.lexsort((pd.factorize(points_gdf[time_col], sort=True)[0], group_codes))
+        else:
+            order = np.argsort(group_codes, kind='stable')
+        sorted_codes = group_codes[order]
+        xs = points_gdf['x'].to_numpy()[order]
+        ys = points_gdf['y'].to_numpy()[order]
+        times_ns = None
+        if time_col and pd.api.types.is_datetime64_any_dtype(points_gdf[time_col]):
+            times_ns = points_gdf[time_col].array.asi8[order]
+        
+        part_start = None
+        if (max_speed_kmh or max_gap_s) and times_ns is not None:
+            profiler.lap('clean_tracks')
+            keep, part_start = clean_track_fixes(xs, ys, times_ns, sorted_codes, max_speed_kmh, max_gap_s)
+            order, sorted_codes, xs, ys, times_ns = order[keep], sorted_codes[keep], xs[keep], ys[keep], times_ns[keep]
+            profiler.annotate(dropped_fixes=int((~keep).sum()), gap_splits=int(part_start.sum()))
+        
+        profiler.lap('build_linestrings')
+        block_starts = np.flatnonzero(np.r_[True, sorted_codes[1:] != sorted_codes[:-1]])
+        block_ends = np.r_[block_starts[1:], len(order)]
+        line_blocks = []  # block index of each line, to rebuild them in bulk when thinning
+        
+        for block, (start, end) in enumerate(zip(block_starts, block_ends)):
+            if sorted_codes[start] < 0:
+                continue  # Points without a patrol_id (or outside every segment)
+            group_id = group_ids[sorted_codes[start]]
+            num_points = int(end - start)
             
-            if len(patrol_points) < 2:
+            if num_points < 2:
                 continue  # Skip patrols with only one point
             
             # Create LineString from points IN TIME ORDER
-            coords = [(point.x, point.y) for point in patrol_points.geometry]
-            line = LineString(coords)
+            coords = np.column_stack([xs[start:end], ys[start:end]])
+            if part_start is not None and part_start[start + 1:end].any():
+                # Split at long gaps; parts of a single fix are dropped
+                parts = [
+                    part for part in np.split(coords, np.flatnonzero(part_start[start + 1:end]) + 1)
+                    if len(part) >= 2
+                ]
+                if not parts:
+                    continue
+                line = MultiLineString(parts) if len(parts) > 1 else LineString(parts[0])
+            else:
+                line = LineString(coords)
             
             # Get patrol metadata from first point
-            first_point = patrol_points.iloc[0]
+            first_point = points_gdf.iloc[order[start]]
             
             # Extract patrol leader/subject name (the person leading the patrol)
             patrol_leader = ''
@@ -318,14 +2658,14 @@ def download_patrol_tracks(er_io, patrol_type_value, since, until, subject_name=
                 'patrol_type': first_point['patrol_type__display'] if 'patrol_type__display' in first_point.index else (first_point['patrol_type__value'] if 'patrol_type__value' in first_point.index else ''),
                 'subject_id': first_point['extra__subject_id'] if 'extra__subject_id' in first_point.index else '',
                 'subject_name': patrol_leader,
-                'num_points': len(patrol_points),
+                'num_points': num_points,
                 'distance_km': line.length * 111
             }
             
             # Add time columns if available
             if time_col:
-                line_data['start_time'] = str(patrol_points[time_col].min())
-                line_data['end_time'] = str(patrol_points[time_col].max())
+                line_data['start_time'] = str(points_gdf[time_col].iloc[order[start]])
+                line_data['end_time'] = str(points_gdf[time_col].iloc[order[end - 1]])
             
             # Add patrol start/end times from metadata if available
             if 'patrol_start_time' in first_point.index:
@@ -338,13 +2678,65 @@ def download_patrol_tracks(er_io, patrol_type_value, since, until, subject_name=
                 if col.startswith('patrol_type__') and col not in line_data:
                     line_data[col] = first_point[col]
             
+            # Segment output: the type, leader and time window come from the segment itself
+            if segment_windows is not None:
+                segment = segment_windows.iloc[sorted_codes[start]]
+                line_data['segment_id'] = segment['segment_id']
+                if segment['segment_type']:
+                    line_data['patrol_type'] = segment_type_names.get(segment['segment_type'], segment['segment_type'])
+                    if 'patrol_type__value' in line_data:
+                        line_data['patrol_type__value'] = segment['segment_type']
+                    if 'patrol_type__display' in line_data:
+                        line_data['patrol_type__display'] = line_data['patrol_type']
+                line_data['subject_name'] = segment['segment_leader'] or patrol_leader
+                line_data['segment_start'] = str(segment['segment_start'])
+                line_data['segment_end'] = str(segment['segment_end']) if pd.notna(segment['segment_end']) else ''
+            
             lines.append(line_data)
+            line_blocks.append(block)
         
         if not lines:
             return None, "No patrols with multiple points found (need at least 2 points to create a line)"
         
+        if effort_resolution_m and outputs is not None:
+            profiler.lap('effort_grid')
+            effort_codes = np.where(sorted_codes >= 0, patrol_codes[order], -1)
+            outputs['effort_grid'] = build_effort_grid(xs, ys, times_ns, effort_codes, effort_resolution_m, aoi=aoi)
+        
         # Create GeoDataFrame from lines
         lines_gdf = gpd.GeoDataFrame(lines, crs=4326)
+        
+        if resample_s or simplify_m:
+            import shapely
+            profiler.lap('simplify_tracks')
+            geometries = lines_gdf.geometry.values
+            if resample_s and times_ns is not None:
+                # Rebuild every line at once from the kept fixes; first and last fixes are always kept
+                line_of_block = np.full(len(block_starts), -1)
+                line_of_block[line_blocks] = np.arange(len(line_blocks))
+                line_of_point = np.repeat(line_of_block, block_ends - block_starts)
+                if part_start is None:
+                    keep = resample_mask(sorted_codes, times_ns, resample_s) & (line_of_point >= 0)
+                    geometries = assemble_tracks(xs[keep], ys[keep], line_of_point[keep])
+                else:
+                    # Resample each gap-separated part on its own so none of them is lost
+                    part_codes = np.cumsum(np.r_[True, sorted_codes[1:] != sorted_codes[:-1]] | part_start)
+                    keep = resample_mask(part_codes, times_ns, resample_s) & (line_of_point >= 0)
+                    geometries = assemble_tracks(xs[keep], ys[keep], line_of_point[keep], part_start[keep])
+            if simplify_m:
+                geometries = simplify_tracks(geometries, simplify_m)
+            lines_gdf = lines_gdf.set_geometry(geometries, crs=4326)
+            lines_gdf['num_vertices'] = shapely.get_num_coordinates(geometries)
+        
+        if track_mode == 'multipart':
+            profiler.lap('merge_segments')
+            lines_gdf = merge_segment_lines(lines_gdf)
+        
+        if aoi is not None:
+            profiler.lap('aoi_clip')
+            lines_gdf = clip_tracks_to_aoi(lines_gdf, aoi)
+            if lines_gdf.empty:
+                return None, "No patrol tracks enter the selected area of interest"
             
         return lines_gdf, None
             
@@ -352,6 +2744,128 @@ def download_patrol_tracks(er_io, patrol_type_value, since, until, subject_name=
         import traceback
         return None, f"{str(e)}\n\n{traceback.format_exc()}"
 
+
+def download_patrol_tracks_from_servers(connections, patrol_type_value, since, until, outputs=None, **kwargs):
+    """
+    Run download_patrol_tracks against every connection concurrently and merge
+    the tracks into one GeoDataFrame with a source_server column. Returns
+    (lines_gdf, error, warnings); servers with no matching patrols only add a warning.
+    Effort grids are merged the same way into outputs['effort_grid'].
+    """
+    server_outputs = {label: {} for label in connections}
+
+    def download(label, er_io):
+        return download_patrol_tracks(
+            er_io, patrol_type_value, since, until, outputs=server_outputs[label], **kwargs
+        )
+
+    results, errors = fan_out(connections, download)
+    warnings = [f"{label}: {message}" for label, message in errors.items()]
+    tracks = {}
+    for label, (lines_gdf, error) in results.items():
+        if error:
+            warnings.append(f"{label}: {error.splitlines()[0]}")
+        else:
+            tracks[label] = lines_gdf
+
+    merged = concat_sources(tracks)
+    if merged is None:
+        return None, "No patrol tracks found on any server\n" + "\n".join(warnings), warnings
+    if outputs is not None:
+        grids = concat_sources({label: out.get('effort_grid') for label, out in server_outputs.items()})
+        if grids is not None:
+            outputs['effort_grid'] = grids
+    return merged, None, warnings
+
+
+SUMMARY_GROUPS = {
+    'subject_name': "Patrol leader",
+    'patrol_type': "Patrol type",
+    'both': "Leader and patrol type",
+}
+SUMMARY_PERIODS = {'W': "Week", 'M': "Month", '': "Whole date range"}
+SUMMARY_FORMATS = {'csv': ('.csv', 'text/csv'),
+                   'parquet': ('.parquet', 'application/vnd.apache.parquet')}
+
+
+def build_patrol_summary(tracks_gdf, events_df=None, group_by='subject_name', period='M'):
+    """
+    Patrols, distance, hours and fixes per period and leader and/or patrol type,
+    in one grouped pass over the downloaded tracks. Hours run from a track's first
+    to last fix, and a track counts towards the week or month it starts in.
+    With events_df (patrol events tagged with patrol_id) an events column is added,
+    each patrol's events counted once on its first track.
+    """
+    group_cols = ['subject_name', 'patrol_type'] if group_by == 'both' else [group_by]
+    key_cols = ['patrol_id']
+    if 'source_server' in tracks_gdf.columns:
+        group_cols = ['source_server'] + group_cols
+        key_cols = ['source_server', 'patrol_id']
+
+    def times(*columns):
+        for col in columns:
+            if col in tracks_gdf.columns:
+                return pd.to_datetime(tracks_gdf[col], utc=True, errors='coerce', format='ISO8601')
+        return pd.Series(pd.NaT, index=tracks_gdf.index, dtype='datetime64[ns, UTC]')
+
+    start = times('start_time', 'patrol_start_time')
+    end = times('end_time', 'patrol_end_time')
+    patrol_codes, patrols = pd.MultiIndex.from_frame(tracks_gdf[key_cols]).factorize()
+
+    frame = pd.DataFrame({col: tracks_gdf[col].fillna('').astype(str) for col in group_cols})
+    if period:
+        frame.insert(0, 'period_start', start.dt.tz_convert(None).dt.to_period(period).dt.start_time.dt.date)
+    keys = list(frame.columns)
+    frame['patrol'] = patrol_codes
+    frame['distance_km'] = tracks_gdf['distance_km'].to_numpy()
+    frame['hours'] = (end - start).dt.total_seconds().to_numpy() / 3600
+    frame['fixes'] = tracks_gdf['num_points'].to_numpy()
+    aggregations = dict(
+        patrols=('patrol', 'nunique'),
+        distance_km=('distance_km', 'sum'),
+        hours=('hours', 'sum'),
+        fixes=('fixes', 'sum'),
+    )
+
+    if events_df is not None:
+        per_patrol = np.zeros(len(patrols), dtype='int64')
+        if not events_df.empty and all(col in events_df.columns for col in key_cols):
+            event_codes = patrols.get_indexer(pd.MultiIndex.from_frame(events_df[key_cols]))
+            per_patrol = np.bincount(event_codes[event_codes >= 0], minlength=len(patrols))
+        first_track = ~pd.Series(patrol_codes).duplicated().to_numpy()
+        frame['events'] = np.where(first_track, per_patrol[patrol_codes], 0)
+        aggregations['events'] = ('events', 'sum')
+
+    summary = frame.groupby(keys, dropna=False, sort=True).agg(**aggregations).reset_index()
+    summary['distance_km'] = summary['distance_km'].round(2)
+    summary['hours'] = summary['hours'].round(2)
+    return summary
+
+
+def patrol_summary_bytes(summary, fmt='csv'):
+    """Serialize a patrol summary as CSV or Parquet"""
+    if fmt == 'parquet':
+        buffer = io.BytesIO()
+        summary.to_parquet(buffer, index=False)
+        return buffer.getvalue()
+    return summary.to_csv(index=False).encode('utf-8')
+
+
+def show_patrol_summary(tracks_gdf, events_df, group_by, period, fmt, base_filename, key):
+    """Render a patrol summary table with its download button"""
+    summary = build_patrol_summary(tracks_gdf, events_df, group_by=group_by, period=period)
+    st.subheader("📊 Patrol summary")
+    st.dataframe(summary, use_container_width=True, hide_index=True)
+    ext, mime = SUMMARY_FORMATS[fmt]
+    st.download_button(
+        label=f"📥 Download patrol summary ({len(summary)} rows)",
+        data=patrol_summary_bytes(summary, fmt),
+        file_name=f"{base_filename}_summary{ext}",
+        mime=mime,
+        use_container_width=True,
+        key=f"patrol_summary_{key}"
+    )
+
 # Main app
 st.title("🗺️ Patrol shapefile downloader")
 st.markdown("Download patrol tracks from EarthRanger as shapefiles, with optional associated events")
@@ -379,6 +2893,7 @@ with st.sidebar:
                     er_io, error = authenticate_earthranger(server, username, password)
                     if er_io:
                         st.session_state.er_io = er_io
+                        st.session_state.er_server = server_label(server)
                         st.session_state.authenticated = True
                         st.success("✅ Successfully authenticated!")
                         st.rerun()
@@ -391,7 +2906,53 @@ with st.sidebar:
         if st.button("Logout"):
             st.session_state.authenticated = False
             st.session_state.er_io = None
+            st.session_state.er_server = None
+            st.session_state.extra_connections = {}
+            st.session_state.diagnostics = {}
             st.rerun()
+        
+        with st.expander("🌍 Additional servers"):
+            st.caption("Log in to more EarthRanger instances to export from all of them at once")
+            for label in list(st.session_state.extra_connections):
+                col_label, col_remove = st.columns([3, 1])
+                col_label.write(label)
+                if col_remove.button("✖", key=f"remove_server_{label}", help=f"Disconnect {label}"):
+                    del st.session_state.extra_connections[label]
+                    st.rerun()
+            extra_server = st.text_input("Instance URL", key="extra_server", placeholder="other.pamdas.org")
+            extra_username = st.text_input("Username", key="extra_username")
+            extra_password = st.text_input("Password", type="password", key="extra_password")
+            if st.button("Add server"):
+                if extra_server and extra_username and extra_password:
+                    server = extra_server if extra_server.startswith('http') else f'https://{extra_server}'
+                    label = server_label(server)
+                    if label in get_connections():
+                        st.warning(f"Already connected to {label}")
+                    else:
+                        with st.spinner(f"Authenticating with {label}..."):
+                            er_io, error = authenticate_earthranger(server, extra_username, extra_password)
+                        if er_io:
+                            st.session_state.extra_connections[label] = er_io
+                            st.rerun()
+                        else:
+                            st.error(f"❌ Authentication failed: {error}")
+                else:
+                    st.warning("Please fill in all fields")
+        
+        fetch_fresh = st.checkbox(
+            "🔄 Fetch fresh data",
+            help="Re-fetch everything from EarthRanger instead of reusing responses cached in the last "
+                 f"{RESPONSE_CACHE_TTL_S // 60} minutes. Today's data and open patrols are always fetched fresh."
+        )
+        for er_io in get_connections().values():
+            if isinstance(er_io, CachedEarthRangerIO):
+                er_io.refresh = fetch_fresh
+        
+        st.checkbox(
+            "🩺 Record diagnostics",
+            key="diagnostics_enabled",
+            help="Record time, API calls, data transferred and peak memory for each step of an export. Adds some overhead."
+        )
 
 # Main content - only show if authenticated
 if st.session_state.authenticated:
@@ -420,46 +2981,40 @@ if st.session_state.authenticated:
     st.markdown("---")
     st.subheader("2️⃣ Select filters (optional)")
     
+    # With extra servers connected, filters and exports can cover all of them
+    connections = get_connections()
+    all_servers = len(connections) > 1 and st.checkbox(
+        f"🌍 Export from all connected servers ({len(connections)})",
+        value=True,
+        help="Fetch from every connected EarthRanger instance concurrently and merge the results, "
+             "with a source_server column"
+    )
+    export_connections = connections if all_servers else {st.session_state.er_server or 'primary': st.session_state.er_io}
+    
     # Now load patrol types and leaders from actual patrols in the date range
     col3, col4 = st.columns(2)
     
     with st.spinner("Loading available filters from patrol data..."):
         try:
-            # Fetch patrols in the date range
-            sample_patrols = st.session_state.er_io.get_patrols(
-                since=since,
-                until=until,
-                status=['done', 'active']
-            )
+            # Options come from the persisted filter index; only date ranges it
+            # has not seen yet are fetched here, recent changes refresh in the background
+            index_frames = []
+            for er_io in export_connections.values():
+                filter_index = get_filter_index(getattr(er_io, 'service_root', ''), getattr(er_io, 'username', ''))
+                filter_index.ensure(er_io, since, until)
+                filter_index.refresh_in_background(er_io)
+                index_frames.append(filter_index.patrols_in_range(since, until))
+            index_patrols = pd.concat(index_frames, ignore_index=True)
             
-            if not sample_patrols.empty:
-                # Extract patrol types from actual patrols
-                def get_patrol_type(row):
-                    if 'patrol_segments' in row and isinstance(row['patrol_segments'], list) and len(row['patrol_segments']) > 0:
-                        segment = row['patrol_segments'][0]
-                        if isinstance(segment, dict) and 'patrol_type' in segment:
-                            return segment['patrol_type']
-                    return None
-                
-                # Extract patrol leaders from actual patrols
-                def get_patrol_subject(row):
-                    if 'patrol_segments' in row and isinstance(row['patrol_segments'], list):
-                        for segment in row['patrol_segments']:
-                            if isinstance(segment, dict):
-                                leader = segment.get('leader', {})
-                                if isinstance(leader, dict):
-                                    return leader.get('name', '')
-                    return ''
-                
-                sample_patrols['patrol_type_extracted'] = sample_patrols.apply(get_patrol_type, axis=1)
-                sample_patrols['leader_name'] = sample_patrols.apply(get_patrol_subject, axis=1)
+            if not index_patrols.empty:
+                st.caption(f"📊 {len(index_patrols)} patrol(s) in the selected date range")
                 
                 # Get unique patrol types (filter out None/empty)
-                patrol_types = sample_patrols['patrol_type_extracted'].dropna().unique().tolist()
+                patrol_types = index_patrols['patrol_type'].dropna().unique().tolist()
                 patrol_types = sorted([pt for pt in patrol_types if pt and str(pt).strip()])
                 
                 # Get unique leader names (filter out empty)
-                leader_names = sample_patrols['leader_name'].dropna().unique().tolist()
+                leader_names = index_patrols['leader'].dropna().unique().tolist()
                 leader_names = sorted([name for name in leader_names if name and str(name).strip()])
                 
                 with col3:
@@ -470,7 +3025,9 @@ if st.session_state.authenticated:
                             default=patrol_types,
                             help="Select one or more patrol types, or leave empty for all"
                         )
-                        patrol_type = selected_patrol_types if selected_patrol_types else None
+                        # Every type selected means no filter, so patrols missing from the index still export
+                        all_types = set(selected_patrol_types) >= set(patrol_types)
+                        patrol_type = selected_patrol_types if selected_patrol_types and not all_types else None
                     else:
                         st.warning("No patrol types found in date range")
                         patrol_type = None
@@ -483,7 +3040,8 @@ if st.session_state.authenticated:
                             default=leader_names,
                             help="Select one or more patrol leaders, or leave empty for all"
                         )
-                        subject_name_filter = selected_leaders if selected_leaders else None
+                        all_leaders = set(selected_leaders) >= set(leader_names)
+                        subject_name_filter = selected_leaders if selected_leaders and not all_leaders else None
                     else:
                         st.warning("No patrol leaders found in date range")
                         subject_name_filter = None
@@ -496,18 +3054,153 @@ if st.session_state.authenticated:
             patrol_type = None
             subject_name_filter = None
     
+    # Optional area of interest - narrows tracks and events to one site
+    col_aoi1, col_aoi2 = st.columns(2)
+    with col_aoi1:
+        aoi_file = st.file_uploader(
+            "Area of interest (optional)",
+            type=['geojson', 'json', 'zip'],
+            help="Polygon GeoJSON or zipped shapefile. Tracks are clipped to it and events outside it are dropped"
+        )
+    with col_aoi2:
+        aoi_bbox = st.text_input(
+            "Or bounding box (optional)",
+            placeholder="min_lon, min_lat, max_lon, max_lat",
+            help="Used when no area of interest file is uploaded"
+        )
+    try:
+        aoi = load_aoi(aoi_file, aoi_bbox)
+    except ValueError as e:
+        st.error(f"❌ {e}")
+        aoi = None
+    
+    # Export options shared by the download sections below
+    with st.expander("⚙️ Export options"):
+        compression_options = [None, 'gzip'] + (['zstd'] if HAS_ZSTD else [])
+        csv_compression = st.selectbox(
+            "Events CSV compression",
+            options=compression_options,
+            format_func=lambda c: "None (.csv)" if c is None else f"{c} ({CSV_FORMATS[c][0]})",
+            help="Compressed CSVs are much smaller to download and to hold in server memory; "
+                 "most spreadsheet tools need them unzipped first"
+        )
+        flatten_workers = st.number_input(
+            "Event flattening processes",
+            min_value=1, max_value=os.cpu_count() or 1, value=1, step=1,
+            help=f"Flatten very large event exports ({PARALLEL_FLATTEN_MIN_ROWS:,}+ events) on several CPU cores; "
+                 "1 flattens in the app process"
+        )
+        col_thin1, col_thin2 = st.columns(2)
+        with col_thin1:
+            simplify_m = st.number_input(
+                "Simplify tracks (tolerance, m)",
+                min_value=0, max_value=1000, value=0, step=5,
+                help="Drop vertices that move the track by less than this; 0 keeps every fix"
+            )
+        with col_thin2:
+            resample_s = st.number_input(
+                "Resample tracks (one fix per N seconds)",
+                min_value=0, max_value=3600, value=0, step=30,
+                help="Keep at most one fix per interval; 0 keeps every fix"
+            )
+        col_clean1, col_clean2 = st.columns(2)
+        with col_clean1:
+            max_speed_kmh = st.number_input(
+                "Drop GPS spikes faster than (km/h)",
+                min_value=0, max_value=1000, value=0, step=10,
+                help="Fixes reached and left above this speed are dropped as GPS errors; 0 keeps every fix"
+            )
+        with col_clean2:
+            max_gap_min = st.number_input(
+                "Split tracks at gaps longer than (minutes)",
+                min_value=0, max_value=1440, value=0, step=5,
+                help="Tracks become multi-part lines instead of joining fixes across long gaps; 0 never splits"
+            )
+        track_mode = st.selectbox(
+            "Track output",
+            options=list(TRACK_MODES),
+            format_func=TRACK_MODES.get,
+            help="Per-segment output keeps patrols with several leaders or types from being joined across segment gaps"
+        )
+        effort_enabled = st.checkbox(
+            "Build patrol-effort grid with the patrol tracks",
+            help="Cells visited, hours and distance per grid cell - much lighter than the full tracks for coverage maps"
+        )
+        col_effort1, col_effort2 = st.columns(2)
+        with col_effort1:
+            effort_resolution_m = st.selectbox(
+                "Grid cell size (m)",
+                options=EFFORT_RESOLUTIONS_M,
+                index=EFFORT_RESOLUTIONS_M.index(1000),
+                disabled=not effort_enabled
+            )
+        with col_effort2:
+            effort_format = st.selectbox(
+                "Grid format",
+                options=['geoparquet'] + (['geotiff'] if HAS_RASTERIO else []),
+                format_func=lambda f: {'geoparquet': 'GeoParquet (.parquet)', 'geotiff': 'GeoTIFF (.tif)'}[f],
+                disabled=not effort_enabled,
+                help="GeoTIFF needs rasterio installed on the server"
+            )
+        summary_enabled = st.checkbox(
+            "Build patrol summary report with the patrol tracks",
+            help="Patrols, km, hours and fixes per leader or patrol type and period; "
+                 "event counts are added when patrol events are extracted"
+        )
+        col_summary1, col_summary2, col_summary3 = st.columns(3)
+        with col_summary1:
+            summary_group = st.selectbox(
+                "Summarise by",
+                options=list(SUMMARY_GROUPS),
+                format_func=SUMMARY_GROUPS.get,
+                disabled=not summary_enabled
+            )
+        with col_summary2:
+            summary_period = st.selectbox(
+                "Summary period",
+                options=list(SUMMARY_PERIODS),
+                index=1,
+                format_func=SUMMARY_PERIODS.get,
+                disabled=not summary_enabled
+            )
+        with col_summary3:
+            summary_format = st.selectbox(
+                "Summary format",
+                options=list(SUMMARY_FORMATS),
+                format_func=lambda f: {'csv': 'CSV (.csv)', 'parquet': 'Parquet (.parquet)'}[f],
+                disabled=not summary_enabled
+            )
+
     st.markdown("---")
     
     # Download button for patrol tracks
     if st.button("🔽 Download patrol tracks", type="primary", use_container_width=True):
-        with st.spinner("Downloading patrol tracks..."):
-            gdf, error = download_patrol_tracks(
-                st.session_state.er_io,
-                patrol_type,
-                since,
-                until,
-                subject_name=subject_name_filter if subject_name_filter else None
+        with st.spinner("Downloading patrol tracks..."), export_profiler('patrol_tracks') as profiler:
+            track_outputs = {}
+            track_options = dict(
+                subject_name=subject_name_filter if subject_name_filter else None,
+                aoi=aoi,
+                effort_resolution_m=effort_resolution_m if effort_enabled else None,
+                outputs=track_outputs,
+                simplify_m=simplify_m or None,
+                resample_s=resample_s or None,
+                track_mode=track_mode,
+                max_speed_kmh=max_speed_kmh or None,
+                max_gap_s=max_gap_min * 60 or None
             )
+            if len(export_connections) > 1:
+                # Per-stage timings are not split by server when fanning out
+                profiler.lap('download_from_servers')
+                gdf, error, server_warnings = download_patrol_tracks_from_servers(
+                    export_connections, patrol_type, since, until, **track_options
+                )
+                for warning in server_warnings:
+                    st.warning(f"⚠️ {warning}")
+            else:
+                gdf, error = download_patrol_tracks(
+                    st.session_state.er_io, patrol_type, since, until, profiler=profiler, **track_options
+                )
+            profiler.lap('render_preview')
             
             if error:
                 st.error(f"❌ Error: {error}")
@@ -521,6 +3214,9 @@ if st.session_state.authenticated:
                 st.subheader("📍 Map preview")
                 if HAS_FOLIUM:
                     try:
+                        import folium
+                        from streamlit_folium import folium_static
+
                         # Calculate center point
                         bounds = gdf.total_bounds  # [minx, miny, maxx, maxy]
                         center_lat = (bounds[1] + bounds[3]) / 2
@@ -533,10 +3229,12 @@ if st.session_state.authenticated:
                         colors = ['blue', 'red', 'green', 'purple', 'orange', 'darkred', 'lightred', 'beige', 'darkblue', 'darkgreen']
                         for idx, row in gdf.iterrows():
                             color = colors[idx % len(colors)]
-                            coords = [(coord[1], coord[0]) for coord in row.geometry.coords]  # lat, lon
+                            parts = track_latlon_parts(row.geometry)  # lat, lon
+                            if not parts:
+                                continue
                             
                             folium.PolyLine(
-                                coords,
+                                parts if len(parts) > 1 else parts[0],
                                 color=color,
                                 weight=3,
                                 opacity=0.8,
@@ -545,7 +3243,7 @@ if st.session_state.authenticated:
                             
                             # Add start marker
                             folium.CircleMarker(
-                                coords[0],
+                                parts[0][0],
                                 radius=5,
                                 color=color,
                                 fill=True,
@@ -554,7 +3252,7 @@ if st.session_state.authenticated:
                             
                             # Add end marker
                             folium.CircleMarker(
-                                coords[-1],
+                                parts[-1][-1],
                                 radius=5,
                                 color=color,
                                 fill=True,
@@ -577,8 +3275,8 @@ if st.session_state.authenticated:
                 st.subheader("Data preview")
                 # Create display DataFrame without geometry and some redundant columns
                 cols_to_drop = ['geometry', 'start_time', 'end_time']
-                display_df = gdf.drop(columns=[col for col in cols_to_drop if col in gdf.columns]).copy()
-                st.dataframe(display_df)
+                display_df = gdf.drop(columns=[col for col in cols_to_drop if col in gdf.columns])
+                show_data_preview(display_df, 'tracks')
                 
                 # Show summary statistics
                 col5, col6, col7 = st.columns(3)
@@ -594,16 +3292,7 @@ if st.session_state.authenticated:
                     # Format filename: patroltype_yymmdd_yymmdd
                     start_str = start_date.strftime('%y%m%d')
                     end_str = end_date.strftime('%y%m%d')
-                    # Clean patrol type for filename (remove spaces, special chars)
-                    if patrol_type:
-                        if isinstance(patrol_type, list):
-                            # Multiple patrol types - join them
-                            patrol_type_clean = "_".join("".join(c if c.isalnum() else "_" for c in pt) for pt in patrol_type[:3])  # Limit to first 3 to avoid too long filename
-                        else:
-                            patrol_type_clean = "".join(c if c.isalnum() else "_" for c in patrol_type)
-                    else:
-                        patrol_type_clean = "all_patrols"
-                    base_filename = f"{patrol_type_clean}_{start_str}_{end_str}"
+                    base_filename = f"{patrol_type_filename(patrol_type)}_{start_str}_{end_str}"
                     
                     # Prepare shapefile-friendly column names (max 10 chars)
                     # Rename columns: patrol → ptrl to save characters
@@ -617,38 +3306,53 @@ if st.session_state.authenticated:
                         'patrol_start_time': 'ptrl_start',
                         'patrol_end_time': 'ptrl_end',
                         'distance_km': 'dist_km',
-                        'num_points': 'num_pts'
+                        'aoi_dist_km': 'aoi_km',
+                        'num_points': 'num_pts',
+                        'num_vertices': 'num_vtx',
+                        'segment_id': 'seg_id',
+                        'segment_start': 'seg_start',
+                        'segment_end': 'seg_end',
+                        'num_segments': 'num_segs',
+                        'source_server': 'source_srv'
                     }
                     # Only rename columns that exist
                     gdf_export = gdf_export.rename(columns={k: v for k, v in column_mapping.items() if k in gdf_export.columns})
                     
-                    with tempfile.TemporaryDirectory() as tmpdir:
-                        shapefile_path = os.path.join(tmpdir, f"{base_filename}.shp")
-                        gdf_export.to_file(shapefile_path)
-                        
-                        # Create a zip file with all shapefile components
-                        zip_path = os.path.join(tmpdir, f"{base_filename}.zip")
-                        
-                        with zipfile.ZipFile(zip_path, 'w') as zipf:
-                            for ext in ['.shp', '.shx', '.dbf', '.prj', '.cpg']:
-                                file_path = shapefile_path.replace('.shp', ext)
-                                if os.path.exists(file_path):
-                                    # Add files to zip with the base filename
-                                    zipf.write(file_path, f"{base_filename}{ext}")
-                        
-                        # Read the zip file for download
-                        with open(zip_path, 'rb') as f:
-                            zip_data = f.read()
-                        
+                    profiler.lap('to_file')
+                    zip_data = build_shapefile_zip(gdf_export, base_filename)
+                    
+                    st.download_button(
+                        label="📥 Download Shapefile (ZIP)",
+                        data=zip_data,
+                        file_name=f"{base_filename}.zip",
+                        mime="application/zip",
+                        use_container_width=True
+                    )
+                except Exception as e:
+                    st.error(f"❌ Error creating shapefile: {e}")
+                
+                effort_grid = track_outputs.get('effort_grid')
+                if effort_grid is not None and not effort_grid.empty:
+                    try:
+                        profiler.lap('effort_grid_file')
+                        ext, mime = EFFORT_GRID_FORMATS[effort_format]
                         st.download_button(
-                            label="📥 Download Shapefile (ZIP)",
-                            data=zip_data,
-                            file_name=f"{base_filename}.zip",
-                            mime="application/zip",
+                            label=f"📥 Download patrol-effort grid ({len(effort_grid)} cells)",
+                            data=effort_grid_bytes(effort_grid, effort_format),
+                            file_name=f"{base_filename}_effort_{effort_resolution_m}m{ext}",
+                            mime=mime,
                             use_container_width=True
                         )
-                except Exception as e:
-                    st.error(f"❌ Error creating shapefile: {e}")
+                    except Exception as e:
+                        st.error(f"❌ Error creating patrol-effort grid: {e}")
+
+                if summary_enabled:
+                    try:
+                        profiler.lap('patrol_summary')
+                        show_patrol_summary(gdf, None, summary_group, summary_period, summary_format,
+                                            base_filename, key='tracks')
+                    except Exception as e:
+                        st.error(f"❌ Error creating patrol summary: {e}")
     
     # Events extraction section
     st.markdown("---")
@@ -662,395 +3366,185 @@ if st.session_state.authenticated:
         # Show available patrols
         st.write(f"Found {len(gdf_patrols)} patrol(s) to extract events from")
         
+        event_map_mode = st.selectbox(
+            "Event map",
+            options=list(EVENT_MAP_MODES),
+            format_func=EVENT_MAP_MODES.get,
+            help="Clusters open into individual events as you zoom; the heat map keeps very large exports responsive"
+        )
+        
         # Button to extract events
         if st.button("📥 Extract patrol events", type="primary", use_container_width=True):
-            with st.spinner("Extracting events from patrols..."):
+            start_str = start_date.strftime('%y%m%d')
+            end_str = end_date.strftime('%y%m%d')
+            base_filename = f"{patrol_type_filename(patrol_type)}_events_{start_str}_{end_str}"
+            events_csv = EventsCSVWriter(base_filename, EVENT_OUTPUT_EXCLUDED, EVENT_RENAME, compression=csv_compression)
+            with st.spinner("Extracting events from patrols..."), export_profiler('patrol_events') as profiler, events_csv:
                 try:
-                    # Get the original patrols dataframe with patrol_segments
-                    # Use patrol_type_value instead of patrol_type since we have the value, not UUID
-                    patrols_df = st.session_state.er_io.get_patrols(
-                        since=since,
-                        until=until,
-                        patrol_type_value=patrol_type,
-                        status=['done', 'active']
-                    )
+                    import geopandas as gpd
+
+                    # Subject names for UUID resolution download alongside the events
+                    lookup_pool = ThreadPoolExecutor(max_workers=1)
+                    lookup_future = lookup_pool.submit(build_subject_lookups, export_connections)
+                    lookup_pool.shutdown(wait=False)
+                    
+                    # Each segment is filtered, decoded, snapped and flattened as it
+                    # arrives, then has its UUIDs resolved and is written to the CSV
+                    # and the map points, while the following segments are still
+                    # downloading. Only the on-screen preview and summary combine them.
+                    profiler.lap('get_patrol_segment_events')
+                    snap_index = track_segment_index(gdf_patrols)
+                    preview_blocks, map_blocks = [], []
+                    sink_lock = threading.Lock()  # Servers are fetched on separate threads
                     
-                    # Filter to only the patrol IDs we have in our downloaded tracks
-                    patrol_ids = gdf_patrols['patrol_id'].unique().tolist()
-                    patrols_df = patrols_df[patrols_df['id'].isin(patrol_ids)].copy()
+                    def prepare(events):
+                        return prepare_patrol_events(events, gdf_patrols, aoi, snap_index)
                     
-                    if patrols_df.empty:
-                        st.warning("No matching patrols found")
+                    def collect(events):
+                        uuid_to_name = lookup_future.result()
+                        points = event_map_points(events)
+                        with sink_lock:
+                            preview_blocks.append(events_csv.write(events, uuid_to_name))
+                            map_blocks.append(points)
+                    
+                    # Events are fetched by the server each patrol came from, all servers at once
+                    if 'source_server' in gdf_patrols.columns and len(export_connections) > 1:
+                        results, errors = fan_out(
+                            export_connections,
+                            lambda label, er_io: fetch_patrol_events(
+                                er_io, gdf_patrols[gdf_patrols['source_server'] == label], since, until, patrol_type,
+                                transform=prepare, sink=lambda events: collect(events.assign(source_server=label))
+                            )
+                        )
+                        fetch_warnings = [f"{label}: {message}" for label, message in errors.items()]
+                        for label, (_, server_warnings) in results.items():
+                            fetch_warnings += [f"{label}: {warning}" for warning in server_warnings]
                     else:
-                        # Get events using get_events with patrol segments to include full details
-                        try:
-                            # Extract all patrol segment IDs from the matched patrols
-                            # Also create mappings for patrol_id, patrol_name, and subject/leader name
-                            patrol_segment_ids = []
-                            segment_to_patrol_map = {}  # Maps segment_id -> patrol_id
-                            segment_to_patrol_name_map = {}  # Maps segment_id -> patrol_name/title
-                            segment_to_subject_map = {}  # Maps segment_id -> subject/leader name
-                            
-                            for _, patrol in patrols_df.iterrows():
-                                patrol_id = patrol['id']
-                                patrol_name = patrol.get('title', patrol.get('serial_number', ''))
-                                
-                                # Extract leader/subject name from first segment
-                                leader_name = ''
-                                for segment in patrol.get('patrol_segments', []):
-                                    if 'id' in segment:
-                                        segment_id = segment['id']
-                                        patrol_segment_ids.append(segment_id)
-                                        segment_to_patrol_map[segment_id] = patrol_id
-                                        segment_to_patrol_name_map[segment_id] = patrol_name
-                                        
-                                        # Extract leader name if not already extracted
-                                        if not leader_name and 'leader' in segment:
-                                            leader_data = segment['leader']
-                                            if isinstance(leader_data, dict):
-                                                leader_name = leader_data.get('name', leader_data.get('username', ''))
-                                            else:
-                                                leader_name = str(leader_data) if leader_data else ''
-                                        
-                                        segment_to_subject_map[segment_id] = leader_name
-                            
-                            if not patrol_segment_ids:
-                                st.warning("No patrol segments found")
-                                events_combined = gpd.GeoDataFrame()
-                            else:
-                                # Get events for each patrol segment with full details
-                                all_events = []
-                                progress_bar = st.progress(0)
-                                status_text = st.empty()
-                                
-                                for idx, segment_id in enumerate(patrol_segment_ids):
-                                    status_text.text(f"Processing segment {idx + 1}/{len(patrol_segment_ids)}...")
+                        progress_bar = st.progress(0)
+                        status_text = st.empty()
+                        
+                        def show_progress(fraction, message):
+                            progress_bar.progress(fraction)
+                            status_text.text(message)
+                        
+                        _, fetch_warnings = fetch_patrol_events(
+                            st.session_state.er_io, gdf_patrols, since, until, patrol_type,
+                            on_progress=show_progress, transform=prepare, sink=collect
+                        )
+                        progress_bar.empty()
+                        status_text.empty()
+                    for warning in fetch_warnings:
+                        st.warning(warning)
+                    
+                    if preview_blocks:
+                        events_combined = gpd.GeoDataFrame(pd.concat(preview_blocks, ignore_index=True))
+                        events_combined = events_combined.drop(columns=events_csv.rejected_name_columns(), errors='ignore')
+                    else:
+                        events_combined = gpd.GeoDataFrame()
+                    
+                    try:
+                        if events_combined.empty:
+                            st.info("No events found for these patrols")
+                        else:
+                                st.success(f"✅ Successfully extracted {len(events_combined)} event(s)!")
+                                profiler.lap('render_preview')
+
+                                # Display map preview with both patrols and events
+                                st.subheader("📍 Events map preview")
+                                if HAS_FOLIUM:
                                     try:
-                                        # Use get_patrol_segment_events which correctly filters to patrol segment
-                                        events_df = st.session_state.er_io.get_patrol_segment_events(
-                                            patrol_segment_id=segment_id,
-                                            include_details=True,
-                                            include_notes=True,
-                                            include_related_events=False,
-                                            include_files=False
-                                        )
+                                        import folium
+                                        from streamlit_folium import folium_static
+
+                                        # Calculate center point from events
+                                        event_points = pd.concat(map_blocks, ignore_index=True)
+                                        events_bounds = [event_points['lon'].min(), event_points['lat'].min(),
+                                                         event_points['lon'].max(), event_points['lat'].max()]
+                                        center_lat = (events_bounds[1] + events_bounds[3]) / 2
+                                        center_lon = (events_bounds[0] + events_bounds[2]) / 2
                                         
-                                        if not events_df.empty:
-                                            # Add patrol_id, patrol_name, and patrol_leader from our mappings
-                                            events_df['patrol_id'] = segment_to_patrol_map.get(segment_id, '')
-                                            events_df['patrol_name'] = segment_to_patrol_name_map.get(segment_id, '')
-                                            events_df['patrol_leader'] = segment_to_subject_map.get(segment_id, '')
-                                            
-                                            # Convert to GeoDataFrame with geometry from geojson
-                                            def extract_geometry(row):
-                                                if 'geojson' in row and row['geojson']:
-                                                    try:
-                                                        if isinstance(row['geojson'], dict):
-                                                            return shape(row['geojson'])
-                                                    except:
-                                                        pass
-                                                return None
-                                            
-                                            events_df['geometry'] = events_df.apply(extract_geometry, axis=1)
-                                            # Filter out events without geometry
-                                            events_gdf = events_df[events_df['geometry'].notna()].copy()
-                                            
-                                            if events_gdf.empty:
-                                                status_text.text(f"Segment {idx + 1}/{len(patrol_segment_ids)}: No events with valid geometry")
+                                        # Create map
+                                        m = folium.Map(location=[center_lat, center_lon], zoom_start=12)
+                                        
+                                        # Add patrol tracks
+                                        patrol_colors = ['blue', 'darkblue', 'lightblue', 'cadetblue']
+                                        for idx, row in gdf_patrols.iterrows():
+                                            color = patrol_colors[idx % len(patrol_colors)]
+                                            parts = track_latlon_parts(row.geometry)  # lat, lon
+                                            if not parts:
                                                 continue
                                             
-                                            events_gdf = gpd.GeoDataFrame(events_gdf, geometry='geometry', crs=4326)
-                                            
-                                            # Now fetch full details for each event by event ID (only if 'id' column exists)
-                                            has_details = False
-                                            if 'id' in events_gdf.columns and len(events_gdf) > 0:
-                                                event_ids = events_gdf['id'].tolist()
-                                                # Filter out any None or NaN values
-                                                event_ids = [eid for eid in event_ids if eid and pd.notna(eid)]
-                                                
-                                                if event_ids:
-                                                    status_text.text(f"Segment {idx + 1}/{len(patrol_segment_ids)}: Fetching details for {len(event_ids)} events...")
-                                                    
-                                                    # Batch event IDs to avoid URL length limits (414 error)
-                                                    # Process in chunks of 50 event IDs at a time
-                                                    batch_size = 50
-                                                    detailed_events_list = []
-                                                    
-                                                    for batch_idx in range(0, len(event_ids), batch_size):
-                                                        batch_event_ids = event_ids[batch_idx:batch_idx + batch_size]
-                                                        try:
-                                                            # Fetch events with details using event IDs
-                                                            detailed_events_batch = st.session_state.er_io.get_events(
-                                                                event_ids=batch_event_ids,
-                                                                include_details=True,
-                                                                include_notes=True
-                                                            )
-                                                            if not detailed_events_batch.empty:
-                                                                detailed_events_list.append(detailed_events_batch)
-                                                        except Exception as batch_err:
-                                                            st.warning(f"Could not fetch details for event batch {batch_idx//batch_size + 1}: {str(batch_err)[:100]}")
-                                                    
-                                                    # Combine all batches
-                                                    if detailed_events_list:
-                                                        detailed_events = pd.concat(detailed_events_list, ignore_index=True)
-                                                        
-                                                        if not detailed_events.empty and 'event_details' in detailed_events.columns and 'id' in detailed_events.columns:
-                                                            # Merge event_details back into events_gdf
-                                                            # Reset index to use 'id' for merging
-                                                            try:
-                                                                detailed_events_subset = detailed_events[['id', 'event_details']].copy()
-                                                                events_gdf = events_gdf.merge(detailed_events_subset, on='id', how='left')
-                                                                has_details = True
-                                                            except Exception as merge_err:
-                                                                st.warning(f"Could not merge event details: {str(merge_err)[:100]}")
-                                                                has_details = False
-                                            
-                                            status_text.text(f"Segment {idx + 1}/{len(patrol_segment_ids)}: Found {len(events_gdf)} events (details: {has_details})")
-                                            all_events.append(events_gdf)
-                                        else:
-                                            status_text.text(f"Segment {idx + 1}/{len(patrol_segment_ids)}: No events")
-                                    except Exception as e:
-                                        status_text.text(f"Segment {idx + 1}/{len(patrol_segment_ids)}: Error - {str(e)[:50]}")
-                                        st.warning(f"Could not get events for segment {segment_id}: {e}")
-                                    
-                                    progress_bar.progress((idx + 1) / len(patrol_segment_ids))
-                                
-                                progress_bar.empty()
-                                status_text.empty()
-                                
-                                # Combine all events
-                                if all_events:
-                                    events_combined = gpd.GeoDataFrame(pd.concat(all_events, ignore_index=True))
-                                else:
-                                    events_combined = gpd.GeoDataFrame()
-                            
-                            if events_combined.empty:
-                                st.info("No events found for these patrols")
-                            else:
-                                    st.success(f"✅ Successfully extracted {len(events_combined)} event(s)!")
-                                    
-                                    # Extract coordinates from geometry
-                                    if 'geometry' in events_combined.columns:
-                                        events_combined['longitude'] = events_combined.geometry.x
-                                        events_combined['latitude'] = events_combined.geometry.y
-                                    
-                                    
-                                    # Extract time from geojson.properties.datetime if time column doesn't exist
-                                    if 'time' not in events_combined.columns and 'geojson' in events_combined.columns:
-                                        def extract_datetime(geojson):
-                                            if isinstance(geojson, dict):
-                                                props = geojson.get('properties', {})
-                                                if isinstance(props, dict):
-                                                    dt_str = props.get('datetime')
-                                                    if dt_str:
-                                                        return pd.to_datetime(dt_str, utc=True)
-                                            return None
-                                        events_combined['time'] = events_combined['geojson'].apply(extract_datetime)
-                                    
-                                    # Extract reported_by name and UUID (subject_name / subject_id)
-                                    if 'reported_by' in events_combined.columns:
-                                        events_combined['subject_name'] = events_combined['reported_by'].apply(
-                                            lambda x: x.get('name', '') if isinstance(x, dict) else ''
-                                        )
-                                        if 'subject_id' not in events_combined.columns:
-                                            events_combined['subject_id'] = events_combined['reported_by'].apply(
-                                                lambda x: x.get('id', '') if isinstance(x, dict) else ''
-                                            )
-                                    
-                                    # Unnest event_details
-                                    if 'event_details' in events_combined.columns:
-                                        # Extract event_details fields into separate columns
-                                        event_details_df = pd.json_normalize(events_combined['event_details'])
-                                        # Add prefix to avoid column name conflicts
-                                        event_details_df.columns = ['detail_' + col for col in event_details_df.columns]
-                                        # Combine with main dataframe - preserve geometry
-                                        geometry_col = events_combined.geometry
-                                        events_combined = pd.concat([events_combined.reset_index(drop=True), event_details_df], axis=1)
-                                        # Restore as GeoDataFrame
-                                        events_combined = gpd.GeoDataFrame(events_combined, geometry=geometry_col.reset_index(drop=True), crs=4326)
-
-                                    # Resolve UUIDs in detail_ columns to display names
-                                    with st.spinner("Resolving subject names for event detail fields..."):
-                                        uuid_to_name = build_subject_lookup(st.session_state.er_io)
-                                    events_combined = resolve_uuid_columns(events_combined, uuid_to_name, col_prefix='')
-
-                                    # Extract coordinates from location dict if it exists
-                                    if 'location' in events_combined.columns:
-                                        events_combined['location_lat'] = events_combined['location'].apply(
-                                            lambda x: x.get('latitude') if isinstance(x, dict) else None
-                                        )
-                                        events_combined['location_lon'] = events_combined['location'].apply(
-                                            lambda x: x.get('longitude') if isinstance(x, dict) else None
-                                        )
-                                    
-                                    # Display map preview with both patrols and events
-                                    st.subheader("📍 Events map preview")
-                                    if HAS_FOLIUM:
-                                        try:
-                                            # Calculate center point from events
-                                            events_bounds = events_combined.total_bounds  # [minx, miny, maxx, maxy]
-                                            center_lat = (events_bounds[1] + events_bounds[3]) / 2
-                                            center_lon = (events_bounds[0] + events_bounds[2]) / 2
-                                            
-                                            # Create map
-                                            m = folium.Map(location=[center_lat, center_lon], zoom_start=12)
-                                            
-                                            # Add patrol tracks
-                                            patrol_colors = ['blue', 'darkblue', 'lightblue', 'cadetblue']
-                                            for idx, row in gdf_patrols.iterrows():
-                                                color = patrol_colors[idx % len(patrol_colors)]
-                                                coords = [(coord[1], coord[0]) for coord in row.geometry.coords]  # lat, lon
-                                                
-                                                folium.PolyLine(
-                                                    coords,
-                                                    color=color,
-                                                    weight=3,
-                                                    opacity=0.6,
-                                                    popup=f"Patrol: {row.get('patrol_sn', 'N/A')}",
-                                                ).add_to(m)
-                                            
-                                            # Add event markers
-                                            event_colors = {
-                                                'default': 'red'
-                                            }
-                                            
-                                            for idx, row in events_combined.iterrows():
-                                                lat = row.geometry.y
-                                                lon = row.geometry.x
-                                                
-                                                # Get event type for popup
-                                                event_type = row.get('event_type', 'Event')
-                                                event_time = row.get('time', 'N/A')
-                                                patrol_sn = row.get('patrol_serial_number', 'N/A')
-                                                
-                                                popup_text = f"<b>{event_type}</b><br>Time: {event_time}<br>Patrol: {patrol_sn}"
-                                                
-                                                folium.CircleMarker(
-                                                    location=[lat, lon],
-                                                    radius=6,
-                                                    color='red',
-                                                    fill=True,
-                                                    fillColor='red',
-                                                    fillOpacity=0.7,
-                                                    popup=popup_text,
-                                                ).add_to(m)
-                                            
-                                            # Fit bounds to show both patrols and events
-                                            all_bounds = [
-                                                [events_bounds[1], events_bounds[0]], 
-                                                [events_bounds[3], events_bounds[2]]
-                                            ]
-                                            m.fit_bounds(all_bounds)
-                                            
-                                            # Display map
-                                            folium_static(m, width=800, height=500)
-                                            
-                                        except Exception as e:
-                                            st.warning(f"Could not create map preview: {e}")
-                                    else:
-                                        st.info("💡 Install folium and streamlit-folium to see map preview")
-                                    
-                                    # Display data preview
-                                    st.subheader("Events data preview")
-                                    # Create display DataFrame without geometry and geojson
-                                    display_cols = [col for col in events_combined.columns if col not in ['geometry', 'geojson']]
-                                    display_df = events_combined[display_cols].copy()
-                                    
-                                    # Clean up the display
-                                    # Remove unwanted columns
-                                    cols_to_remove = ['level_8', 'index', 'location', 'reported_by', 'event_details', 
-                                                     'geojson', 'attributes', 'notes', 'patrols', 'patrol_segments',
-                                                     'is_contained_in', 'related_subjects',
-                                                     'location_lat', 'location_lon', 'message', 'provenance',
-                                                     'event_category', 'priority_label', 'comment', 'end_time',
-                                                     'sort_at', 'icon_id', 'url', 'image_url', 'external_source']
-                                    display_df = display_df.drop(columns=[col for col in cols_to_remove if col in display_df.columns])
-                                    
-                                    # Rename columns for better readability
-                                    rename_mapping = {
-                                        'id': 'event_id',
-                                        'time': 'event_datetime'
-                                    }
-                                    # Only rename columns that exist
-                                    rename_mapping = {k: v for k, v in rename_mapping.items() if k in display_df.columns}
-                                    if rename_mapping:
-                                        display_df = display_df.rename(columns=rename_mapping)
-                                    
-                                    # Reorder columns to put important ones first
-                                    preferred_order = ['event_id', 'patrol_id', 'patrol_name', 'patrol_leader',
-                                                      'serial_number', 'event_type', 'subject_name', 'subject_id',
-                                                      'longitude', 'latitude', 'event_datetime',
-                                                      'priority', 'title', 'state',
-                                                      'updated_at', 'created_at', 'is_collection']
-                                    
-                                    # Add all detail_ columns after the main columns
-                                    detail_cols = sorted([col for col in display_df.columns if col.startswith('detail_')])
-                                    preferred_order.extend(detail_cols)
-                                    
-                                    # Get columns in preferred order (only if they exist)
-                                    ordered_cols = [col for col in preferred_order if col in display_df.columns]
-                                    # Add remaining columns
-                                    remaining_cols = [col for col in display_df.columns if col not in ordered_cols]
-                                    display_df = display_df[ordered_cols + remaining_cols]
-                                    
-                                    st.dataframe(display_df)
-                                    
-                                    # Show summary statistics
-                                    col_e1, col_e2 = st.columns(2)
-                                    with col_e1:
-                                        st.metric("Total events", len(events_combined))
-                                    with col_e2:
-                                        if 'event_type' in events_combined.columns:
-                                            st.metric("Event types", events_combined['event_type'].nunique())
-                                    
-                                    # Save to CSV
-                                    try:
-                                        start_str = start_date.strftime('%y%m%d')
-                                        end_str = end_date.strftime('%y%m%d')
-                                        patrol_type_clean = "".join(c if c.isalnum() else "_" for c in patrol_type)
-                                        base_filename = f"{patrol_type_clean}_events_{start_str}_{end_str}"
-                                        
-                                        # Prepare CSV export - remove geometry and geojson columns
-                                        events_export = events_combined.copy()
-                                        cols_to_remove_export = ['geometry', 'geojson']
-                                        events_export = events_export.drop(columns=[col for col in cols_to_remove_export if col in events_export.columns])
+                                            folium.PolyLine(
+                                                parts if len(parts) > 1 else parts[0],
+                                                color=color,
+                                                weight=3,
+                                                opacity=0.6,
+                                                popup=f"Patrol: {row.get('patrol_sn', 'N/A')}",
+                                            ).add_to(m)
                                         
-                                        # Remove same columns as display
-                                        cols_to_remove_from_export = ['level_8', 'index', 'location', 'reported_by', 'event_details', 
-                                                                     'geojson', 'attributes', 'notes', 'patrols', 
-                                                                     'patrol_segments', 'is_contained_in', 'related_subjects', 
-                                                                     'location_lat', 'location_lon', 
-                                                                     'message', 'provenance', 'event_category', 'priority_label', 
-                                                                     'comment', 'end_time', 'sort_at', 'icon_id', 'url', 
-                                                                     'image_url', 'external_source']
-                                        events_export = events_export.drop(columns=[col for col in cols_to_remove_from_export if col in events_export.columns])
+                                        # Add events as a single cluster or heat layer
+                                        used_mode = add_event_layer(m, event_points, event_map_mode)
+                                        if used_mode == 'heat' and event_map_mode == 'auto':
+                                            st.caption(f"Showing a heat map: more than {EVENT_MAP_MAX_MARKERS:,} events")
                                         
-                                        # Apply same renaming as display
-                                        rename_mapping = {
-                                            'id': 'event_id',
-                                            'time': 'event_datetime'
-                                        }
-                                        # Only rename columns that exist
-                                        rename_mapping = {k: v for k, v in rename_mapping.items() if k in events_export.columns}
-                                        if rename_mapping:
-                                            events_export = events_export.rename(columns=rename_mapping)
+                                        # Fit bounds to show both patrols and events
+                                        all_bounds = [
+                                            [events_bounds[1], events_bounds[0]], 
+                                            [events_bounds[3], events_bounds[2]]
+                                        ]
+                                        m.fit_bounds(all_bounds)
                                         
-                                        # Convert to CSV
-                                        csv_data = events_export.to_csv(index=False)
+                                        # Display map
+                                        folium_static(m, width=800, height=500)
                                         
+                                    except Exception as e:
+                                        st.warning(f"Could not create map preview: {e}")
+                                else:
+                                    st.info("💡 Install folium and streamlit-folium to see map preview")
+                                
+                                # Display data preview
+                                st.subheader("Events data preview")
+                                display_df = event_preview_frame(events_combined)
+                                show_data_preview(display_df, 'patrol_events')
+                                
+                                # Show summary statistics
+                                col_e1, col_e2 = st.columns(2)
+                                with col_e1:
+                                    st.metric("Total events", len(events_combined))
+                                with col_e2:
+                                    if 'event_type' in events_combined.columns:
+                                        st.metric("Event types", events_combined['event_type'].nunique())
+                                
+                                # Save to CSV: the segments are already encoded, this settles the header
+                                # and copies them into the download; the download button still reads
+                                # the finished file whole (see write_events_csv)
+                                try:
+                                    profiler.lap('to_csv')
+                                    csv_path, csv_mime = events_csv.finish()
+                                    with open(csv_path, 'rb') as csv_file:
                                         st.download_button(
                                             label="📥 Download Events CSV",
-                                            data=csv_data,
-                                            file_name=f"{base_filename}.csv",
-                                            mime="text/csv",
+                                            data=csv_file,
+                                            file_name=os.path.basename(csv_path),
+                                            mime=csv_mime,
                                             use_container_width=True
                                         )
+                                except Exception as e:
+                                    st.error(f"❌ Error creating events CSV: {e}")
+
+                                # Same summary as with the tracks, now with event counts per patrol
+                                if summary_enabled:
+                                    try:
+                                        profiler.lap('patrol_summary')
+                                        show_patrol_summary(gdf_patrols, events_combined, summary_group, summary_period,
+                                                            summary_format, base_filename.replace('_events_', '_'),
+                                                            key='patrol_events')
                                     except Exception as e:
-                                        st.error(f"❌ Error creating events CSV: {e}")
-                        except Exception as e:
-                            st.error(f"❌ Error extracting patrol events: {e}")
-                            import traceback
-                            st.error(traceback.format_exc())
+                                        st.error(f"❌ Error creating patrol summary: {e}")
+                    except Exception as e:
+                        st.error(f"❌ Error extracting patrol events: {e}")
+                        import traceback
+                        st.error(traceback.format_exc())
                 
                 except Exception as e:
                     st.error(f"❌ Error extracting events: {e}")
@@ -1070,11 +3564,23 @@ if st.session_state.authenticated:
         with st.spinner("Loading available event types..."):
             try:
                 # Get events from the date range to determine event types
-                sample_events = st.session_state.er_io.get_events(
-                    since=since,
-                    until=until,
-                    include_details=True
-                )
+                if len(export_connections) > 1:
+                    server_events, errors = fan_out(
+                        export_connections,
+                        lambda label, er_io: er_io.get_events(since=since, until=until, include_details=True)
+                    )
+                    for label, message in errors.items():
+                        st.warning(f"⚠️ {label}: {message}")
+                    sample_events = concat_sources(server_events)
+                    if sample_events is None:
+                        sample_events = pd.DataFrame()
+                else:
+                    sample_events = st.session_state.er_io.get_events(
+                        since=since,
+                        until=until,
+                        include_details=True
+                    )
+                sample_events = project_event_columns(sample_events)
                 
                 if not sample_events.empty and 'event_type' in sample_events.columns:
                     # Get unique event types
@@ -1093,8 +3599,13 @@ if st.session_state.authenticated:
                     # Button to extract events
                     if selected_event_types:
                         if st.button("📥 Export selected events", type="primary", use_container_width=True):
-                            with st.spinner(f"Extracting {len(selected_event_types)} event type(s)..."):
+                            with st.spinner(f"Extracting {len(selected_event_types)} event type(s)..."), \
+                                    export_profiler('selected_events') as profiler:
                                 try:
+                                    import geopandas as gpd
+                                    import shapely
+
+                                    profiler.lap('get_events')
                                     # Filter sample events by selected types
                                     filtered_events = sample_events[sample_events['event_type'].isin(selected_event_types)].copy()
                                     
@@ -1133,13 +3644,16 @@ if st.session_state.authenticated:
                                                 detailed_events_list = []
                                                 progress_bar = st.progress(0)
                                                 
+                                                # In multi-server exports each event's details come from the server that listed it
+                                                server_of_event = (
+                                                    dict(zip(filtered_events[id_col], filtered_events['source_server']))
+                                                    if 'source_server' in filtered_events.columns else None
+                                                )
                                                 for batch_idx in range(0, len(event_ids), batch_size):
                                                     batch_event_ids = event_ids[batch_idx:batch_idx + batch_size]
                                                     try:
-                                                        detailed_events_batch = st.session_state.er_io.get_events(
-                                                            event_ids=batch_event_ids,
-                                                            include_details=True,
-                                                            include_notes=True
+                                                        detailed_events_batch = get_events_by_id(
+                                                            export_connections, batch_event_ids, server_of_event
                                                         )
                                                         if not detailed_events_batch.empty:
                                                             detailed_events_list.append(detailed_events_batch)
@@ -1151,7 +3665,9 @@ if st.session_state.authenticated:
                                                 progress_bar.empty()
                                                 
                                                 if detailed_events_list:
-                                                    events_detailed = pd.concat(detailed_events_list, ignore_index=True)
+                                                    events_detailed = project_event_columns(
+                                                        pd.concat(detailed_events_list, ignore_index=True)
+                                                    )
                                                 else:
                                                     st.warning("No detailed events could be retrieved")
                                                     events_detailed = None
@@ -1163,46 +3679,21 @@ if st.session_state.authenticated:
                                             st.success(f"✅ Successfully extracted {len(events_detailed)} event(s)!")
                                             
                                             # Convert to GeoDataFrame with geometry from geojson
-                                            def extract_geometry(row):
-                                                if 'geojson' in row and row['geojson']:
-                                                    try:
-                                                        if isinstance(row['geojson'], dict):
-                                                            return shape(row['geojson'])
-                                                    except:
-                                                        pass
-                                                return None
-                                            
-                                            events_detailed['geometry'] = events_detailed.apply(extract_geometry, axis=1)
+                                            events_detailed['geometry'] = geojson_geometries(
+                                                events_detailed.get('geojson', [None] * len(events_detailed))
+                                            )
                                             
                                             # Create GeoDataFrame (even if some don't have geometry)
                                             events_gdf = gpd.GeoDataFrame(events_detailed, geometry='geometry', crs=4326)
                                             
                                             # Extract coordinates from geometry
                                             if 'geometry' in events_gdf.columns:
-                                                events_gdf['longitude'] = events_gdf.geometry.apply(lambda g: g.x if g else None)
-                                                events_gdf['latitude'] = events_gdf.geometry.apply(lambda g: g.y if g else None)
+                                                # NaN for missing or non-point geometries
+                                                events_gdf['longitude'] = shapely.get_x(events_gdf.geometry.values)
+                                                events_gdf['latitude'] = shapely.get_y(events_gdf.geometry.values)
                                             
-                                            # Extract time from geojson.properties.datetime if time column doesn't exist
-                                            if 'time' not in events_gdf.columns and 'geojson' in events_gdf.columns:
-                                                def extract_datetime(geojson):
-                                                    if isinstance(geojson, dict):
-                                                        props = geojson.get('properties', {})
-                                                        if isinstance(props, dict):
-                                                            dt_str = props.get('datetime')
-                                                            if dt_str:
-                                                                return pd.to_datetime(dt_str, utc=True)
-                                                    return None
-                                                events_gdf['time'] = events_gdf['geojson'].apply(extract_datetime)
-                                            
-                                            # Extract reported_by name and UUID (subject_name / subject_id)
-                                            if 'reported_by' in events_gdf.columns:
-                                                events_gdf['subject_name'] = events_gdf['reported_by'].apply(
-                                                    lambda x: x.get('name', '') if isinstance(x, dict) else ''
-                                                )
-                                                if 'subject_id' not in events_gdf.columns:
-                                                    events_gdf['subject_id'] = events_gdf['reported_by'].apply(
-                                                        lambda x: x.get('id', '') if isinstance(x, dict) else ''
-                                                    )
+                                            # Time and reporter from the nested dicts; the merge and flattening never need their sources
+                                            events_gdf = decode_event_fields(events_gdf)
 
                                             # Merge repeat-group "orphan" child rows with their parent.
                                             # Must run BEFORE event_details normalisation so the list-of-dicts
@@ -1226,7 +3717,7 @@ if st.session_state.authenticated:
                                                     _meta = [c for c in [
                                                         'time', 'id', 'serial_number', 'event_type',
                                                         'priority', 'title', 'state', 'updated_at',
-                                                        'created_at', 'is_collection', 'reported_by',
+                                                        'created_at', 'is_collection',
                                                         'longitude', 'latitude',
                                                         'subject_name', 'subject_id',
                                                     ] if c in events_gdf.columns]
@@ -1248,97 +3739,34 @@ if st.session_state.authenticated:
                                                         crs=4326
                                                     )
 
-                                            # Unnest event_details - FULLY EXPLODE THE DATA
-                                            if 'event_details' in events_gdf.columns:
-                                                # Extract event_details fields into separate columns
-                                                event_details_df = pd.json_normalize(events_gdf['event_details'])
-                                                # Reset index so it aligns with events_gdf after reset_index below.
-                                                # pd.json_normalize preserves the input Series index, which may not
-                                                # start at 0 — mismatched indices cause pd.concat(axis=1) to create
-                                                # extra NaN-filled rows instead of joining the single row correctly.
-                                                event_details_df = event_details_df.reset_index(drop=True)
-                                                # Add prefix to avoid column name conflicts
-                                                event_details_df.columns = ['detail_' + col for col in event_details_df.columns]
-                                                # Combine with main dataframe - preserve geometry
-                                                geometry_col = events_gdf.geometry
-                                                events_gdf = pd.concat([events_gdf.reset_index(drop=True), event_details_df], axis=1)
-                                                # Restore as GeoDataFrame
-                                                events_gdf = gpd.GeoDataFrame(events_gdf, geometry=geometry_col.reset_index(drop=True), crs=4326)
-                                            
-                                            # Unnest any detail_ columns that contain lists of dicts (e.g. detail_Herd)
-                                            list_dict_cols = [
-                                                col for col in events_gdf.columns
-                                                if col.startswith('detail_') and events_gdf[col].apply(
-                                                    lambda x: isinstance(x, list) and len(x) > 0 and isinstance(x[0], dict)
-                                                ).any()
-                                            ]
-                                            if list_dict_cols:
-                                                for col in list_dict_cols:
-                                                    # Normalise empty/null to [{}] so rows are kept with NaN fields
-                                                    events_gdf[col] = events_gdf[col].apply(
-                                                        lambda x: x if (isinstance(x, list) and len(x) > 0) else [{}]
-                                                    )
-                                                    # Explode: one row per item in the list
-                                                    events_gdf = events_gdf.explode(col, ignore_index=True)
-                                                    # Normalise the dict into flat columns
-                                                    nested_df = pd.json_normalize(events_gdf[col].apply(
-                                                        lambda x: x if isinstance(x, dict) else {}
-                                                    ))
-                                                    events_gdf = gpd.GeoDataFrame(
-                                                        pd.concat([events_gdf.drop(columns=[col]).reset_index(drop=True), nested_df], axis=1),
-                                                        geometry='geometry',
-                                                        crs=4326
-                                                    )
+                                            # Drop events outside the area of interest before any flattening
+                                            # (after the orphan merge, which fills child rows' geometry)
+                                            if aoi is not None:
+                                                events_gdf = filter_events_to_aoi(events_gdf, aoi).reset_index(drop=True)
+                                                st.info(f"{len(events_gdf)} event(s) inside the area of interest")
 
-                                            # Resolve UUIDs in detail_ columns to display names
+                                            # Subject names for resolving UUIDs in detail_ columns
+                                            profiler.lap('build_subject_lookup')
                                             with st.spinner("Resolving subject names for event detail fields..."):
-                                                uuid_to_name = build_subject_lookup(st.session_state.er_io)
-                                            events_gdf = resolve_uuid_columns(events_gdf, uuid_to_name, col_prefix='')
+                                                uuid_to_name = build_subject_lookups(export_connections)
+
+                                            # Unnest event_details - FULLY EXPLODE THE DATA - then resolve UUIDs
+                                            if flatten_workers > 1 and len(events_gdf) >= PARALLEL_FLATTEN_MIN_ROWS:
+                                                profiler.lap('flatten_parallel')
+                                                with st.spinner(f"Flattening event details on {flatten_workers} processes..."):
+                                                    events_gdf = flatten_events_parallel(events_gdf, uuid_to_name, flatten_workers)
+                                            else:
+                                                profiler.lap('flatten_event_details')
+                                                events_gdf = flatten_event_details(events_gdf, explode_lists=True)
+                                                profiler.lap('resolve_uuid_columns')
+                                                events_gdf = resolve_uuid_columns(events_gdf, uuid_to_name, col_prefix='')
+                                            profiler.lap('render_preview')
 
                                             # Display data preview
                                             st.subheader("Events data preview")
-                                            # Create display DataFrame without geometry and geojson
-                                            display_cols = [col for col in events_gdf.columns if col not in ['geometry', 'geojson']]
-                                            display_df = events_gdf[display_cols].copy()
-                                            
-                                            # Clean up the display
-                                            cols_to_remove = ['level_8', 'index', 'location', 'reported_by', 'event_details', 
-                                                             'geojson', 'attributes', 'notes', 'patrols', 'patrol_segments',
-                                                             'is_contained_in', 'related_subjects',
-                                                             'location_lat', 'location_lon', 'message', 'provenance',
-                                                             'event_category', 'priority_label', 'comment', 'end_time',
-                                                             'sort_at', 'icon_id', 'url', 'image_url', 'external_source']
-                                            display_df = display_df.drop(columns=[col for col in cols_to_remove if col in display_df.columns])
-                                            
-                                            # Rename columns for better readability
-                                            rename_mapping = {
-                                                'id': 'event_id',
-                                                'time': 'event_datetime'
-                                            }
-                                            rename_mapping = {k: v for k, v in rename_mapping.items() if k in display_df.columns}
-                                            if rename_mapping:
-                                                display_df = display_df.rename(columns=rename_mapping)
-                                            
-                                            # Reorder columns to put important ones first
-                                            preferred_order = ['event_id', 'serial_number', 'event_type', 'subject_name', 'subject_id',
-                                                              'longitude', 'latitude', 'event_datetime',
-                                                              'priority', 'title', 'state',
-                                                              'updated_at', 'created_at', 'is_collection']
-                                            
-                                            # Add all detail_ columns, then any unnested item columns (e.g. giraffe_*)
-                                            detail_cols = sorted([col for col in display_df.columns if col.startswith('detail_')])
-                                            preferred_order.extend(detail_cols)
-                                            item_cols = sorted([col for col in display_df.columns
-                                                                if not col.startswith('detail_') and col not in preferred_order])
-                                            preferred_order.extend(item_cols)
-                                            
-                                            # Get columns in preferred order (only if they exist)
-                                            ordered_cols = [col for col in preferred_order if col in display_df.columns]
-                                            # Add remaining columns
-                                            remaining_cols = [col for col in display_df.columns if col not in ordered_cols]
-                                            display_df = display_df[ordered_cols + remaining_cols]
-                                            
-                                            st.dataframe(display_df)
+                                            # Exploded item columns (e.g. giraffe_*) are sorted after the detail_ columns
+                                            display_df = event_preview_frame(events_gdf, sort_rest=True)
+                                            show_data_preview(display_df, 'events')
                                             
                                             # Show summary statistics
                                             col_e1, col_e2, col_e3 = st.columns(3)
@@ -1358,40 +3786,25 @@ if st.session_state.authenticated:
                                                 event_type_clean = "_".join([c if c.isalnum() else "_" for c in "_".join(selected_event_types)])
                                                 base_filename = f"all_events_{event_type_clean}_{start_str}_{end_str}"
                                                 
-                                                # Prepare CSV export - remove geometry and geojson columns
-                                                events_export = events_gdf.copy()
-                                                cols_to_remove_export = ['geometry', 'geojson']
-                                                events_export = events_export.drop(columns=[col for col in cols_to_remove_export if col in events_export.columns])
-                                                
-                                                # Remove same columns as display
-                                                cols_to_remove_from_export = ['level_8', 'index', 'location', 'reported_by', 'event_details', 
-                                                                             'geojson', 'attributes', 'notes', 'patrols', 
-                                                                             'patrol_segments', 'is_contained_in', 'related_subjects', 
-                                                                             'location_lat', 'location_lon', 
-                                                                             'message', 'provenance', 'event_category', 'priority_label', 
-                                                                             'comment', 'end_time', 'sort_at', 'icon_id', 'url', 
-                                                                             'image_url', 'external_source']
-                                                events_export = events_export.drop(columns=[col for col in cols_to_remove_from_export if col in events_export.columns])
-                                                
-                                                # Apply same renaming as display
-                                                rename_mapping = {
-                                                    'id': 'event_id',
-                                                    'time': 'event_datetime'
-                                                }
-                                                rename_mapping = {k: v for k, v in rename_mapping.items() if k in events_export.columns}
-                                                if rename_mapping:
-                                                    events_export = events_export.rename(columns=rename_mapping)
-                                                
-                                                # Convert to CSV
-                                                csv_data = events_export.to_csv(index=False)
-                                                
-                                                st.download_button(
-                                                    label="📥 Download Events CSV",
-                                                    data=csv_data,
-                                                    file_name=f"{base_filename}.csv",
-                                                    mime="text/csv",
-                                                    use_container_width=True
-                                                )
+                                                # Stream the CSV to a temp file in row blocks instead of building it in memory;
+                                                # the download button still reads the finished file whole (see write_events_csv)
+                                                profiler.lap('to_csv')
+                                                with tempfile.TemporaryDirectory() as tmpdir:
+                                                    csv_path, csv_mime = write_events_csv(
+                                                        events_gdf,
+                                                        os.path.join(tmpdir, base_filename),
+                                                        EVENT_OUTPUT_EXCLUDED,
+                                                        EVENT_RENAME,
+                                                        compression=csv_compression
+                                                    )
+                                                    with open(csv_path, 'rb') as csv_file:
+                                                        st.download_button(
+                                                            label="📥 Download Events CSV",
+                                                            data=csv_file,
+                                                            file_name=os.path.basename(csv_path),
+                                                            mime=csv_mime,
+                                                            use_container_width=True
+                                                        )
                                             except Exception as e:
                                                 st.error(f"❌ Error creating events CSV: {e}")
                                         else:
@@ -1411,6 +3824,33 @@ if st.session_state.authenticated:
     except Exception as e:
         st.error(f"❌ Error in event extraction section: {e}")
     
+    # Diagnostics panel - per-stage timings for the exports run in this session
+    if st.session_state.get('diagnostics_enabled') and st.session_state.diagnostics:
+        st.markdown("---")
+        with st.expander("🩺 Diagnostics"):
+            for record in st.session_state.diagnostics.values():
+                st.markdown(f"**{record['flow']}** ({record['recorded_at']}, {record['total_seconds']:.1f} s total)")
+                st.dataframe(pd.DataFrame(record['stages']), use_container_width=True)
+            cache = get_response_cache().summary()
+            st.caption(
+                f"Shared response cache (all sessions): {cache['entries']} entries, {cache['mb']} MB, "
+                f"{cache['hits']} hits, {cache['misses']} misses, {cache['evictions']} evictions"
+            )
+            # Only this session's servers; other users' server names stay private
+            scheduler_metrics = get_request_scheduler().metrics(hosts=set(get_connections()))
+            if scheduler_metrics:
+                st.caption("EarthRanger request scheduler (your servers, all sessions)")
+                st.dataframe(
+                    pd.DataFrame.from_dict(scheduler_metrics, orient='index').rename_axis('server'),
+                    use_container_width=True
+                )
+            st.download_button(
+                label="📥 Download diagnostics (JSON)",
+                data=json.dumps(list(st.session_state.diagnostics.values()), indent=2),
+                file_name="patrol_export_diagnostics.json",
+                mime="application/json"
+            )
+    
     # Citation section at bottom of main area
     st.markdown("""
     ---
@@ -0,0 +1,102 @@
+"""
+Import-time benchmark for the app's dependencies
+Run this to keep cold-start regressions visible: it reports how long each
+module takes to import using `python -X importtime`, split into what the
+login page needs and what is loaded lazily after authentication
+"""
+
+import importlib.util
+import subprocess
+import sys
+
+# Imported at the top of app.py - paid before the login form renders
+STARTUP_MODULES = [
+    "streamlit",
+    "pandas",
+    "requests",
+]
+
+# Imported lazily after login / when a map or export is first needed
+LAZY_MODULES = [
+    "ecoscope.io.earthranger",
+    "geopandas",
+    "shapely.geometry",
+    "folium",
+    "streamlit_folium",
+]
+
+# Warn if the startup imports take longer than this (seconds)
+STARTUP_BUDGET_S = 3.0
+
+
+def measure_imports(modules):
+    """
+    Import modules in order in one fresh interpreter and return
+    {module: cumulative seconds}. Dependencies shared with an earlier module
+    are only counted once, as they would be in the app.
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "; ".join(f"import {m}" for m in modules)],
+        capture_output=True,
+        text=True
+    )
+    if result.returncode != 0:
+        return None
+
+    # Lines look like: "import time:      self [us] | cumulative | imported package"
+    # Packages imported directly by the -c statement have no indentation
+    timings = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        parts = line[len("import time:"):].split("|")
+        if len(parts) != 3 or parts[2].startswith("  "):
+            continue
+        try:
+            timings[parts[2].strip()] = int(parts[1].strip()) / 1e6
+        except ValueError:
+            pass  # Header line
+
+    # A dotted module's cost is reported across its parent packages
+    return {
+        m: sum(t for name, t in timings.items() if m == name or m.startswith(name + "."))
+        for m in modules
+    }
+
+
+def report(title, modules, preloaded=()):
+    """Print import times for a group of modules and return the group total"""
+    print(title)
+    installed = [m for m in modules if importlib.util.find_spec(m.split(".")[0]) is not None]
+    for module in modules:
+        if module not in installed:
+            print(f"   ⚠️  {module}: not installed")
+
+    timings = measure_imports(list(preloaded) + installed) or {}
+    total = 0.0
+    for module in installed:
+        seconds = timings.get(module, 0.0)
+        total += seconds
+        print(f"   {module:<28} {seconds * 1000:8.1f} ms")
+    print(f"   {'total':<28} {total * 1000:8.1f} ms\n")
+    return total
+
+
+def main():
+    print("=" * 50)
+    print("Import Time Benchmark")
+    print("=" * 50 + "\n")
+
+    startup_total = report("Startup imports (before login):", STARTUP_MODULES)
+    report("Lazy imports (after login):", LAZY_MODULES, preloaded=STARTUP_MODULES)
+
+    print("=" * 50)
+    if startup_total > STARTUP_BUDGET_S:
+        print(f"⚠️  Startup imports took {startup_total:.2f}s (budget {STARTUP_BUDGET_S:.1f}s)")
+        print("   Check app.py for new top-level imports of heavy packages")
+    else:
+        print(f"✅ Startup imports took {startup_total:.2f}s (budget {STARTUP_BUDGET_S:.1f}s)")
+
+
+if __name__ == "__main__":
+    main()
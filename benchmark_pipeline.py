@@ -0,0 +1,474 @@
+"""
+Pipeline benchmark with synthetic EarthRanger data
+Runs each processing stage of app.py against a fake EarthRangerIO so
+performance work can be measured offline, without a server or credentials.
+Reports throughput and peak memory per stage and compares them against a
+saved baseline to keep regressions visible. The first run at each scale
+records the baseline in benchmark_baseline.json next to this script; it is
+not committed, since timings only compare on the same machine.
+
+Usage:
+    python benchmark_pipeline.py                         # medium scale
+    python benchmark_pipeline.py --scale large           # 5M points, 100k events
+    python benchmark_pipeline.py --points 20000 --events 5000
+    python benchmark_pipeline.py --save-baseline         # replace the baseline with current results
+"""
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+import uuid
+import warnings
+
+# Importing app.py runs the Streamlit script in bare mode: keep it quiet and offline
+os.environ.setdefault("GCF_ANALYTICS", "off")
+
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import requests
+import streamlit.logger
+
+streamlit.logger.set_log_level("error")
+# Long attribute names are truncated when written to shapefile - expected, not interesting here
+warnings.filterwarnings("ignore", message="Normalized/laundered field name")
+warnings.filterwarnings("ignore", message="Column names longer than 10 characters")
+
+import app
+
+SCALES = {
+    "small": {"points": 1_000, "events": 1_000},
+    "medium": {"points": 100_000, "events": 10_000},
+    "large": {"points": 5_000_000, "events": 100_000},
+}
+
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark_baseline.json")
+
+# Flag a stage if it is this much slower / hungrier than the baseline
+REGRESSION_TOLERANCE = 1.2
+
+# download_patrol_tracks may allocate at most this multiple of the raw observation frame
+OBSERVATION_MEMORY_MULTIPLE = 1.5
+
+
+class FakeEarthRangerIO:
+    """
+    Stand-in for ecoscope's EarthRangerIO returning synthetic patrols, segments,
+    observations, subjects and events with nested event_details, shaped like
+    the real API responses the app consumes. latency_s is slept on every
+    per-segment and per-id event request, standing in for network round trips.
+    """
+
+    PATROL_TYPES = ["foot_patrol", "vehicle_patrol", "aerial_patrol", "giraffe_monitoring"]
+    EVENT_TYPES = ["giraffe_sighting", "carcass", "snare", "fence_damage", "poacher_camp"]
+
+    def __init__(self, points=100_000, events=10_000, points_per_patrol=1_000, n_subjects=50, seed=42, latency_s=0.0):
+        self.seed = seed
+        self.latency_s = latency_s
+        self.rng = np.random.default_rng(seed)
+        self.n_points = points
+        self.n_events = events
+        self.n_patrols = max(1, points // points_per_patrol)
+        self.start = pd.Timestamp("2025-01-01", tz="UTC")
+        self.subject_ids = [str(uuid.UUID(int=int(i) + 1)) for i in range(n_subjects)]
+        self.subject_names = [f"Ranger {i:03d}" for i in range(n_subjects)]
+        self._patrols = self._make_patrols()
+        self._events = self._make_events()
+
+    def _make_patrols(self):
+        n = self.n_patrols
+        ids = [str(uuid.UUID(int=(1 << 64) + i)) for i in range(n)]
+        starts = self.start + pd.to_timedelta(np.arange(n) * 6, unit="h")
+        # Each patrol records one fix per 30s; the device starts before and stops
+        # after the segment so the time clip always has a few fixes to drop
+        points_per_patrol = int(np.ceil(self.n_points / n))
+        ends = starts + pd.to_timedelta(points_per_patrol * 30 - 120, unit="s")
+        types = self.rng.choice(self.PATROL_TYPES, size=n)
+        leaders = self.rng.integers(0, len(self.subject_ids), size=n)
+
+        segments = []
+        for i in range(n):
+            segments.append([{
+                "id": str(uuid.UUID(int=(2 << 64) + i)),
+                "patrol_type": types[i],
+                "leader": {"id": self.subject_ids[leaders[i]], "name": self.subject_names[leaders[i]]},
+                "time_range": {"start_time": starts[i].isoformat(), "end_time": ends[i].isoformat()},
+            }])
+
+        return pd.DataFrame({
+            "id": ids,
+            "serial_number": np.arange(n) + 1000,
+            "title": [f"Patrol {i}" for i in range(n)],
+            "state": "done",
+            "patrol_segments": segments,
+        })
+
+    def _make_events(self):
+        n = self.n_events
+        segment_ids = [seg[0]["id"] for seg in self._patrols["patrol_segments"]]
+        lons = 16.0 + self.rng.normal(0, 0.5, n)
+        lats = -20.0 + self.rng.normal(0, 0.5, n)
+        times = self.start + pd.to_timedelta(self.rng.integers(0, 86_400 * 30, n), unit="s")
+        types = self.rng.choice(self.EVENT_TYPES, size=n)
+        observers = self.rng.integers(0, len(self.subject_ids), size=n)
+        herd_sizes = self.rng.integers(0, 6, size=n)
+        segment_idx = self.rng.integers(0, len(segment_ids), size=n)
+
+        records = []
+        for i in range(n):
+            time_str = times[i].isoformat()
+            herd = [
+                {"giraffe_id": f"G{i:06d}{j}", "sex": "F" if j % 2 else "M", "age_class": "adult"}
+                for j in range(herd_sizes[i])
+            ]
+            records.append({
+                "id": str(uuid.UUID(int=(3 << 64) + i)),
+                "serial_number": 50_000 + i,
+                "event_type": types[i],
+                "time": time_str,
+                "priority": 0,
+                "title": None,
+                "state": "new",
+                "updated_at": time_str,
+                "created_at": time_str,
+                "is_collection": False,
+                "location": {"latitude": lats[i], "longitude": lons[i]},
+                "geojson": {
+                    "type": "Feature",
+                    "geometry": {"type": "Point", "coordinates": [lons[i], lats[i]]},
+                    "properties": {"datetime": time_str},
+                },
+                "reported_by": {"id": self.subject_ids[observers[i]], "name": self.subject_names[observers[i]]},
+                "event_details": {
+                    "observer": self.subject_ids[observers[i]],
+                    "herd_size": int(herd_sizes[i]),
+                    "habitat": "woodland" if i % 3 else "savanna",
+                    "Herd": herd,
+                },
+                "notes": [],
+                "patrol_segments": [segment_ids[segment_idx[i]]],
+            })
+        return pd.DataFrame(records)
+
+    def get_patrols(self, since=None, until=None, status=None, patrol_type_value=None, **kwargs):
+        patrols = self._patrols.copy()
+        if patrol_type_value:
+            wanted = patrol_type_value if isinstance(patrol_type_value, list) else [patrol_type_value]
+            keep = [seg[0]["patrol_type"] in wanted for seg in patrols["patrol_segments"]]
+            patrols = patrols[keep]
+        return patrols
+
+    def get_patrol_observations(self, patrols_df, include_patrol_details=True, **kwargs):
+        n_patrols = len(patrols_df)
+        per_patrol = int(np.ceil(self.n_points / max(1, self.n_patrols)))
+        patrol_idx = np.repeat(np.arange(n_patrols), per_patrol)
+        step = np.tile(np.arange(per_patrol), n_patrols)
+
+        segments = [seg[0] for seg in patrols_df["patrol_segments"]]
+        seg_start = pd.to_datetime([s["time_range"]["start_time"] for s in segments], utc=True)
+        recorded_at = seg_start[patrol_idx] + pd.to_timedelta(step * 30 - 60, unit="s")
+
+        # Random walk per patrol starting from a per-patrol origin
+        # (seeded per call so repeated fetches return identical tracks)
+        rng = np.random.default_rng(self.seed)
+        origin_lon = 16.0 + rng.normal(0, 0.5, n_patrols)
+        origin_lat = -20.0 + rng.normal(0, 0.5, n_patrols)
+        d_lon = rng.normal(0, 0.0003, len(step))
+        d_lat = rng.normal(0, 0.0003, len(step))
+        d_lon[step == 0] = 0
+        d_lat[step == 0] = 0
+        walk_lon = np.cumsum(d_lon)
+        walk_lat = np.cumsum(d_lat)
+        first = np.flatnonzero(step == 0)
+        walk_lon -= np.repeat(walk_lon[first], per_patrol)
+        walk_lat -= np.repeat(walk_lat[first], per_patrol)
+        lon = origin_lon[patrol_idx] + walk_lon
+        lat = origin_lat[patrol_idx] + walk_lat
+
+        leader_ids = np.array([s["leader"]["id"] for s in segments], dtype=object)
+        types = np.array([s["patrol_type"] for s in segments], dtype=object)
+        points = gpd.GeoDataFrame({
+            "extra__recorded_at": recorded_at.strftime("%Y-%m-%dT%H:%M:%S+00:00"),
+            "extra__subject_id": leader_ids[patrol_idx],
+            "groupby_col": leader_ids[patrol_idx],
+            "patrol_id": patrols_df["id"].to_numpy()[patrol_idx],
+            "patrol_title": patrols_df["title"].to_numpy()[patrol_idx],
+            "patrol_serial_number": patrols_df["serial_number"].to_numpy()[patrol_idx],
+            "patrol_start_time": np.array([s["time_range"]["start_time"] for s in segments], dtype=object)[patrol_idx],
+            "patrol_end_time": np.array([s["time_range"]["end_time"] for s in segments], dtype=object)[patrol_idx],
+            "patrol_type__value": types[patrol_idx],
+            "patrol_type__display": np.char.replace(types.astype(str), "_", " ")[patrol_idx],
+        }, geometry=gpd.points_from_xy(lon, lat), crs=4326)
+        return points
+
+    def get_patrol_segment_events(self, patrol_segment_id, **kwargs):
+        time.sleep(self.latency_s)
+        mask = self._events["patrol_segments"].apply(lambda segs: patrol_segment_id in segs)
+        return self._events[mask].copy()
+
+    def get_events(self, event_ids=None, since=None, until=None, include_details=True, **kwargs):
+        if event_ids is not None:
+            time.sleep(self.latency_s)
+            return self._events[self._events["id"].isin(event_ids)].copy()
+        return self._events.copy()
+
+    def get_subjects(self, include_inactive=True, **kwargs):
+        return pd.DataFrame({"id": self.subject_ids, "name": self.subject_names})
+
+
+def run_stage(name, items, func, repeat):
+    """Time func (best of repeat) and measure its peak traced memory in a separate run"""
+    best = float("inf")
+    result = None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        result = func()
+        best = min(best, time.perf_counter() - t0)
+
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return result, {
+        "items": items,
+        "seconds": best,
+        "items_per_s": items / best if best > 0 else float("inf"),
+        "peak_mb": peak / 1e6,
+    }
+
+
+def events_to_gdf(events_df):
+    """Build the events GeoDataFrame the way the app does after fetching (fixture prep, not timed)"""
+    return gpd.GeoDataFrame(events_df, geometry=app.geojson_geometries(events_df["geojson"]), crs=4326)
+
+
+def observation_memory(er_io, since, until):
+    """
+    Peak traced memory of the track build and the size of the raw observation
+    frame it starts from, both in MB. test_track_memory.py holds the ratio to
+    OBSERVATION_MEMORY_MULTIPLE, i.e. the build must not hold several copies at once
+    """
+    observations = er_io.get_patrol_observations(er_io.get_patrols())
+    raw_mb = app.frame_memory_mb(observations)
+    # Serve the pre-built frame so only the pipeline's own allocations are traced
+    er_io.get_patrol_observations = lambda patrols_df, **kwargs: observations
+    try:
+        tracemalloc.start()
+        app.download_patrol_tracks(er_io, None, since, until)
+        peak_mb = tracemalloc.get_traced_memory()[1] / 1e6
+    finally:
+        tracemalloc.stop()
+        del er_io.get_patrol_observations
+    return peak_mb, raw_mb
+
+
+def check_observation_memory(er_io, since, until):
+    """Report the track build's peak memory against the raw observations; False above the limit"""
+    peak_mb, raw_mb = observation_memory(er_io, since, until)
+    ratio = peak_mb / raw_mb if raw_mb else 0.0
+    if ratio > OBSERVATION_MEMORY_MULTIPLE:
+        print(f"⚠️  Track build peaked at {peak_mb:.1f} MB, {ratio:.2f}x the raw observations "
+              f"({raw_mb:.1f} MB, limit {OBSERVATION_MEMORY_MULTIPLE}x)")
+        return False
+    print(f"✅ Track build peaked at {peak_mb:.1f} MB, {ratio:.2f}x the raw observations ({raw_mb:.1f} MB)")
+    return True
+
+
+def compare_to_baseline(results, scale_key):
+    """
+    Print a warning for each stage that regressed against the saved baseline.
+    With no baseline for this scale yet, these results become it.
+    """
+    baseline = None
+    if os.path.exists(BASELINE_FILE):
+        with open(BASELINE_FILE) as f:
+            baseline = json.load(f).get(scale_key)
+    if not baseline:
+        print(f"No baseline for scale {scale_key} yet - recording this run as the baseline")
+        save_baseline(results, scale_key)
+        return True
+
+    ok = True
+    for stage, current in results.items():
+        base = baseline.get(stage)
+        if not base:
+            continue
+        if current["seconds"] > base["seconds"] * REGRESSION_TOLERANCE:
+            print(f"⚠️  {stage}: {current['seconds']:.2f}s vs baseline {base['seconds']:.2f}s")
+            ok = False
+        if current["peak_mb"] > base["peak_mb"] * REGRESSION_TOLERANCE:
+            print(f"⚠️  {stage}: {current['peak_mb']:.1f} MB vs baseline {base['peak_mb']:.1f} MB")
+            ok = False
+    if ok:
+        print("✅ All stages within baseline")
+    return ok
+
+
+def save_baseline(results, scale_key):
+    baseline = {}
+    if os.path.exists(BASELINE_FILE):
+        with open(BASELINE_FILE) as f:
+            baseline = json.load(f)
+    baseline[scale_key] = results
+    with open(BASELINE_FILE, "w") as f:
+        json.dump(baseline, f, indent=2)
+    print(f"Baseline saved to {BASELINE_FILE}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the patrol export pipeline on synthetic data")
+    parser.add_argument("--scale", choices=SCALES, default="medium")
+    parser.add_argument("--points", type=int, help="Number of observation points (overrides --scale)")
+    parser.add_argument("--events", type=int, help="Number of events (overrides --scale)")
+    parser.add_argument("--latency-ms", type=float, default=20,
+                        help="Simulated round trip per event request in the patrol_events stages")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1,
+                        help="Worker processes for the flatten_parallel stage")
+    parser.add_argument("--repeat", type=int, default=1, help="Timed runs per stage (best is kept)")
+    parser.add_argument("--save-baseline", action="store_true", help="Save results as the new baseline")
+    args = parser.parse_args()
+
+    points = args.points or SCALES[args.scale]["points"]
+    n_events = args.events or SCALES[args.scale]["events"]
+    scale_key = f"{points}pts_{n_events}ev"
+
+    print("=" * 50)
+    print("Pipeline Benchmark")
+    print("=" * 50)
+    print(f"Generating synthetic data: {points:,} points, {n_events:,} events...\n")
+    er_io = FakeEarthRangerIO(points=points, events=n_events)
+    since, until = "2025-01-01T00:00:00", "2026-01-01T00:00:00"
+
+    results = {}
+
+    tracks, results["download_patrol_tracks"] = run_stage(
+        "download_patrol_tracks", points,
+        lambda: app.download_patrol_tracks(er_io, None, since, until)[0],
+        args.repeat
+    )
+
+    raw_events = er_io.get_events()
+    page = requests.Response()
+    page._content = json.dumps(raw_events.to_dict("records"), default=str).encode()
+    page.encoding = "utf-8"
+    _, results["decode_json"] = run_stage("decode_json", n_events, lambda: app.decode_json(page), args.repeat)
+
+    _, results["decode_event_fields"] = run_stage(
+        "decode_event_fields", n_events,
+        lambda: app.decode_event_fields(events_to_gdf(raw_events.copy())),
+        args.repeat
+    )
+
+    events_gdf = events_to_gdf(raw_events)
+    flattened, results["flatten_event_details"] = run_stage(
+        "flatten_event_details", n_events,
+        lambda: app.flatten_event_details(events_gdf.copy(), explode_lists=True),
+        args.repeat
+    )
+
+    lookup = app.build_subject_lookup(er_io)
+    resolved, results["resolve_uuid_columns"] = run_stage(
+        "resolve_uuid_columns", len(flattened),
+        lambda: app.resolve_uuid_columns(flattened, lookup, col_prefix=""),
+        args.repeat
+    )
+
+    # Both stages above on row partitions in a process pool; same output, compared to their sum
+    _, results["flatten_parallel"] = run_stage(
+        "flatten_parallel", n_events,
+        lambda: app.flatten_events_parallel(events_gdf.copy(), lookup, args.workers),
+        args.repeat
+    )
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        _, results["events_csv"] = run_stage(
+            "events_csv", len(resolved),
+            lambda: app.write_events_csv(resolved, os.path.join(tmpdir, "events"), ["geometry", "geojson"], {}),
+            args.repeat
+        )
+
+    _, results["shapefile_zip"] = run_stage(
+        "shapefile_zip", len(tracks),
+        lambda: app.build_shapefile_zip(tracks, "benchmark"),
+        args.repeat
+    )
+
+    # Patrol events: fetch everything then transform, vs transforming each segment
+    # while the next downloads. With simulated latency the second approaches max(network, CPU)
+    slow_io = FakeEarthRangerIO(points=points, events=n_events, latency_s=args.latency_ms / 1000)
+    snap_index = app.track_segment_index(tracks)
+
+    def prepare(events):
+        return app.prepare_patrol_events(events, tracks, snap_index=snap_index)
+
+    def fetch_then_prepare():
+        events, _ = app.fetch_patrol_events(slow_io, tracks, since, until, None)
+        return prepare(events)
+
+    _, results["patrol_events_sequential"] = run_stage(
+        "patrol_events_sequential", n_events, fetch_then_prepare, args.repeat
+    )
+    _, results["patrol_events_pipelined"] = run_stage(
+        "patrol_events_pipelined", n_events,
+        lambda: app.fetch_patrol_events(slow_io, tracks, since, until, None, transform=prepare)[0],
+        args.repeat
+    )
+
+    def fetch_streamed_to_csv():
+        """As the app exports patrol events: each segment resolved and written as it arrives"""
+        with app.EventsCSVWriter("events", ["geometry", "geojson"], {}) as writer:
+            app.fetch_patrol_events(slow_io, tracks, since, until, None, transform=prepare,
+                                    sink=lambda events: writer.write(events, lookup))
+            return writer.finish()
+
+    _, results["patrol_events_streamed_csv"] = run_stage(
+        "patrol_events_streamed_csv", n_events, fetch_streamed_to_csv, args.repeat
+    )
+
+    _, results["patrol_summary"] = run_stage(
+        "patrol_summary", len(tracks),
+        lambda: app.build_patrol_summary(tracks, group_by="both", period="W"),
+        args.repeat
+    )
+
+    observations = app.compact_observations(er_io.get_patrol_observations(er_io.get_patrols()))
+    codes = pd.factorize(observations["patrol_id"])[0]
+    order = np.lexsort((observations["extra__recorded_at"].array.asi8, codes))
+    grid, results["effort_grid"] = run_stage(
+        "effort_grid", len(order),
+        lambda: app.build_effort_grid(
+            observations["x"].to_numpy()[order], observations["y"].to_numpy()[order],
+            observations["extra__recorded_at"].array.asi8[order], codes[order], 1000
+        ),
+        args.repeat
+    )
+    _, results["effort_grid_parquet"] = run_stage(
+        "effort_grid_parquet", len(grid),
+        lambda: app.effort_grid_bytes(grid, "geoparquet"),
+        args.repeat
+    )
+
+    print(f"{'stage':<26}{'items':>10}{'seconds':>10}{'items/s':>14}{'peak MB':>10}")
+    for stage, r in results.items():
+        print(f"{stage:<26}{r['items']:>10,}{r['seconds']:>10.2f}{r['items_per_s']:>14,.0f}{r['peak_mb']:>10.1f}")
+    serial_s = results["flatten_event_details"]["seconds"] + results["resolve_uuid_columns"]["seconds"]
+    print(f"\nflatten_parallel: {serial_s / results['flatten_parallel']['seconds']:.1f}x "
+          f"flatten_event_details + resolve_uuid_columns on {args.workers} worker(s)")
+    print()
+
+    memory_ok = check_observation_memory(er_io, since, until)
+
+    if args.save_baseline:
+        save_baseline(results, scale_key)
+        return 0 if memory_ok else 1
+    baseline_ok = compare_to_baseline(results, scale_key)
+    return 0 if memory_ok and baseline_ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,277 @@
+"""
+Event table transforms used by app.py
+Flattening event_details and resolving UUIDs to display names live here rather
+than in the Streamlit script, so worker processes can import them without
+running the app. flatten_events_parallel spreads both over a process pool for
+very large exports.
+"""
+
+import os
+import pickle
+import queue
+import re
+import subprocess
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+# Workers run flatten_worker.py in a fresh interpreter. They are never forked
+# from the app (the Streamlit server is multithreaded and a fork can copy locks
+# other threads hold), and not started through multiprocessing either: its
+# spawn and forkserver children re-run the parent's __main__, which under
+# Streamlit is the app script.
+WORKER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'flatten_worker.py')
+
+_UUID_RE = re.compile(r'^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$', re.I)
+
+
+def _is_uuid(val):
+    return isinstance(val, str) and bool(_UUID_RE.match(val.strip()))
+
+
+def uuid_column_counts(df, col_prefix='detail_'):
+    """{column: (values that look like UUIDs, non-null values)} for every column resolve_uuid_columns considers"""
+    counts = {}
+    for col in df.columns:
+        if not col.endswith('_name') and col.startswith(col_prefix):
+            sample = df[col].dropna()
+            if not sample.empty:
+                counts[col] = (int(sample.apply(_is_uuid).sum()), len(sample))
+    return counts
+
+
+def uuid_names(values, uuid_to_name):
+    """Display name for each value of a column (empty string where it does not resolve)"""
+    return values.apply(lambda v: uuid_to_name.get(str(v).strip(), '') if isinstance(v, str) else '')
+
+
+def insert_name_columns(df, names):
+    """Insert every '<col>_name' series of names ({col: series}) immediately after its column"""
+    inserts = [(i + 1, col + '_name', names[col]) for i, col in enumerate(df.columns) if col in names]
+    if not inserts:
+        return df
+
+    # Rebuild column order with injected name columns
+    result = df.copy()
+    offset = 0
+    for pos, name_col, series in inserts:
+        if name_col not in result.columns:
+            result.insert(pos + offset, name_col, np.asarray(series))
+            offset += 1
+    return result
+
+
+def resolve_uuid_columns(df, uuid_to_name, col_prefix='detail_'):
+    """
+    For every column whose name starts with col_prefix and whose values look like
+    UUIDs, insert a companion '<col>_name' column immediately after it containing
+    the resolved display name (or empty string if not found).
+    Only adds the name column when at least one value resolves successfully.
+    """
+    if not uuid_to_name:
+        return df
+
+    names = {}
+    for col, (n_uuid, n_values) in uuid_column_counts(df, col_prefix).items():
+        if n_uuid / n_values >= 0.5:  # majority look like UUIDs
+            name_series = uuid_names(df[col], uuid_to_name)
+            if name_series.str.len().sum() > 0:  # at least one resolved
+                names[col] = name_series
+    return insert_name_columns(df, names)
+
+
+def list_detail_columns(event_details):
+    """
+    The detail_ columns that hold lists of dicts anywhere in a column of
+    event_details dicts, named the way pd.json_normalize names nested keys
+    """
+    found = set()
+
+    def walk(details, prefix):
+        for key, value in details.items():
+            if isinstance(value, dict):
+                walk(value, f"{prefix}{key}.")
+            elif isinstance(value, list) and len(value) > 0 and isinstance(value[0], dict):
+                found.add(f"detail_{prefix}{key}")
+
+    for details in event_details:
+        if isinstance(details, dict):
+            walk(details, '')
+    return found
+
+
+def flatten_event_details(events_gdf, explode_lists=False, list_columns=None, exploded=None):
+    """
+    Replace the event_details dicts with 'detail_' prefixed columns.
+    With explode_lists=True, detail_ columns holding lists of dicts (e.g. detail_Herd)
+    are also exploded to one row per list item and normalised into flat columns.
+    list_columns fixes which columns are exploded instead of detecting them in
+    this frame; given a dict, exploded is filled with {column: its flat columns}.
+    A plain DataFrame is flattened the same way and stays a DataFrame.
+    """
+    # A GeoDataFrame means geopandas is loaded; workers handed plain frames skip importing it
+    gpd = sys.modules.get('geopandas')
+    is_geo = gpd is not None and isinstance(events_gdf, gpd.GeoDataFrame)
+    if 'event_details' in events_gdf.columns:
+        # Extract event_details fields into separate columns
+        event_details_df = pd.json_normalize(events_gdf['event_details'])
+        # Reset index so it aligns with events_gdf after reset_index below.
+        # pd.json_normalize preserves the input Series index, which may not
+        # start at 0 — mismatched indices cause pd.concat(axis=1) to create
+        # extra NaN-filled rows instead of joining the single row correctly.
+        event_details_df = event_details_df.reset_index(drop=True)
+        # Add prefix to avoid column name conflicts
+        event_details_df.columns = ['detail_' + col for col in event_details_df.columns]
+        # Combine with main dataframe - preserve geometry
+        events_gdf = pd.concat([events_gdf.drop(columns='event_details').reset_index(drop=True), event_details_df], axis=1)
+        if is_geo:
+            # Restore as GeoDataFrame
+            events_gdf = gpd.GeoDataFrame(events_gdf, geometry='geometry', crs=4326)
+
+    if not explode_lists:
+        return events_gdf
+
+    # Unnest any detail_ columns that contain lists of dicts (e.g. detail_Herd)
+    if list_columns is not None:
+        list_dict_cols = [col for col in events_gdf.columns if col in list_columns]
+    else:
+        list_dict_cols = [
+            col for col in events_gdf.columns
+            if col.startswith('detail_') and events_gdf[col].apply(
+                lambda x: isinstance(x, list) and len(x) > 0 and isinstance(x[0], dict)
+            ).any()
+        ]
+    for col in list_dict_cols:
+        # Normalise empty/null to [{}] so rows are kept with NaN fields
+        events_gdf[col] = events_gdf[col].apply(
+            lambda x: x if (isinstance(x, list) and len(x) > 0) else [{}]
+        )
+        # Explode: one row per item in the list
+        events_gdf = events_gdf.explode(col, ignore_index=True)
+        # Normalise the dict into flat columns
+        nested_df = pd.json_normalize(events_gdf[col].apply(
+            lambda x: x if isinstance(x, dict) else {}
+        ))
+        if exploded is not None:
+            exploded[col] = list(nested_df.columns)
+        events_gdf = pd.concat([events_gdf.drop(columns=[col]).reset_index(drop=True), nested_df], axis=1)
+        if is_geo:
+            events_gdf = gpd.GeoDataFrame(events_gdf, geometry='geometry', crs=4326)
+    return events_gdf
+
+
+def flatten_partition(events_gdf, list_columns, uuid_to_name, col_prefix):
+    """
+    Worker for flatten_events_parallel: flatten and explode one partition, and
+    count and resolve its UUID-looking values without deciding which name
+    columns to keep - that needs the counts of every partition
+    """
+    exploded = {}
+    flat = flatten_event_details(events_gdf, explode_lists=True, list_columns=list_columns, exploded=exploded)
+    counts = uuid_column_counts(flat, col_prefix) if uuid_to_name else {}
+    names = {col: uuid_names(flat[col], uuid_to_name) for col, (n_uuid, _) in counts.items() if n_uuid}
+    return flat, exploded, counts, names
+
+
+def _run_worker(tasks, results):
+    """
+    Start one flatten_worker.py process and feed it (index, args) tasks from the
+    tasks queue until it is empty, storing each result at its index
+    """
+    worker = subprocess.Popen([sys.executable, WORKER_SCRIPT], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    try:
+        while True:
+            try:
+                index, args = tasks.get_nowait()
+            except queue.Empty:
+                break
+            pickle.dump(args, worker.stdin, protocol=pickle.HIGHEST_PROTOCOL)
+            worker.stdin.flush()
+            try:
+                ok, result = pickle.load(worker.stdout)
+            except EOFError:
+                raise RuntimeError(f"Flatten worker exited with code {worker.wait()}") from None
+            if not ok:
+                raise result
+            results[index] = result
+    except BaseException:
+        # Let the other workers stop after their current partition
+        try:
+            while True:
+                tasks.get_nowait()
+        except queue.Empty:
+            pass
+        worker.kill()
+        raise
+    finally:
+        try:
+            worker.stdin.close()  # EOF: the worker exits
+        except BrokenPipeError:
+            pass
+        worker.wait()
+        worker.stdout.close()
+
+
+def _ordered_union(target, columns):
+    seen = set(target)
+    target.extend(col for col in columns if col not in seen)
+
+
+def flatten_events_parallel(events_gdf, uuid_to_name, workers, col_prefix='', partitions=None):
+    """
+    flatten_event_details(explode_lists=True) followed by resolve_uuid_columns,
+    run on contiguous row ranges of events_gdf in a pool of worker processes.
+    The partial results are reconciled to the same rows, columns and column
+    order as running both on the whole frame: the exploded list columns are
+    agreed up front, columns are merged in order of first appearance, and name
+    columns are kept on the UUID counts of all partitions together.
+    """
+    import geopandas as gpd
+
+    partitions = partitions or workers * 2
+    bounds = np.linspace(0, len(events_gdf), min(partitions, len(events_gdf)) + 1).astype(int)
+    list_columns = list_detail_columns(events_gdf['event_details']) if 'event_details' in events_gdf.columns else set()
+
+    # Geometries are slow to pickle, so workers get each row's position in
+    # their place; exploding copies it to every row the event becomes
+    geometries = events_gdf.geometry.values
+    rows = pd.DataFrame(events_gdf).assign(geometry=np.arange(len(events_gdf)))
+
+    # Each worker process takes the next partition as soon as it is free
+    tasks = queue.Queue()
+    for index, (start, end) in enumerate(zip(bounds[:-1], bounds[1:])):
+        tasks.put((index, (rows.iloc[start:end], list_columns, uuid_to_name, col_prefix)))
+    results = [None] * tasks.qsize()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(_run_worker, tasks, results) for _ in range(min(workers, len(results)))]
+        for future in futures:
+            future.result()
+
+    # Columns in order of first appearance, each exploded column's items after the rest
+    columns, nested = [], {}
+    for flat, exploded, _, _ in results:
+        nested_columns = {col for cols in exploded.values() for col in cols}
+        _ordered_union(columns, [col for col in flat.columns if col not in nested_columns])
+        for col, cols in exploded.items():
+            _ordered_union(nested.setdefault(col, []), cols)
+    for cols in nested.values():
+        _ordered_union(columns, cols)
+    combined = pd.concat([flat for flat, _, _, _ in results], ignore_index=True)[columns]
+    combined['geometry'] = geometries[combined['geometry'].to_numpy(dtype=int)]
+    combined = gpd.GeoDataFrame(combined, geometry='geometry', crs=4326)
+
+    # Keep a name column when most of its values across all partitions look like UUIDs
+    names = {}
+    for col in combined.columns:
+        counts = [result[2][col] for result in results if col in result[2]]
+        if not counts or sum(n for n, _ in counts) / sum(n for _, n in counts) < 0.5:
+            continue
+        series = pd.concat(
+            [names_.get(col, pd.Series('', index=flat.index)) for flat, _, _, names_ in results],
+            ignore_index=True
+        )
+        if series.str.len().sum() > 0:
+            names[col] = series
+    return insert_name_columns(combined, names)
@@ -0,0 +1,32 @@
+"""
+Worker process for flatten_events_parallel
+Started by path as its own script, so the worker's __main__ is this module and
+never the Streamlit app. Reads pickled flatten_partition argument tuples from
+stdin until it closes and writes one pickled (ok, result or exception) pair
+per task to stdout.
+"""
+
+import pickle
+import sys
+
+from event_transforms import flatten_partition
+
+
+def main():
+    tasks, results = sys.stdin.buffer, sys.stdout.buffer
+    sys.stdout = sys.stderr  # Stray prints must not corrupt the result stream
+    while True:
+        try:
+            args = pickle.load(tasks)
+        except EOFError:
+            return
+        try:
+            reply = (True, flatten_partition(*args))
+        except Exception as e:
+            reply = (False, e)
+        pickle.dump(reply, results, protocol=pickle.HIGHEST_PROTOCOL)
+        results.flush()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,123 @@
+"""
+Page-view analytics never hold up the app
+Local http.server stubs stand in for a slow and a failing GoatCounter endpoint.
+Queueing a hit must return at once in both cases, the worker must keep going
+after errors, and a full queue must drop hits rather than block.
+Run with: python -m pytest test_analytics.py
+"""
+
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+os.environ.setdefault("GCF_ANALYTICS", "off")  # Importing the app must not send page views
+
+import app  # noqa: E402
+
+SLOW_ENDPOINT_S = 1.5   # longer than any app step should ever wait on analytics
+MAX_QUEUE_WAIT_S = 0.05  # what queueing one hit may cost the caller
+
+
+class CountingHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        with self.server.lock:
+            self.server.hits += 1
+        if self.server.delay_s:
+            time.sleep(self.server.delay_s)
+        self.send_response(self.server.status)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_stub(delay_s=0.0, status=200):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), CountingHandler)
+    server.daemon_threads = True
+    server.lock = threading.Lock()
+    server.hits = 0
+    server.delay_s = delay_s
+    server.status = status
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+@pytest.fixture
+def slow_endpoint():
+    server = start_stub(delay_s=SLOW_ENDPOINT_S)
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def failing_endpoint():
+    server = start_stub(status=500)
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def endpoint_url(server):
+    return f"http://127.0.0.1:{server.server_port}/count"
+
+
+def queue_hit(url):
+    """Queue one page view for url; returns seconds spent"""
+    start = time.perf_counter()
+    app.track_page_view(path="/test", url=url)
+    return time.perf_counter() - start
+
+
+def wait_until(condition, timeout_s):
+    deadline = time.monotonic() + timeout_s
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.02)
+    return False
+
+
+def test_slow_endpoint_does_not_delay_callers(slow_endpoint):
+    url = endpoint_url(slow_endpoint)
+    waits = [queue_hit(url) for _ in range(5)]
+    assert max(waits) < MAX_QUEUE_WAIT_S
+    # The worker is still busy with the first hit when the callers are done
+    assert wait_until(lambda: slow_endpoint.hits >= 1, SLOW_ENDPOINT_S)
+    assert slow_endpoint.hits < 5
+
+
+def test_failing_endpoint_is_ignored(failing_endpoint):
+    url = endpoint_url(failing_endpoint)
+    hits = app.get_analytics_queue(url)
+    for _ in range(5):
+        assert queue_hit(url) < MAX_QUEUE_WAIT_S
+    # Errors neither stop the worker nor leave hits unfinished
+    assert wait_until(lambda: hits.unfinished_tasks == 0, 10)
+    assert failing_endpoint.hits == 5
+
+
+def test_unreachable_endpoint_is_ignored():
+    server = start_stub()
+    url = endpoint_url(server)
+    server.shutdown()
+    server.server_close()  # Nothing listens on the port any more
+    hits = app.get_analytics_queue(url)
+    assert queue_hit(url) < MAX_QUEUE_WAIT_S
+    assert wait_until(lambda: hits.unfinished_tasks == 0, 10)
+
+
+def test_full_queue_drops_hits(slow_endpoint):
+    url = endpoint_url(slow_endpoint)
+    hits = app.get_analytics_queue(url)
+    start = time.perf_counter()
+    for _ in range(app.ANALYTICS_QUEUE_SIZE * 3):
+        queue_hit(url)
+    assert time.perf_counter() - start < 1.0
+    # The worker holds at most one batch; everything beyond the queue was dropped
+    assert hits.qsize() <= app.ANALYTICS_QUEUE_SIZE
+    assert hits.unfinished_tasks <= app.ANALYTICS_QUEUE_SIZE + app.ANALYTICS_BATCH_SIZE
@@ -0,0 +1,51 @@
+"""
+Tests for clip_tracks_to_aoi
+Clipped tracks must stay linear so they can be written as a line shapefile.
+Run with: python -m pytest test_aoi_clip.py
+"""
+
+import os
+
+import geopandas as gpd
+import numpy as np
+import pytest
+from shapely.geometry import LineString, box
+
+os.environ.setdefault("GCF_ANALYTICS", "off")  # Importing the app must not send page views
+
+import app  # noqa: E402
+
+AOI = box(16.0, -20.0, 16.01, -19.99)
+
+
+def clip(*lines):
+    tracks = gpd.GeoDataFrame({'patrol_id': [f"p{i}" for i in range(len(lines))]}, geometry=list(lines), crs=4326)
+    return app.clip_tracks_to_aoi(tracks, AOI)
+
+
+def test_crossing_track_is_cut_at_the_boundary():
+    clipped = clip(LineString([(15.99, -19.995), (16.02, -19.995)]))
+    assert clipped.geometry.iloc[0].equals(LineString([(16.0, -19.995), (16.01, -19.995)]))
+    assert np.isclose(clipped['aoi_dist_km'].iloc[0], 0.01 * 111)
+
+
+def test_tracks_touching_the_boundary_are_dropped():
+    corner = LineString([(15.99, -20.01), (16.0, -20.0), (15.99, -19.99)])  # Touches at one point
+    zigzag = LineString([(15.99, -19.995), (16.0, -19.996), (15.99, -19.997), (16.0, -19.998)])  # Two points
+    clipped = clip(corner, zigzag, LineString([(16.005, -19.995), (16.006, -19.995)]))
+    assert clipped['patrol_id'].tolist() == ['p2']
+
+
+def test_points_are_dropped_from_mixed_results():
+    # Runs along the boundary inside the AOI, then touches it again from outside
+    track = LineString([(16.002, -19.995), (16.008, -19.995), (16.012, -19.995), (16.01, -19.992), (16.012, -19.99)])
+    clipped = clip(track)
+    assert set(clipped.geom_type) <= {'LineString', 'MultiLineString'}
+    assert np.isclose(clipped['aoi_dist_km'].iloc[0], 0.008 * 111)
+
+
+@pytest.mark.filterwarnings("ignore:Column names longer than 10 characters", "ignore:Normalized/laundered field name")
+def test_clipped_tracks_write_to_a_shapefile(tmp_path):
+    corner = LineString([(15.99, -20.01), (16.0, -20.0), (15.99, -19.99)])
+    clip(corner, LineString([(15.99, -19.995), (16.02, -19.995)])).to_file(tmp_path / "tracks.shp")
+    assert len(gpd.read_file(tmp_path / "tracks.shp")) == 1
@@ -0,0 +1,101 @@
+"""
+The streamed patrol events CSV matches the one written from the combined frame
+EventsCSVWriter resolves and encodes each segment as it arrives; its finished
+file must have the same header, rows and name columns as running
+resolve_uuid_columns and write_events_csv on all segments concatenated.
+Run with: python -m pytest test_events_csv.py
+"""
+
+import os
+
+import pandas as pd
+
+os.environ.setdefault("GCF_ANALYTICS", "off")  # Importing the app must not send page views
+
+import app  # noqa: E402
+
+RANGER = "1b4c2a9e-0000-4000-8000-000000000001"
+VEHICLE = "1b4c2a9e-0000-4000-8000-000000000002"
+UNKNOWN = "1b4c2a9e-0000-4000-8000-0000000000ff"
+LOOKUP = {RANGER: "Ranger One", VEHICLE: "Land Cruiser"}
+DROP = ['geometry', 'geojson']
+RENAME = {'id': 'event_id', 'time': 'event_datetime'}
+
+
+def segments():
+    """Segments whose columns and UUID shares differ, as they do between patrol segments"""
+    return [
+        pd.DataFrame({
+            'id': ['e1', 'e2'], 'time': ['2024-01-01', '2024-01-02'], 'geojson': [{}, {}],
+            'detail_observer': [RANGER, 'notes, "quoted"'],
+            'detail_count': ['3', '4'],
+        }),
+        pd.DataFrame({
+            'id': ['e3'], 'time': ['2024-01-03'], 'geojson': [{}],
+            'detail_vehicle': [VEHICLE],
+            'detail_observer': [RANGER],
+        }),
+        pd.DataFrame({
+            'id': ['e4', 'e5', 'e6'], 'time': ['2024-01-04', '2024-01-05', '2024-01-06'], 'geojson': [{}, {}, {}],
+            'detail_observer': ['a\nmultiline note', None, 'x'],  # Observer is mostly not UUIDs overall
+            'detail_unknown': [UNKNOWN, UNKNOWN, None],  # UUIDs that never resolve
+            'detail_count': ['5', '6', '7'],
+        }),
+    ]
+
+
+def read(path, compression=None):
+    return pd.read_csv(path, dtype=str, keep_default_na=False, compression=compression)
+
+
+def combined_csv(tmp_path, blocks, compression=None):
+    combined = app.resolve_uuid_columns(pd.concat(blocks, ignore_index=True), LOOKUP, col_prefix='')
+    path, _ = app.write_events_csv(combined, str(tmp_path / "combined"), DROP, RENAME, compression=compression)
+    return path
+
+
+def streamed_csv(blocks, compression=None):
+    writer = app.EventsCSVWriter("streamed", DROP, RENAME, compression=compression)
+    with writer:
+        returned = [writer.write(block, LOOKUP) for block in blocks]
+        path, _ = writer.finish()
+        return read(path, 'infer'), returned, writer.rejected_name_columns()
+
+
+def test_matches_the_combined_frame(tmp_path):
+    expected = read(combined_csv(tmp_path, segments()))
+    streamed, _, _ = streamed_csv(segments())
+    assert list(streamed.columns) == list(expected.columns)
+    pd.testing.assert_frame_equal(streamed, expected)
+
+
+def test_name_columns_follow_all_segments(tmp_path):
+    streamed, returned, rejected = streamed_csv(segments())
+    # The observer column held UUIDs in the first segments only: below half overall
+    assert 'detail_observer_name' in returned[0].columns
+    assert 'detail_observer_name' not in streamed.columns
+    assert rejected == ['detail_observer_name']
+    assert streamed['detail_vehicle_name'].tolist() == ['', '', 'Land Cruiser', '', '', '']
+    assert 'detail_unknown_name' not in streamed.columns
+
+
+def test_single_layout_is_copied_through(tmp_path):
+    blocks = [segments()[0], segments()[0].assign(id=['e7', 'e8'])]
+    with open(combined_csv(tmp_path, blocks), 'rb') as f:
+        expected = f.read()
+    writer = app.EventsCSVWriter("streamed", DROP, RENAME)
+    with writer:
+        for block in blocks:
+            writer.write(block, LOOKUP)
+        path, mime = writer.finish()
+        with open(path, 'rb') as f:
+            assert f.read() == expected
+        assert mime == 'text/csv'
+    assert not os.path.exists(path)  # The context manager removes the file
+
+
+def test_gzip_output(tmp_path):
+    expected = read(combined_csv(tmp_path, segments(), 'gzip'), 'infer')
+    streamed, _, _ = streamed_csv(segments(), 'gzip')
+    pd.testing.assert_frame_equal(streamed, expected)
+
@@ -0,0 +1,160 @@
+"""
+Tests for the shared EarthRanger request scheduler
+The token bucket and round-robin queue are driven directly; throttling is
+checked end to end through configure_er_transport against a local
+http.server stub that answers with 429/503 responses.
+Run with: python -m pytest test_scheduler.py
+"""
+
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import requests
+
+os.environ.setdefault("GCF_ANALYTICS", "off")  # Importing the app must not send page views
+
+import app  # noqa: E402
+
+
+class ThrottlingHandler(BaseHTTPRequestHandler):
+    """Answers with the statuses queued in server.statuses, then 200"""
+    protocol_version = "HTTP/1.1"
+
+    def _respond(self):
+        self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        with self.server.lock:
+            self.server.requests.append((self.command, time.monotonic()))
+            status = self.server.statuses.pop(0) if self.server.statuses else 200
+        body = b'{"data": []}'
+        self.send_response(status)
+        if status in (429, 503):
+            self.send_header("Retry-After", str(self.server.retry_after))
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = _respond
+    do_POST = _respond
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def stub_server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), ThrottlingHandler)
+    server.daemon_threads = True
+    server.lock = threading.Lock()
+    server.requests = []
+    server.statuses = []
+    server.retry_after = 0
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+class StubEarthRangerIO:
+    """Just the part of EarthRangerIO configure_er_transport touches"""
+
+    def __init__(self):
+        self._http_session = requests.Session()
+
+
+def stub_url(server):
+    return f"http://127.0.0.1:{server.server_port}/api/v1.0/activity/events"
+
+
+def test_token_bucket_limits_the_rate():
+    scheduler = app.RequestScheduler(rate_per_s=20, burst=2)
+    start = time.monotonic()
+    for _ in range(6):
+        scheduler.acquire("host", "client")
+    # Two requests from the burst, four more at 20 per second
+    assert time.monotonic() - start >= 4 / 20 * 0.9
+    assert scheduler.metrics()["host"]["requests"] == 6
+
+
+def test_waiting_clients_are_served_round_robin():
+    scheduler = app.RequestScheduler(rate_per_s=20, burst=1)
+    scheduler.pause("host", 0.3)  # Everyone queues up behind the pause
+    served, lock = [], threading.Lock()
+
+    def request(client):
+        scheduler.acquire("host", client)
+        with lock:
+            served.append(client)
+
+    threads = []
+    for client in ["big"] * 4 + ["small"]:
+        threads.append(threading.Thread(target=request, args=(client,)))
+        threads[-1].start()
+        time.sleep(0.02)  # Queue in this order
+    for thread in threads:
+        thread.join(timeout=5)
+    # The second login's single request does not wait for the whole large export
+    assert served.index("small") <= 1
+
+
+def test_interrupted_acquire_withdraws_its_ticket():
+    scheduler = app.RequestScheduler(rate_per_s=1000, burst=1)
+    scheduler.pause("host", 0.2)
+    wait = scheduler._cond.wait
+
+    def interrupted_wait(timeout=None):
+        if threading.current_thread().name == "interrupted":
+            raise KeyboardInterrupt
+        return wait(timeout)
+
+    scheduler._cond.wait = interrupted_wait
+    errors = []
+
+    def interrupted():
+        try:
+            scheduler.acquire("host", "gone")
+        except KeyboardInterrupt as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=interrupted, name="interrupted")
+    thread.start()
+    thread.join(timeout=5)
+    assert errors
+    # The next client is served once the pause ends, not blocked behind the dead ticket
+    done = threading.Event()
+    threading.Thread(target=lambda: (scheduler.acquire("host", "next"), done.set()), daemon=True).start()
+    assert done.wait(timeout=2)
+
+
+def test_429_pauses_the_host_for_retry_after(stub_server):
+    stub_server.statuses = [429]
+    stub_server.retry_after = 1
+    er_io = app.configure_er_transport(StubEarthRangerIO())
+    response = er_io._http_session.get(stub_url(stub_server))
+    assert response.status_code == 200
+    (_, first), (_, second) = stub_server.requests
+    assert second - first >= 0.9
+    host = f"127.0.0.1:{stub_server.server_port}"
+    assert app.get_request_scheduler().metrics(hosts={host})[host]["throttled"] == 1
+
+
+def test_503_is_retried_for_get_only(stub_server):
+    er_io = app.configure_er_transport(StubEarthRangerIO())
+    stub_server.statuses = [503, 503]
+    assert er_io._http_session.get(stub_url(stub_server)).status_code == 200
+    assert len(stub_server.requests) == 3
+
+    stub_server.requests.clear()
+    stub_server.statuses = [503]
+    assert er_io._http_session.post(stub_url(stub_server), json={"title": "x"}).status_code == 503
+    assert len(stub_server.requests) == 1
+
+
+def test_metrics_can_be_limited_to_hosts():
+    scheduler = app.RequestScheduler(rate_per_s=1000, burst=10)
+    scheduler.acquire("mine.pamdas.org", "client")
+    scheduler.acquire("theirs.pamdas.org", "client")
+    assert list(scheduler.metrics(hosts={"mine.pamdas.org"})) == ["mine.pamdas.org"]
@@ -0,0 +1,57 @@
+"""
+Tests for segment track output in download_patrol_tracks
+Each segment's line carries that segment's own patrol type and leader, not
+those of the patrol's first fix.
+Run with: python -m pytest test_segment_tracks.py
+"""
+
+import os
+
+import pandas as pd
+
+os.environ.setdefault("GCF_ANALYTICS", "off")  # Importing the app must not send page views
+
+import app  # noqa: E402
+from benchmark_pipeline import FakeEarthRangerIO  # noqa: E402
+
+SINCE, UNTIL = "2025-01-01T00:00:00", "2026-01-01T00:00:00"
+
+
+class TwoSegmentIO(FakeEarthRangerIO):
+    """Each patrol is split halfway; the second half is a boat patrol segment with its own leader"""
+
+    def get_patrols(self, **kwargs):
+        patrols = super().get_patrols(**kwargs)
+        split = []
+        for segments in patrols['patrol_segments']:
+            segment = segments[0]
+            start, end = (pd.Timestamp(segment['time_range'][key]) for key in ['start_time', 'end_time'])
+            middle = (start + (end - start) / 2).isoformat()
+            split.append([
+                {**segment, 'time_range': {'start_time': segment['time_range']['start_time'], 'end_time': middle}},
+                {**segment, 'id': segment['id'] + '-2', 'patrol_type': 'boat_patrol',
+                 'leader': {'id': 'driver', 'name': 'Driver'},
+                 'time_range': {'start_time': middle, 'end_time': segment['time_range']['end_time']}},
+            ])
+        return patrols.assign(patrol_segments=split)
+
+    def get_patrol_observations(self, patrols_df, **kwargs):
+        # Observations cover the whole patrol, as before the split
+        whole = super().get_patrols()
+        return super().get_patrol_observations(whole[whole['id'].isin(patrols_df['id'])], **kwargs)
+
+
+def test_segment_lines_take_the_segment_type():
+    er_io = TwoSegmentIO(points=2000, events=10)
+    tracks, error = app.download_patrol_tracks(er_io, None, SINCE, UNTIL, track_mode='segment')
+    assert error is None
+    first = tracks[~tracks['segment_id'].str.endswith('-2')].set_index('patrol_id')
+    second = tracks[tracks['segment_id'].str.endswith('-2')].set_index('patrol_id')
+    assert len(first) == len(second) > 0
+    # A type the observations name is shown by its display name, as in patrol mode
+    whole, _ = app.download_patrol_tracks(FakeEarthRangerIO(points=2000, events=10), None, SINCE, UNTIL)
+    assert first['patrol_type'].to_dict() == whole.set_index('patrol_id')['patrol_type'].to_dict()
+    # Any other segment type keeps its value
+    assert set(second['patrol_type']) == {'boat_patrol'}
+    assert set(second['patrol_type__value']) == {'boat_patrol'}
+    assert set(second['subject_name']) == {'Driver'}
@@ -16,6 +16,7 @@ def test_imports():
         "ecoscope.io.earthranger": "Ecoscope EarthRanger integration",
         "shapely": "Shapely geometric operations",
         "pytz": "Timezone support",
+        "orjson": "Fast JSON decoding",
     }
     
     failed = []
@@ -0,0 +1,39 @@
+"""
+Tests for the nearest-track join in snap_events_to_tracks
+Run with: python -m pytest test_snapping.py
+"""
+
+import os
+
+import geopandas as gpd
+import numpy as np
+from shapely.geometry import LineString, Point, Polygon
+
+os.environ.setdefault("GCF_ANALYTICS", "off")  # Importing the app must not send page views
+
+import app  # noqa: E402
+
+
+def tracks():
+    """Two east-west tracks 0.01 degrees (~1.1 km) apart"""
+    return gpd.GeoDataFrame({
+        'patrol_id': ['north', 'south'],
+        'geometry': [LineString([(16.0, -20.0), (16.01, -20.0)]), LineString([(16.0, -20.01), (16.01, -20.01)])],
+    }, crs=4326)
+
+
+def test_points_snap_to_the_nearest_track():
+    events = gpd.GeoDataFrame(geometry=[Point(16.005, -20.001), Point(16.002, -20.009)], crs=4326)
+    snapped = app.snap_events_to_tracks(events, tracks())
+    assert snapped['nearest_patrol_id'].tolist() == ['north', 'south']
+    assert np.allclose(snapped['track_offset_m'], [110.6, 110.6], atol=1)
+    assert np.allclose(snapped['km_along_patrol'], [0.523, 0.209], atol=0.01)
+
+
+def test_non_point_events_snap_from_their_surface():
+    polygon = Polygon([(16.004, -20.0085), (16.006, -20.0085), (16.006, -20.0095), (16.004, -20.0095)])
+    events = gpd.GeoDataFrame(geometry=[Point(16.005, -20.001), polygon, None, Point(16.002, -20.009)], crs=4326)
+    snapped = app.snap_events_to_tracks(events, tracks())
+    assert snapped['nearest_patrol_id'].tolist() == ['north', 'south', None, 'south']
+    assert snapped['track_offset_m'].isna().tolist() == [False, False, True, False]
+    assert np.isclose(snapped['km_along_patrol'].iloc[1], 0.523, atol=0.01)
@@ -0,0 +1,55 @@
+"""
+Tests for the GPS spike filter in clean_track_fixes
+Run with: python -m pytest test_track_cleaning.py
+"""
+
+import os
+
+import numpy as np
+
+os.environ.setdefault("GCF_ANALYTICS", "off")  # Importing the app must not send page views
+
+import app  # noqa: E402
+
+MAX_SPEED_KMH = 50
+
+
+def patrol_fixes(n, spikes=(), code=0):
+    """n fixes one minute and ~110 m apart (about 7 km/h), with a 1 degree jump at each index in spikes"""
+    xs = 16.0 + np.arange(n) * 0.001
+    xs[list(spikes)] += 1.0
+    ys = np.full(n, -20.0)
+    times_ns = np.arange(n, dtype=np.int64) * 60 * 10**9
+    return xs, ys, times_ns, np.full(n, code)
+
+
+def spike_mask(*patrols):
+    xs, ys, times_ns, codes = (np.concatenate(parts) for parts in zip(*patrols))
+    keep, _ = app.clean_track_fixes(xs, ys, times_ns, codes, max_speed_kmh=MAX_SPEED_KMH)
+    return keep.tolist()
+
+
+def test_interior_spike_is_dropped():
+    assert spike_mask(patrol_fixes(5, spikes=[2])) == [True, True, False, True, True]
+
+
+def test_spike_next_to_first_fix_keeps_first_fix():
+    assert spike_mask(patrol_fixes(5, spikes=[1])) == [True, False, True, True, True]
+
+
+def test_spike_next_to_last_fix_keeps_last_fix():
+    assert spike_mask(patrol_fixes(5, spikes=[3])) == [True, True, True, False, True]
+
+
+def test_spiked_endpoints_are_dropped():
+    assert spike_mask(patrol_fixes(5, spikes=[0])) == [False, True, True, True, True]
+    assert spike_mask(patrol_fixes(5, spikes=[4])) == [True, True, True, True, False]
+
+
+def test_patrols_are_cleaned_independently():
+    keep = spike_mask(patrol_fixes(4, spikes=[1], code=0), patrol_fixes(4, spikes=[2], code=1))
+    assert keep == [True, False, True, True, True, True, False, True]
+
+
+def test_clean_track_is_untouched():
+    assert all(spike_mask(patrol_fixes(6)))
@@ -0,0 +1,23 @@
+"""
+The track build's peak memory stays within OBSERVATION_MEMORY_MULTIPLE of the
+raw observation frame, so it never holds several copies of it at once.
+Uses the synthetic EarthRanger data from benchmark_pipeline.py.
+Run with: python -m pytest test_track_memory.py
+"""
+
+import os
+
+os.environ.setdefault("GCF_ANALYTICS", "off")  # Importing the app must not send page views
+
+from benchmark_pipeline import OBSERVATION_MEMORY_MULTIPLE, FakeEarthRangerIO, observation_memory  # noqa: E402
+
+POINTS = 100_000  # large enough that the frame, not fixed overheads, dominates the peak
+SINCE, UNTIL = "2025-01-01T00:00:00", "2026-01-01T00:00:00"
+
+
+def test_track_build_stays_within_observation_memory_bound():
+    peak_mb, raw_mb = observation_memory(FakeEarthRangerIO(points=POINTS, events=10), SINCE, UNTIL)
+    assert raw_mb > 0
+    assert peak_mb <= OBSERVATION_MEMORY_MULTIPLE * raw_mb, (
+        f"track build peaked at {peak_mb:.1f} MB, {peak_mb / raw_mb:.2f}x the raw observations ({raw_mb:.1f} MB)"
+    )
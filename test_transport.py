@@ -0,0 +1,130 @@
+"""
+Connection reuse through the shared EarthRanger HTTP pool
+A local http.server stub records which client connection served each request,
+so these tests fail if configure_er_transport stops reusing keep-alive
+connections across requests and sessions.
+Run with: python -m pytest test_transport.py
+"""
+
+import gzip
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import requests
+
+os.environ.setdefault("GCF_ANALYTICS", "off")  # Importing the app must not send page views
+
+import app  # noqa: E402
+
+
+class KeepAliveHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # Keep connections open between requests
+
+    def do_GET(self):
+        with self.server.lock:
+            self.server.connections.append(self.client_address)
+        if self.path.endswith("/gzip"):
+            self._send_gzip(chunked=self.path.endswith("/chunked/gzip"))
+            return
+        body = b'<html>Bad gateway</html>' if self.path.endswith("/html") else b'{"data": []}'
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_gzip(self, chunked):
+        """A gzip body, sent in chunks with no Content-Length as large API pages often are"""
+        body = gzip.compress(json.dumps({"data": [{"id": i} for i in range(2000)]}).encode())
+        self.server.sent_bytes = len(body)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Encoding", "gzip")
+        if not chunked:
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        for start in range(0, len(body), 1000):
+            chunk = body[start:start + 1000]
+            self.wfile.write(f"{len(chunk):x}\r\n".encode() + chunk + b"\r\n")
+        self.wfile.write(b"0\r\n\r\n")
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def stub_server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), KeepAliveHandler)
+    server.daemon_threads = True
+    server.lock = threading.Lock()
+    server.connections = []
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+class StubEarthRangerIO:
+    """Just the part of EarthRangerIO configure_er_transport touches"""
+
+    def __init__(self):
+        self._http_session = requests.Session()
+
+
+def test_requests_reuse_one_connection(stub_server):
+    er_io = app.configure_er_transport(StubEarthRangerIO())
+    url = f"http://127.0.0.1:{stub_server.server_port}/api/v1.0/activity/patrols"
+    for _ in range(10):
+        er_io._http_session.get(url).raise_for_status()
+    assert len(stub_server.connections) == 10
+    assert len(set(stub_server.connections)) == 1
+    assert app.get_er_call_stats(er_io)["calls"] == 10
+
+
+def test_sessions_share_the_pool(stub_server):
+    url = f"http://127.0.0.1:{stub_server.server_port}/api/v1.0/subjects"
+    for _ in range(3):
+        er_io = app.configure_er_transport(StubEarthRangerIO())
+        er_io._http_session.get(url).raise_for_status()
+    assert len(set(stub_server.connections)) == 1
+
+
+def test_concurrent_requests_stay_within_pool_size(stub_server):
+    er_io = app.configure_er_transport(StubEarthRangerIO())
+    url = f"http://127.0.0.1:{stub_server.server_port}/api/v1.0/activity/events"
+    with ThreadPoolExecutor(max_workers=app.ER_POOL_MAXSIZE * 2) as pool:
+        responses = list(pool.map(lambda _: er_io._http_session.get(url), range(app.ER_POOL_MAXSIZE * 2)))
+    assert all(response.ok for response in responses)
+    assert len(set(stub_server.connections)) <= app.ER_POOL_MAXSIZE
+
+
+def test_gzip_bytes_are_counted_as_received(stub_server):
+    er_io = app.configure_er_transport(StubEarthRangerIO())
+    url = f"http://127.0.0.1:{stub_server.server_port}/api/v1.0/activity/gzip"
+    assert len(er_io._http_session.get(url).json()["data"]) == 2000
+    assert app.get_er_call_stats(er_io)["bytes"] == stub_server.sent_bytes  # Compressed size
+
+
+def test_chunked_bytes_are_counted(stub_server):
+    er_io = app.configure_er_transport(StubEarthRangerIO())
+    url = f"http://127.0.0.1:{stub_server.server_port}/api/v1.0/activity/chunked/gzip"
+    response = er_io._http_session.get(url)
+    # No Content-Length: counted after decoding rather than as 0
+    assert app.get_er_call_stats(er_io)["bytes"] == len(response.content)
+
+
+def test_json_is_decoded_like_requests(stub_server):
+    er_io = app.configure_er_transport(StubEarthRangerIO())
+    base = f"http://127.0.0.1:{stub_server.server_port}/api/v1.0/activity"
+    assert er_io._http_session.get(f"{base}/gzip").json() == requests.get(f"{base}/gzip").json()
+    # Bodies that are not JSON raise the error erclient expects from requests
+    with pytest.raises(requests.exceptions.JSONDecodeError):
+        er_io._http_session.get(f"{base}/html").json()